@@ -10,6 +10,8 @@ import traceback # [新增] 用于打印堆栈
 
 # 引用数据库工具 (用于打印日志)
 import 数据库工具 as db_util
+import 图片处理
+from 媒体仓库 import 媒体仓库
 
 # ===========================
 # 配置文件路径
@@ -32,6 +34,7 @@ class AI决策大脑:
         self.超时设置 = 300      # 请求超时 (秒)
         self.最大Token = 10000   # 回复最大长度 (Token)
         self.代理配置 = None     # 代理设置
+        self.媒体仓库 = 媒体仓库()  # 读图片时刷新最近使用时间，记命中 / 缺失
         
         # 启动时加载
         self.加载配置()
@@ -99,7 +102,7 @@ class AI决策大脑:
             db_util.带时间的日志打印(f"❌ [AI] 提示词读取错误: {e}")
 
     def 图片转Base64(self, 图片路径):
-        if not 图片路径 or not os.path.exists(图片路径):
+        if not 图片路径 or not self.媒体仓库.取用(图片路径):
             return None
         try:
             # 检查文件扩展名，只接受标准图片格式
@@ -113,7 +116,16 @@ class AI决策大脑:
                 return None
 
             with open(图片路径, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
+                图片字节 = image_file.read()
+            # 监听TG 入库时已经规范化过；老文件 / 监听端没装 Pillow 存的原图在这里压缩，只在内存里
+            if 图片处理.可用():
+                图片配置 = 图片处理.读取_图片配置()
+                if 图片配置["启用"] and 图片处理.需要压缩(图片字节, 图片配置["最大边长"]):
+                    try:
+                        图片字节, _ = 图片处理.压缩(图片字节, 图片配置["最大边长"], 图片配置["格式"], 图片配置["质量"])
+                    except Exception as e:
+                        db_util.带时间的日志打印(f"⚠️ [AI] 图片压缩失败，发送原图: {e}")
+            return base64.b64encode(图片字节).decode('utf-8')
         except Exception as e:
             db_util.带时间的日志打印(f"⚠️ [AI] 图片读取失败: {e}")
             return None
@@ -171,7 +183,7 @@ class AI决策大脑:
             if Base64字串:
                 用户内容.append({
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{Base64字串}"}
+                    "image_url": {"url": f"data:{'image/png' if Base64字串.startswith('iVBORw0KGgo') else 'image/jpeg'};base64,{Base64字串}"}  # iVBORw0KGgo = PNG 文件头
                 })
 
         请求头 = {
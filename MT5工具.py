@@ -5,6 +5,7 @@ import os
 import json
 import time
 import traceback
+from datetime import datetime, timedelta
 
 # 引用数据库工具用于打印日志
 import 数据库工具 as db
@@ -392,6 +393,23 @@ class MT5助手:
             db.带时间的日志打印(f"❌ [MT5] 查找持仓失败: {e}")
             return None
 
+    def 查找备注订单(self, 备注, 回看小时=24):
+        """按下单备注找已经发出去的单：挂单 -> 持仓 -> 最近的历史订单 (已成交 / 已平)，返回 ticket；
+        没有返回 None；MT5 查询失败抛 RuntimeError (查不清楚就不能当作没下过)"""
+        if not self.已连接: self.启动连接()
+        结束 = datetime.now() + timedelta(days=1)  # 服务器时区和本地不一样，两头放宽
+        查询列表 = [mt5.orders_get, mt5.positions_get,
+                    lambda: mt5.history_orders_get(结束 - timedelta(hours=回看小时 + 48), 结束)]
+        for 查询 in 查询列表:
+            列表 = 查询()
+            # 查不到东西也可能返回 None，last_error 为负数才是真的失败
+            if 列表 is None and mt5.last_error()[0] < 0:
+                raise RuntimeError(f"MT5 查询失败: {mt5.last_error()}")
+            for 单 in 列表 or ():
+                if 单.comment == 备注:
+                    return int(单.ticket)
+        return None
+
     def 断开连接(self):
         """标记连接已断开（用于错误恢复）"""
         self.已连接 = False
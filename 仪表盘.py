@@ -9,8 +9,9 @@ import os
 import plotly.express as px
 import traceback # [Debug] 引入堆栈工具
 import sys # [Debug] 用于强制刷新输出
-from datetime import datetime
+from datetime import datetime, timedelta
 from 查看数据库 import 读取数据_df
+import 数据库工具 as db
 
 # [Debug] 全局日志函数
 def 控制台日志(消息, 是否错误=False):
@@ -73,6 +74,10 @@ else:
 st.sidebar.markdown("---")
 # 自动刷新开关
 自动刷新 = st.sidebar.checkbox('开启自动刷新 (5s)', value=True)
+# 主库只留近期结算，更早的在 archive/ 的月度归档库里
+包含归档 = st.sidebar.checkbox('包含归档历史', value=False)
+# 结算时间窗 (走 settlements.close_ms 索引)
+时间范围 = st.sidebar.selectbox('结算时间范围', ['全部', '今天', '近7天', '近30天'], index=0)
 st.sidebar.markdown("---")
 if st.sidebar.button("🔄 立即刷新"):
     st.rerun()
@@ -83,9 +88,36 @@ if st.sidebar.button("🔄 立即刷新"):
 # console_log("📥 开始读取核心业务数据...")
 
 # 1. 结算数据
-结算表 = 读取数据("SELECT * FROM settlements")
-# 2. 持仓数据
-持仓表 = 读取数据("SELECT * FROM active_positions")
+开始 = None
+if 时间范围 != '全部':
+    今天零点 = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    开始 = 今天零点 - timedelta(days={'今天': 0, '近7天': 6, '近30天': 29}[时间范围])
+    结算表 = pd.DataFrame(db.查询_结算区间(开始, 包含归档=包含归档))
+elif 包含归档:
+    try:
+        结算表 = pd.DataFrame(db.查询_全历史("settlements"))
+    except Exception as e:
+        控制台日志(f"❌ [归档读取失败] {e}", 是否错误=True)
+        st.error(f"❌ 归档读取失败: {e}")
+        结算表 = pd.DataFrame()
+else:
+    # 按变更序号增量读取：没有新结算就复用上一轮的表，只新增时只读新行
+    try:
+        if "结算缓存" not in st.session_state:
+            st.session_state.结算缓存 = db.增量表缓存("settlements")
+        结算行, 有变化 = st.session_state.结算缓存.获取()
+        if 有变化 or "结算表" not in st.session_state:
+            st.session_state.结算表 = pd.DataFrame(结算行)
+        结算表 = st.session_state.结算表
+    except Exception as e:
+        控制台日志(f"❌ [增量读取失败] {e}", 是否错误=True)
+        结算表 = 读取数据("SELECT * FROM settlements")
+# 2. 持仓数据 (结构或实时价格有变化才重读)
+if "持仓缓存" not in st.session_state:
+    st.session_state.持仓缓存 = db.变更缓存(lambda: 读取数据("SELECT * FROM active_positions"), "active_positions", "active_positions.实时")
+持仓表 = st.session_state.持仓缓存.获取()
+# 3. KOL 战绩 (kol_stats 汇总表，含已归档历史，不再对结算表做 groupby)
+战绩表 = pd.DataFrame(db.查询_KOL战绩())
 
 # ===========================
 # 主界面渲染
@@ -94,10 +126,10 @@ if st.sidebar.button("🔄 立即刷新"):
 st.title("📊 MT5交易系统 - 实时监控仪表盘")
 
 # --- KPI 区域 ---
-if not 结算表.empty:
-    总盈亏 = 结算表['profit'].sum()
-    总单数 = len(结算表)
-    胜单数 = len(结算表[结算表['profit'] > 0])
+if not 战绩表.empty:
+    总盈亏 = 战绩表['total_profit'].sum()
+    总单数 = int(战绩表['total_trades'].sum())
+    胜单数 = int(战绩表['win_count'].sum())
     胜率 = (胜单数 / 总单数 * 100) if 总单数 > 0 else 0
     浮动盈亏 = 持仓表['unrealized_pnl'].sum() if (not 持仓表.empty and 'unrealized_pnl' in 持仓表.columns) else 0.0
 
@@ -114,12 +146,8 @@ else:
 
 # Tab 1: 琅琊榜
 with 标签1:
-    if not 结算表.empty:
-        统计 = 结算表.groupby('kol_name').agg(
-            总收益=('profit', 'sum'),
-            交易次数=('id', 'count'),
-            胜单=('profit', lambda x: (x > 0).sum())
-        ).reset_index()
+    if not 战绩表.empty:
+        统计 = 战绩表.rename(columns={'total_profit': '总收益', 'total_trades': '交易次数', 'win_count': '胜单'})[['kol_name', '总收益', '交易次数', '胜单']]
         统计['胜率'] = (统计['胜单'] / 统计['交易次数'] * 100).map('{:.1f}%'.format)
         统计 = 统计.sort_values('总收益', ascending=False)
 
@@ -131,6 +159,15 @@ with 标签1:
     else:
         st.write("暂无数据")
 
+    # 止盈止损习惯 (shadow_signals 的 JSON 生成列，聚合在 SQL 里做；时间窗跟随侧边栏)
+    止盈止损表 = pd.DataFrame(db.查询_KOL止盈止损统计(开始))
+    if not 止盈止损表.empty:
+        st.subheader("🎯 止盈止损习惯")
+        止盈止损表 = 止盈止损表.rename(columns={'signal_count': '开仓信号', 'avg_tp_count': '平均止盈个数', 'max_tp_count': '最多止盈个数',
+                                               'limit_count': '挂单信号', 'avg_sl_distance': '平均止损距离',
+                                               'min_sl_distance': '最小止损距离', 'max_sl_distance': '最大止损距离'})
+        st.dataframe(止盈止损表.round(2), hide_index=True, width='stretch')
+
 # Tab 2: 持仓
 with 标签2:
     # 只从数据库读取持仓数据（包括手动持仓，由统计端负责同步）
@@ -144,11 +181,12 @@ with 标签2:
             'entry_price': '开仓价',
             'current_price': '当前价',
             'unrealized_pnl': '浮动盈亏',
-            'tp_goal': '止盈价'
+            'tp_goal': '止盈价',
+            'exit_sl': '止损价'
         }
 
         # 智能筛选存在的列
-        列表 = [c for c in ['ticket', 'kol_name', 'symbol', 'direction', 'entry_price', 'current_price', 'unrealized_pnl', 'tp_goal'] if c in 持仓表.columns]
+        列表 = [c for c in ['ticket', 'kol_name', 'symbol', 'direction', 'entry_price', 'current_price', 'unrealized_pnl', 'tp_goal', 'exit_sl'] if c in 持仓表.columns]
         显示表 = 持仓表[列表].copy()
         显示表.columns = [列名映射.get(c, c) for c in 显示表.columns]
         st.dataframe(显示表, hide_index=True, width='stretch')
@@ -162,11 +200,11 @@ with 标签3:
     # 从数据库读取所有挂单（只显示 state='挂单' 的记录）
     所有挂单 = 读取数据("""
         SELECT
-            c.id, c.created_at, c.kol_name, c.symbol,
+            c.id, datetime(c.created_ms / 1000, 'unixepoch', 'localtime') AS created_at, c.kol_name, c.symbol,
             c.direction, c.volume, c.price, c.sl, c.tp, c.mt5_ticket, c.state
         FROM command_queue c
         WHERE c.status = '已执行' AND c.state = '挂单'
-        ORDER BY c.created_at DESC
+        ORDER BY c.created_ms DESC
     """)
 
     if not 所有挂单.empty:
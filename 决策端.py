@@ -5,7 +5,9 @@ import json
 import logging
 import math
 import time
+import threading
 import traceback
+import collections
 from flask import Flask, request, jsonify
 
 # 引入基建
@@ -154,15 +156,95 @@ def 计算拆单计划(总手数, TP列表, 原始方向=None):
             
     return 计划列表
 
+# ===========================
+# 消息去重 (侦察兵发件箱超时重投时同一条消息会再来一次)
+# ===========================
+# 处理中: 还在分析 / 下单，重投回 409 让侦察兵过会儿再投 (不能说 "重复"，这次要是失败了消息就丢了)
+# 已处理: 处理完 (下单的和父信号同一个事务) 才记进 processed_messages，重投回 "重复"；重启后也认得
+处理中消息 = set()
+已处理消息 = collections.OrderedDict()  # message_id -> AI 是否判定为信号，库里 processed_messages 的内存缓存
+已处理消息上限 = 2000
+_已收消息锁 = threading.Lock()
+
+def 登记消息(消息键):
+    """返回 "新" (已登记为处理中) / "处理中" / "已处理"；没带 message_id 的老版本侦察兵不去重"""
+    if not 消息键:
+        return "新"
+    with _已收消息锁:
+        if 消息键 in 处理中消息:
+            return "处理中"
+        if 消息键 in 已处理消息:
+            return "已处理"
+        处理中消息.add(消息键)
+    记录 = db.查询_已处理消息(消息键)  # 重启前处理过的
+    if 记录:
+        结束消息(消息键, True, 记录["is_signal"])
+        return "已处理"
+    return "新"
+
+def 结束消息(消息键, 已完成, 是否信号=False):
+    """处理结束：成功的记进 已处理消息，失败 (返回 500) 的只撤掉处理中，侦察兵重投时重新处理"""
+    if not 消息键:
+        return
+    with _已收消息锁:
+        处理中消息.discard(消息键)
+        if 已完成:
+            已处理消息[消息键] = bool(是否信号)
+            while len(已处理消息) > 已处理消息上限:
+                已处理消息.popitem(last=False)
+
+def 消息已出信号(消息键):
+    with _已收消息锁:
+        if 消息键 in 已处理消息:
+            return 已处理消息[消息键]
+    记录 = db.查询_已处理消息(消息键)
+    return bool(记录 and 记录["is_signal"])
+
 # ===========================
 # Webhook 接口 (接收侦察兵数据)
 # ===========================
 @app.route('/webhook', methods=['POST'])
 def 接收情报接口():
+    数据包 = request.get_json(silent=True)
+    if not 数据包: return jsonify({"状态": "忽略"}), 200
+
+    消息键 = 数据包.get("message_id")
+    状态 = 登记消息(消息键)
+    if 状态 == "处理中":
+        db.带时间的日志打印(f"⏳ [决策端] 消息 {消息键} 还在处理，重投稍后再来")
+        return jsonify({"状态": "处理中"}), 409
+    if 状态 == "已处理":
+        db.带时间的日志打印(f"♻️ [决策端] 重复消息 {消息键}，已处理过，忽略")
+        return jsonify({"状态": "重复"}), 200
+
+    上下文 = {"是否信号": False}
+    已完成 = False
     try:
-        数据包 = request.json
-        if not 数据包: return jsonify({"状态": "忽略"}), 200
+        # 侦察兵先发了文字、图片下载完后补发的同一条消息：文字还在分析就让侦察兵晚点再投，已经出过信号就不再分析，避免重复下单
+        原消息键 = 数据包.get("补充")
+        with _已收消息锁:
+            原消息处理中 = 原消息键 in 处理中消息
+        if 原消息处理中:
+            return jsonify({"状态": "处理中", "原因": "原消息还在分析"}), 409
+        if 原消息键 and 消息已出信号(原消息键):
+            db.带时间的日志打印(f"🖼️ [决策端] {原消息键} 的图片补充到达，文字已出信号，忽略")
+            响应, 状态码 = jsonify({"状态": "忽略", "原因": "原消息已出信号"}), 200
+        else:
+            响应, 状态码 = 处理情报(数据包, 消息键, 上下文)
+        if 状态码 < 500 and 消息键:
+            db.写入_已处理消息(消息键, 上下文["是否信号"])  # 下单的已在下单事务里记过，这里不覆盖
+        已完成 = 状态码 < 500
+        return 响应, 状态码
+    except Exception as e:
+        db.带时间的日志打印(f"❌ [决策端] 消息 {消息键} 处理异常: {e}")
+        db.带时间的日志打印(traceback.format_exc())
+        return jsonify({"状态": "错误"}), 500
+    finally:
+        结束消息(消息键, 已完成, 上下文["是否信号"])
 
+def 处理情报(数据包, 消息键, 上下文):
+    """分析 + 下单，返回 (响应, 状态码)；上下文["是否信号"] 记 AI 的判定"""
+    try:
         KOL名称 = 数据包.get("author", "匿名")
         原始内容 = 数据包.get("content", "")
         图片列表 = 数据包.get("images", [])
@@ -171,8 +253,8 @@ def 接收情报接口():
         打印器.决策_收到信号_紧凑版(KOL名称, len(图片列表))
         # db.带时间的日志打印(f"📨 [决策端] 收到: {KOL名称} | 图片: {len(图片列表)}张") # 系统日志可以保留，也可以注释
 
-        # [新增] 读取历史上下文 (最近2条)
-        历史记录 = db.读取_最近聊天记录(KOL名称, limit=2)
+        # [新增] 读取历史上下文 (条数按 配置.json -> 聊天上下文，走内存缓存)
+        历史记录 = db.读取_最近聊天记录(KOL名称)
 
         # [Debug] 打印发送给AI的文本内容
         实际发送文本 = f"KOL名称: {KOL名称}\n原始消息:\n{原始内容}"
@@ -187,6 +269,7 @@ def 接收情报接口():
 
         # [新增] 记录本次交互到数据库
         db.写入_聊天记录(KOL名称, 原始内容, AI原始回复, 是否信号)
+        上下文["是否信号"] = bool(是否信号 and 分析结果)
 
         # [修改 2] 打印 AI 结果提示
         # 打印器.决策_AI结果_提示(耗时)
@@ -247,16 +330,18 @@ def 接收情报接口():
             if 方向 == "平仓":
                 打印器.决策_平仓令(KOL名称, 品种)
                 db.带时间的日志打印(f"🚨 [收到清盘令] {KOL名称} 要求平仓 {品种}")
-                父ID = db.写入_父信号(KOL名称, 品种, "平仓", "市价", 0, {})
-                db.写入_子命令(父ID, KOL名称, 品种, "平仓", 0, 0, 0, 0)
+                父ID = db.写入_信号及子命令(KOL名称, 品种, "平仓", "市价", 0, {}, [("平仓", 0, 0, 0, 0)], 消息键)
+                if 父ID == -1:
+                    return jsonify({"状态": "数据库错误"}), 500
                 return jsonify({"状态": "成功", "类型": "平仓指令"}), 200
 
             # === 🔥 分支 C: 止盈/保本指令 ===
             if 方向 == "止盈":
                 打印器.决策_平仓令(KOL名称, 品种) # 复用平仓打印
                 db.带时间的日志打印(f"🥂 [收到止盈令] {KOL名称} 提示 {品种} 止盈/保本")
-                父ID = db.写入_父信号(KOL名称, 品种, "止盈", "市价", 0, {})
-                db.写入_子命令(父ID, KOL名称, 品种, "止盈", 0, 0, 0, 0)
+                父ID = db.写入_信号及子命令(KOL名称, 品种, "止盈", "市价", 0, {}, [("止盈", 0, 0, 0, 0)], 消息键)
+                if 父ID == -1:
+                    return jsonify({"状态": "数据库错误"}), 500
                 return jsonify({"状态": "成功", "类型": "止盈指令"}), 200
 
             # === 🔥 分支 B: 开仓指令 (做多/做空) ===
@@ -272,10 +357,7 @@ def 接收情报接口():
 
             # 4. 写入数据库
             try:
-                # (1) 父信号
-                父ID = db.写入_父信号(KOL名称, 品种, 方向, 模式, 挂单价, {"sl": 止损, "tps": TP列表})
-                
-                # (2) 转换方向
+                # (1) 转换方向
                 mt5_direction = ""
                 if 模式 == "市价":
                     mt5_direction = "买入" if 方向 == "做多" else "卖出"
@@ -283,9 +365,11 @@ def 接收情报接口():
                     mt5_direction = "买入限价" if 方向 == "做多" else "卖出限价"
                     if 挂单价 <= 0: 挂单价 = 0 
 
-                # (3) 子命令入队
-                for 计划 in 拆单结果:
-                    db.写入_子命令(父ID, KOL名称, 品种, mt5_direction, 计划['手数'], 挂单价, 止损, 计划['tp'])
+                # (2) 父信号 + 子命令 一个事务入库
+                子命令列表 = [(mt5_direction, 计划['手数'], 挂单价, 止损, 计划['tp']) for 计划 in 拆单结果]
+                父ID = db.写入_信号及子命令(KOL名称, 品种, 方向, 模式, 挂单价, {"sl": 止损, "tps": TP列表}, 子命令列表, 消息键)
+                if 父ID == -1:
+                    return jsonify({"状态": "数据库错误"}), 500
 
                 # [修改 6] 移除大块的决策完成打印，仅保留简短的系统日志
                 # db.带时间的日志打印(f"✅ [系统日志] 决策入库成功 SignalID:{父ID}")
@@ -306,7 +390,14 @@ def 接收情报接口():
         db.带时间的日志打印(traceback.format_exc())
         return jsonify({"状态": "错误"}), 500
 
+@app.route('/metrics', methods=['GET'])
+def 运行指标():
+    """后台写入队列深度 / 刷新耗时 / 聊天上下文缓存命中 / temp_images 读取命中和占用"""
+    return jsonify({"后台写入": db.获取后台写入指标(), "聊天缓存": db.聊天缓存.指标(), "媒体仓库": AI核心.媒体仓库.指标()}), 200
+
 if __name__ == "__main__":
     端口 = 获取监听端口()
+    db.带时间的日志打印(f"💬 [决策端] 聊天上下文缓存已预热: {db.预热_聊天缓存()} 个KOL")
+    db.带时间的日志打印(f"♻️ [决策端] 清理 7 天前的已处理消息: {db.清理_已处理消息()} 条")
     print(f"\n🔥 决策端已启动 (Port: {端口}) [大脑就绪]...\n")
     app.run(host='0.0.0.0', port=端口, debug=False)
\ No newline at end of file
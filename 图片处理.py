@@ -0,0 +1,87 @@
+# 图片处理.py
+# -*- coding: utf-8 -*-
+"""
+图片入库规范化：监听TG 下载完截图马上处理一次，AI分析 发给模型的就是处理后的小文件。
+    - 长边超过 最大边长 的等比缩小 (K 线截图缩到 1568 看不出区别，模型端反正也会缩)
+    - 按 格式 / 质量 重新编码，透明背景铺白底；格式 = 自动 时 JPEG 和 PNG 都编一遍取小的
+      (纯色块多的图表截图 PNG 往往更小，照片 / 拍屏 JPEG 小得多；原图是 JPEG 的只编 JPEG)
+    - 不带 EXIF / ICC / PNG 文本块等元数据 (先按 EXIF 方向转正再丢掉)
+按内容哈希存文件、清理在 媒体仓库.py。
+
+需要 Pillow (pip install pillow)；没装时 媒体仓库 按原图存、AI分析 发原图，其它流程不受影响。
+"""
+import os
+import io
+import json
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+配置文件路径 = os.path.join(BASE_DIR, "配置.json")
+
+默认配置 = {"启用": True, "最大边长": 1568, "格式": "自动", "质量": 85}
+可处理扩展名 = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+格式扩展名 = {"JPEG": ".jpg", "PNG": ".png"}
+
+def 读取_图片配置():
+    """配置.json -> 图片规范化 (没有就用默认值)"""
+    try:
+        with open(配置文件路径, 'r', encoding='utf-8') as f:
+            return {**默认配置, **json.load(f).get("图片规范化", {})}
+    except Exception:
+        return dict(默认配置)
+
+def 可用():
+    return Image is not None
+
+def 需要压缩(原始字节, 最大边长):
+    """只读文件头：不是 JPEG/PNG 或长边超过 最大边长 的 (入库时没规范化过的老图、监听端没装 Pillow 时存的原图)"""
+    try:
+        with Image.open(io.BytesIO(原始字节)) as 图:
+            return 图.format not in 格式扩展名 or max(图.size) > 最大边长
+    except Exception:
+        return False
+
+# ===========================
+# 压缩
+# ===========================
+def 压缩(原始字节, 最大边长=1568, 格式="JPEG", 质量=85):
+    """图片字节 -> (规范化后的字节, 扩展名)；不是静态图片时抛 Pillow 的异常"""
+    格式 = 格式.upper()
+    if 格式 not in 格式扩展名 and 格式 != "自动":
+        raise ValueError(f"不支持的输出格式: {格式} (可选: 自动, {', '.join(格式扩展名)})")
+    with Image.open(io.BytesIO(原始字节)) as 原图:
+        if getattr(原图, "n_frames", 1) > 1:
+            raise ValueError("动图不处理")
+        原图有损 = 原图.format == "JPEG"
+        原图.draft("RGB", (最大边长, 最大边长))  # JPEG 直接按 1/2、1/4 解码，大照片省掉大半解码时间
+        图 = ImageOps.exif_transpose(原图)  # 返回新图，方向已转正
+    if 图.mode in ("1", "P"):
+        图 = 图.convert("RGBA" if "transparency" in 图.info else "RGB")  # 调色板图缩放只能用最近邻
+    图.thumbnail((最大边长, 最大边长), Image.LANCZOS)  # 只缩不放
+    # encoder 会从 info 里带上 icc_profile / exif / PNG 文本块，清空就不写元数据
+    图.info = {}
+    候选 = []
+    if 格式 in ("JPEG", "自动"):
+        候选.append((_编码JPEG(图, 质量), 格式扩展名["JPEG"]))
+    # 原图已经是 JPEG (Telegram 发的照片都是)，转无损 PNG 只会更大，还要白费几百 ms 到几秒 (optimize 很慢)
+    if 格式 == "PNG" or (格式 == "自动" and not 原图有损):
+        缓冲 = io.BytesIO()
+        图.save(缓冲, "PNG", optimize=True)  # PNG 无损，质量 只对 JPEG 有效
+        候选.append((缓冲.getvalue(), 格式扩展名["PNG"]))
+    return min(候选, key=lambda c: len(c[0]))
+
+def _编码JPEG(图, 质量):
+    if 图.mode in ("RGBA", "LA"):
+        图 = 图.convert("RGBA")
+        底 = Image.new("RGB", 图.size, (255, 255, 255))
+        底.paste(图, mask=图.getchannel("A"))
+        图 = 底
+    elif 图.mode not in ("RGB", "L"):
+        图 = 图.convert("RGB")
+    缓冲 = io.BytesIO()
+    图.save(缓冲, "JPEG", quality=质量, optimize=True)
+    return 缓冲.getvalue()
@@ -0,0 +1,131 @@
+# 媒体仓库.py
+# -*- coding: utf-8 -*-
+"""
+temp_images 按内容寻址存储：监听TG 下载的图片规范化后以内容 sha256 命名，同一张图 (重发、几个 KOL 互相转发) 只存一份，
+推给决策端的消息里引用的就是这个路径；文件名即内容，引用它的消息再多也不用记引用计数。
+    - 最近使用时间就是文件 mtime：入库撞上已有的、AI分析 读取时都刷新一下，监听TG 和 决策端 两个进程看到的是同一份
+    - 清理 (监听TG 后台每 清理间隔秒 一次)：超过 保留小时 没用过的删掉；总量超过 上限MB 时按最近使用时间从旧到新删 (LRU)。
+      保护分钟 内用过的不删：发件箱里还没投出去、决策端还没分析的消息要用
+    - 视频、GIF 不进仓库 (AI分析 不收)，监听TG 直接不下载
+"""
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+import 图片处理
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+配置文件路径 = os.path.join(BASE_DIR, "配置.json")
+默认_仓库目录 = os.path.join(BASE_DIR, "temp_images")
+
+默认配置 = {"上限MB": 500, "保留小时": 72, "保护分钟": 30, "清理间隔秒": 600}
+_哈希长度 = 32
+_临时文件保留秒 = 3600  # 进程崩溃留下的 .tmp
+
+def 读取_仓库配置():
+    """配置.json -> 媒体仓库 (没有就用默认值)"""
+    try:
+        with open(配置文件路径, 'r', encoding='utf-8') as f:
+            return {**默认配置, **json.load(f).get("媒体仓库", {})}
+    except Exception:
+        return dict(默认配置)
+
+class 媒体仓库:
+    """入库 / 清理 是文件 IO，在 监听TG 里用 asyncio.to_thread 调；计数是本进程的"""
+
+    def __init__(self, 目录=默认_仓库目录, 配置=None, 图片配置=None):
+        配置 = 配置 or 读取_仓库配置()
+        self.目录 = 目录
+        self.上限字节 = 配置["上限MB"] * 1_000_000
+        self.保留秒 = 配置["保留小时"] * 3600
+        self.保护秒 = 配置["保护分钟"] * 60
+        self.清理间隔秒 = 配置["清理间隔秒"]
+        self.图片配置 = 图片配置 or 图片处理.读取_图片配置()
+        os.makedirs(目录, exist_ok=True)
+        self.入库命中 = self.入库新增 = 0
+        self.读取命中 = self.读取缺失 = 0
+        self.清理删除 = self.清理释放字节 = 0
+
+    def 入库(self, 路径):
+        """下载好的文件 -> 仓库里的 {sha256}{扩展名}，原文件删除。图片先规范化 (缩小、去元数据)，没装 Pillow / 处理失败按原样存"""
+        扩展名 = os.path.splitext(路径)[1].lower()
+        with open(路径, "rb") as f:
+            数据 = f.read()
+        if 扩展名 in 图片处理.可处理扩展名 and 图片处理.可用() and self.图片配置["启用"]:
+            try:
+                数据, 扩展名 = 图片处理.压缩(数据, self.图片配置["最大边长"], self.图片配置["格式"], self.图片配置["质量"])
+            except Exception as e:
+                print(f"⚠️ 图片规范化失败，按原图入库 {os.path.basename(路径)}: {e!r}")
+        目标 = os.path.join(self.目录, hashlib.sha256(数据).hexdigest()[:_哈希长度] + 扩展名)
+        try:
+            os.utime(目标)  # 已经有了：只刷新最近使用时间
+            self.入库命中 += 1
+        except FileNotFoundError:
+            # 先写临时文件再替换，决策端不会读到半个文件；临时文件名各用各的，同一张图并发入库也不冲突
+            句柄, 临时 = tempfile.mkstemp(suffix=".tmp", dir=self.目录)
+            with os.fdopen(句柄, "wb") as f:
+                f.write(数据)
+            os.replace(临时, 目标)
+            self.入库新增 += 1
+        if os.path.abspath(路径) != os.path.abspath(目标):
+            os.remove(路径)
+        return 目标
+
+    def 取用(self, 路径):
+        """读文件前调用：还在就刷新最近使用时间 (LRU) 记一次命中；已经被清理掉记一次缺失，返回 False"""
+        try:
+            os.utime(路径)
+        except OSError:
+            self.读取缺失 += 1
+            return False
+        self.读取命中 += 1
+        return True
+
+    def _扫描(self):
+        """[(最近使用时间, 字节, 路径)]，顺手删掉过时的 .tmp"""
+        现在 = time.time()
+        文件列表 = []
+        for 项 in os.scandir(self.目录):
+            try:
+                if not 项.is_file():
+                    continue
+                信息 = 项.stat()
+                if 项.name.endswith(".tmp"):
+                    if 现在 - 信息.st_mtime > _临时文件保留秒:
+                        os.remove(项.path)
+                    continue
+            except FileNotFoundError:
+                continue  # 扫描途中被别人删了 / 改名了
+            文件列表.append((信息.st_mtime, 信息.st_size, 项.path))
+        return 文件列表
+
+    def 清理(self):
+        """删掉超过保留时间的，总量还超上限就按最近使用时间从旧到新删，保护期内的不动；返回本次统计"""
+        现在 = time.time()
+        文件列表 = sorted(self._扫描())
+        总量 = sum(大小 for _, 大小, _ in 文件列表)
+        删除 = 释放 = 0
+        for 时间, 大小, 路径 in 文件列表:
+            if 现在 - 时间 < self.保护秒:
+                break
+            if 现在 - 时间 <= self.保留秒 and 总量 <= self.上限字节:
+                break  # 按时间排好序，后面的都更新
+            try:
+                os.remove(路径)
+            except FileNotFoundError:
+                pass
+            总量 -= 大小
+            删除 += 1
+            释放 += 大小
+        self.清理删除 += 删除
+        self.清理释放字节 += 释放
+        return {"删除": 删除, "释放MB": round(释放 / 1e6, 2), "剩余文件": len(文件列表) - 删除, "占用MB": round(总量 / 1e6, 2)}
+
+    def 指标(self):
+        文件列表 = self._扫描()
+        return {"文件数": len(文件列表), "占用MB": round(sum(大小 for _, 大小, _ in 文件列表) / 1e6, 2),
+                "上限MB": round(self.上限字节 / 1e6), "入库命中": self.入库命中, "入库新增": self.入库新增,
+                "读取命中": self.读取命中, "读取缺失": self.读取缺失,
+                "清理删除": self.清理删除, "清理释放MB": round(self.清理释放字节 / 1e6, 2)}
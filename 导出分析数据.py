@@ -0,0 +1,196 @@
+# 导出分析数据.py
+# -*- coding: utf-8 -*-
+"""
+把 settlements / shadow_signals / chat_history 增量导出成按 月份 + KOL 分区的 Parquet，给离线分析用。
+不用再拷整个 影子订单簿.db 跑 read_sql_query：每次只导出上次水位 (id) 之后的新行 (含归档库)，
+按 id 分块读，每块一条短查询，不会长时间占着读事务。
+
+目录结构 (hive 分区，pyarrow / pandas / duckdb 都能直接读):
+    analytics/settlements/month=2026-01/kol=黄金帝国/part-00000001-00005000.parquet
+    analytics/_watermark.json   # {表: 已导出的最大 id}
+
+用法:
+    python 导出分析数据.py                 # 增量导出全部表到 analytics/
+    python 导出分析数据.py settlements     # 只导出指定表
+    python 导出分析数据.py --dir D:/分析   # 指定导出目录
+
+离线分析:
+    from 导出分析数据 import 读取_导出
+    表 = 读取_导出("settlements", 月份=["2026-01", "2026-02"], kol="黄金帝国")   # pyarrow.Table (内存映射读)
+    df = 表.to_pandas()
+
+需要 pyarrow (pip install pyarrow)，只有导出/读取时才用到，其它模块不依赖它。
+注意: 按 id 增量，导出的是行插入后第一次被导出时的样子；shadow_signals 之后的状态变化不会回写到已导出的文件。
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import itertools
+
+import 数据库工具 as db
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+except ImportError:
+    pa = None
+
+# 表: 分区用的 (毫秒时间列, KOL列)
+导出表 = {
+    "settlements": ("close_ms", "kol_name"),
+    "shadow_signals": ("ts_ms", "kol_name"),
+    "chat_history": ("created_ms", "kol_name"),
+}
+每块行数 = 5000
+默认_导出目录 = os.path.join(db.BASE_DIR, "analytics")
+_未知分区 = "未知"
+
+def _需要pyarrow():
+    if pa is None:
+        raise RuntimeError("导出/读取 Parquet 需要 pyarrow: pip install pyarrow")
+
+# ===========================
+# 水位 (每张表已导出的最大 id)
+# ===========================
+def _水位文件(导出目录):
+    return os.path.join(导出目录, "_watermark.json")
+
+def 读取_水位(导出目录=默认_导出目录):
+    try:
+        with open(_水位文件(导出目录), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _写入水位(导出目录, 水位):
+    # 先写临时文件再替换，中途崩溃也不会留下半个 JSON
+    临时 = _水位文件(导出目录) + ".tmp"
+    with open(临时, 'w', encoding='utf-8') as f:
+        json.dump(水位, f, ensure_ascii=False, indent=2)
+    os.replace(临时, _水位文件(导出目录))
+
+# ===========================
+# 导出
+# ===========================
+_类型映射 = {"INTEGER": "int64", "REAL": "float64"}
+
+def _表结构(表):
+    """主库里的 [(列名, pyarrow 类型)]：INTEGER -> int64，REAL -> float64，其余 (TEXT/TIMESTAMP) -> string"""
+    cursor = db.获取读连接().cursor()
+    cursor.execute(f"PRAGMA table_info({表})")
+    return [(info[1], pa.type_for_alias(_类型映射.get((info[2] or "").upper(), "string"))) for info in cursor.fetchall()]
+
+def _分区值(值):
+    """目录名里不能出现的字符按 %XX 转义 (pyarrow 读 hive 分区时会解回来)"""
+    if 值 is None or 值 == "":
+        return _未知分区
+    return "".join(f"%{ord(c):02X}" if c in '/\\:*?"<>|%' else c for c in str(值))
+
+def _月份(毫秒):
+    return datetime.datetime.fromtimestamp(毫秒 / 1000).strftime("%Y-%m") if 毫秒 is not None else _未知分区
+
+def _分块读取(cursor, 表, 列, 起始id):
+    """按 id 分块 (keyset 分页)，每块一条独立的短查询；这个库里缺的列补 NULL (老归档库)"""
+    cursor.execute(f"PRAGMA table_info({表})")
+    已有列 = {info[1] for info in cursor.fetchall()}
+    if not 已有列:
+        return  # 这个归档库里没有这张表
+    选择 = ", ".join(c if c in 已有列 else f"NULL AS {c}" for c in 列)
+    while True:
+        cursor.execute(f"SELECT {选择} FROM {表} WHERE id > ? ORDER BY id LIMIT ?", (起始id, 每块行数))
+        行列表 = cursor.fetchall()
+        if not 行列表:
+            return
+        yield 行列表
+        起始id = 行列表[-1][0]
+
+def _写分区文件(导出目录, 表, 结构, 行列表):
+    """一块行按 (月份, KOL) 分组，每组写一个 part 文件，返回写入的文件数"""
+    列 = [c for c, _ in 结构]
+    时间位置, kol位置 = 列.index(导出表[表][0]), 列.index(导出表[表][1])
+    分组 = {}
+    for 行 in 行列表:
+        分组.setdefault((_月份(行[时间位置]), _分区值(行[kol位置])), []).append(行)
+    schema = pa.schema(结构)
+    for (月份, kol), 组 in 分组.items():
+        目录 = os.path.join(导出目录, 表, f"month={月份}", f"kol={kol}")
+        os.makedirs(目录, exist_ok=True)
+        数组 = [pa.array([行[i] for 行 in 组], type=类型) for i, (_, 类型) in enumerate(结构)]
+        # 文件名由 id 范围决定：同一块重导会覆盖同名文件，不会重复
+        文件 = os.path.join(目录, f"part-{组[0][0]:08d}-{组[-1][0]:08d}.parquet")
+        pq.write_table(pa.Table.from_arrays(数组, schema=schema), 文件 + ".tmp", compression="zstd")
+        os.replace(文件 + ".tmp", 文件)
+    return len(分组)
+
+def 导出_增量(表列表=None, 导出目录=默认_导出目录):
+    """把各表上次水位之后的新行 (主库 + 归档库) 导出成分区 Parquet，返回 {表: 导出行数}"""
+    _需要pyarrow()
+    os.makedirs(导出目录, exist_ok=True)
+    db.后台写入.刷新()  # 本进程队列里的聊天记录先落盘
+    水位 = 读取_水位(导出目录)
+    结果 = {}
+    for 表 in 表列表 or list(导出表):
+        结构 = _表结构(表)
+        列 = [c for c, _ in 结构]
+        起始id = 水位.get(表, 0)
+        行数 = 文件数 = 0
+        # 归档库里的 id 都比主库现存的小：先按月份顺序导归档，最后导主库，水位单调增长
+        # (遍历_历史库 第一个产出主库游标，归档库的连接在迭代到下一个时关闭，所以边迭代边导)
+        历史库 = db.遍历_历史库() if 表 in db.归档表 else iter([db.获取读连接().cursor()])
+        主库 = next(历史库)
+        for cursor in itertools.chain(历史库, [主库]):
+            cursor.row_factory = None
+            for 行列表 in _分块读取(cursor, 表, 列, 水位.get(表, 0)):
+                文件数 += _写分区文件(导出目录, 表, 结构, 行列表)
+                行数 += len(行列表)
+                水位[表] = max(水位.get(表, 0), 行列表[-1][0])
+                _写入水位(导出目录, 水位)  # 每块写完就推进水位，中断后从这里继续
+        结果[表] = 行数
+        if 行数:
+            db.带时间的日志打印(f"📦 [导出] {表}: {行数} 行 -> {文件数} 个文件 (id {起始id} -> {水位[表]})")
+    return 结果
+
+# ===========================
+# 读取 (离线分析)
+# ===========================
+def 读取_导出(表, 导出目录=默认_导出目录, 月份=None, kol=None, 列=None):
+    """读导出的 Parquet 为 pyarrow.Table (内存映射，按分区裁剪)；月份 / kol 可传单个值或列表。
+    还没导出过的表返回同样结构的空表"""
+    _需要pyarrow()
+    if 表 not in 导出表:
+        raise ValueError(f"未知表: {表} (可选: {', '.join(导出表)})")
+    分区字段 = [("month", pa.string()), ("kol", pa.string())]  # KOL 名是纯数字也当字符串
+    if not os.path.isdir(os.path.join(导出目录, 表)):
+        空表 = pa.schema(_表结构(表) + 分区字段).empty_table()
+        return 空表.select(列) if 列 else 空表
+    分区 = ds.partitioning(pa.schema(分区字段), flavor="hive")
+    数据集 = ds.dataset(os.path.join(导出目录, 表), format="parquet", partitioning=分区,
+                     filesystem=pafs.LocalFileSystem(use_mmap=True))
+    条件 = None
+    for 字段, 值 in (("month", 月份), ("kol", kol)):
+        if 值 is None:
+            continue
+        值列表 = [值] if isinstance(值, str) else list(值)
+        子条件 = ds.field(字段).isin(值列表)
+        条件 = 子条件 if 条件 is None else 条件 & 子条件
+    return 数据集.to_table(columns=列, filter=条件)
+
+if __name__ == "__main__":
+    参数 = sys.argv[1:]
+    导出目录 = 默认_导出目录
+    if "--dir" in 参数:
+        位置 = 参数.index("--dir")
+        导出目录 = 参数[位置 + 1]
+        del 参数[位置:位置 + 2]
+    未知 = [t for t in 参数 if t not in 导出表]
+    if 未知:
+        print(f"❌ 未知表: {', '.join(未知)} (可选: {', '.join(导出表)})")
+        sys.exit(1)
+    db.初始化数据库()
+    开始 = time.perf_counter()
+    结果 = 导出_增量(参数 or None, 导出目录)
+    db.带时间的日志打印(f"✅ [导出] 完成: {结果}，耗时 {(time.perf_counter() - 开始) * 1000:.0f} ms，目录: {导出目录}")
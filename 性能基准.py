@@ -0,0 +1,762 @@
+# 性能基准.py
+# -*- coding: utf-8 -*-
+"""
+数据库工具 性能基准
+所有项目都在临时目录的独立数据库上运行，不会碰正在使用的 影子订单簿.db
+
+用法:
+    python 性能基准.py            # 运行全部项目
+    python 性能基准.py 连接开销    # 只运行指定项目
+    python 性能基准.py 多进程争用 --json 结果.json   # 有结构化结果的项目写入 JSON，方便跨版本对比
+    python 性能基准.py 数据规模 --规模 10000,100000  # 数据规模 默认跑 1 万 / 10 万 / 100 万条结算 (100 万要几分钟)
+    python 性能基准.py 图片压缩 --图片目录 D:/截图  # 图片压缩 默认用生成的 K 线截图，也可以指定一个放真实截图的目录 (需要 Pillow)
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import shutil
+import sqlite3
+import platform
+import tempfile
+import threading
+import collections
+import multiprocessing
+import contextlib
+import tracemalloc
+import math
+
+import 数据库工具 as db
+import 生成测试数据
+
+# ===========================
+# 公共工具
+# ===========================
+@contextlib.contextmanager
+def 临时数据库():
+    """把 数据库工具 指向临时目录里的新库，结束后恢复并删除"""
+    原路径 = db.数据库文件
+    临时目录 = tempfile.mkdtemp(prefix="kol_bench_")
+    db.数据库文件 = os.path.join(临时目录, "影子订单簿.db")
+    try:
+        db.初始化数据库()
+        yield db.数据库文件
+    finally:
+        db.后台写入.刷新()  # 队列里的日志写回临时库，别漏到下一个库
+        db.关闭连接()
+        db.数据库文件 = 原路径
+        shutil.rmtree(临时目录, ignore_errors=True)
+
+def 计时(函数, 次数):
+    """返回单次调用的平均耗时 (微秒)"""
+    开始 = time.perf_counter()
+    for _ in range(次数):
+        函数()
+    return (time.perf_counter() - 开始) / 次数 * 1e6
+
+def 打印对比(标题, 旧耗时, 新耗时, 单位="µs/次"):
+    倍数 = 旧耗时 / 新耗时 if 新耗时 > 0 else float("inf")
+    print(f"  {标题:<24} 旧: {旧耗时:>10.1f} {单位} | 新: {新耗时:>10.1f} {单位} | 提升 {倍数:.1f}x")
+
+# ===========================
+# 项目 1: 连接开销 (每次 connect/close vs 每线程长连接)
+# ===========================
+def 基准_连接开销(次数=2000):
+    print(f"\n[连接开销] 每个函数调用 {次数} 次")
+    with 临时数据库() as 路径:
+        db.写入_子命令(1, "基准KOL", "XAUUSD", "买入", 0.01, 0, 2000, 2010)
+
+        def 旧_读取():
+            conn = sqlite3.connect(路径, timeout=30)
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM command_queue WHERE status = '待执行'")
+            cursor.fetchall()
+            conn.close()
+
+        def 旧_写入():
+            conn = sqlite3.connect(路径, timeout=30)
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO execution_logs (time, action, details) VALUES (?, ?, ?)", ("", "基准", ""))
+            conn.commit()
+            conn.close()
+
+        打印对比("读取_待执行命令", 计时(旧_读取, 次数), 计时(db.读取_待执行命令, 次数))
+        def 新_写入():
+            db.写入_执行日志("基准", "")
+        新耗时 = 计时(新_写入, 次数)
+        刷新耗时 = 计时(db.后台写入.刷新, 1) / 次数  # 后台落盘的成本摊到每条
+        打印对比("写入_执行日志", 计时(旧_写入, 次数), 新耗时)
+        print(f"  {'└ 后台批量落盘':<22} 摊到每条: {刷新耗时:>10.1f} µs | {db.获取后台写入指标()}")
+
+# ===========================
+# 项目 2: command_queue 状态同步 (逐行 Python 循环 vs 集合运算 UPDATE)
+# ===========================
+def _旧版_更新command_queue_state(真实Ticket_集合, 挂单_ticket_集合):
+    """改造前的实现：扫全部已执行命令，在 Python 里逐行比对"""
+    with db.数据库事务() as cursor:
+        cursor.execute("SELECT id, mt5_ticket, state FROM command_queue WHERE status='已执行'")
+        更新数 = 0
+        for cmd_id, ticket, 当前_state in cursor.fetchall():
+            if ticket is None:
+                continue
+            if int(ticket) in 真实Ticket_集合:
+                新_state = "持仓"
+            elif int(ticket) in 挂单_ticket_集合:
+                新_state = "挂单"
+            else:
+                新_state = "已结束"
+            if 新_state != 当前_state:
+                cursor.execute("UPDATE command_queue SET state=? WHERE id=?", (新_state, cmd_id))
+                更新数 += 1
+    return 更新数
+
+def 基准_状态同步(历史命令数=100_000, 持仓数=50, 挂单数=20, 次数=20):
+    print(f"\n[状态同步] 历史命令 {历史命令数} 条 | 持仓 {持仓数} | 挂单 {挂单数} | 每种调用 {次数} 次")
+    with 临时数据库():
+        with db.数据库事务() as cursor:
+            cursor.executemany(
+                "INSERT INTO command_queue (signal_id, kol_name, symbol, direction, volume, price, sl, tp, status, mt5_ticket, state) "
+                "VALUES (?, '基准KOL', 'XAUUSD', '买入', 0.01, 0, 0, 0, '已执行', ?, '已结束')",
+                [(i, 1_000_000 + i) for i in range(历史命令数)]
+            )
+        最新 = 1_000_000 + 历史命令数
+        真实Ticket_集合 = set(range(最新 - 持仓数, 最新))
+        挂单_ticket_集合 = set(range(最新 - 持仓数 - 挂单数, 最新 - 持仓数))
+
+        # 首轮会把活单从 '已结束' 改回来，两种实现都先各跑一遍进入稳态
+        _旧版_更新command_queue_state(真实Ticket_集合, 挂单_ticket_集合)
+        旧耗时 = 计时(lambda: _旧版_更新command_queue_state(真实Ticket_集合, 挂单_ticket_集合), 次数) / 1000
+        db.更新command_queue_state(0, 真实Ticket_集合, 挂单_ticket_集合)
+        新耗时 = 计时(lambda: db.更新command_queue_state(0, 真实Ticket_集合, 挂单_ticket_集合), 次数) / 1000
+        打印对比("更新command_queue_state", 旧耗时, 新耗时, 单位="ms/次")
+
+        # 正确性: 持仓单 -> 一个平仓、一个挂单成交
+        平仓 = max(真实Ticket_集合)
+        成交 = min(挂单_ticket_集合)
+        真实Ticket_集合 = (真实Ticket_集合 - {平仓}) | {成交}
+        挂单_ticket_集合 = 挂单_ticket_集合 - {成交}
+        assert db.更新command_queue_state(0, 真实Ticket_集合, 挂单_ticket_集合) == 2
+        cursor = db.获取读连接().cursor()
+        cursor.execute("SELECT state, COUNT(*) FROM command_queue GROUP BY state")
+        分布 = dict(cursor.fetchall())
+        assert 分布 == {"持仓": 持仓数, "挂单": 挂单数 - 1, "已结束": 历史命令数 - 持仓数 - 挂单数 + 1}, 分布
+        print(f"  状态分布校验通过: {分布}")
+
+# ===========================
+# 项目 3: 读写并发 (API 读请求 vs 正在跑的同步循环)
+# ===========================
+def _百分位(样本, 比例):
+    if not 样本:
+        return 0.0
+    样本 = sorted(样本)
+    return 样本[min(len(样本) - 1, int(len(样本) * 比例))]
+
+def 基准_读写并发(持仓数=200, 结算数=50_000, 读线程数=8, 秒数=3, 同步间隔=0.02):
+    print(f"\n[读写并发] 持仓 {持仓数} | 结算 {结算数} | API 读线程 {读线程数} | 同步间隔 {同步间隔}s | 每种模式 {秒数}s")
+    with 临时数据库():
+        with db.数据库事务() as cursor:
+            cursor.executemany(
+                "INSERT INTO active_positions (ticket, kol_name, symbol, direction, entry_price, volume, exit_conditions, status) "
+                "VALUES (?, ?, 'XAUUSD', '做多', 2000, 0.01, '[]', '监控中')",
+                [(t, f"KOL{t % 10}") for t in range(持仓数)]
+            )
+            cursor.executemany(
+                "INSERT INTO settlements (kol_name, symbol, direction, volume, entry_price, exit_price, profit, close_time) "
+                "VALUES (?, 'XAUUSD', '做多', 0.01, 2000, 2001, ?, '2026-01-01 00:00:00')",
+                [(f"KOL{i % 10}", (i % 7) - 3) for i in range(结算数)]
+            )
+            cursor.executemany(
+                "INSERT INTO command_queue (kol_name, symbol, direction, status, mt5_ticket, state) "
+                "VALUES ('KOL', 'XAUUSD', '买入', '已执行', ?, '持仓')",
+                [(t,) for t in range(持仓数)]
+            )
+        持仓集合 = set(range(持仓数))
+
+        # 模拟统计端的同步循环 (比真实的 3s 频率高得多)：每轮全部持仓价格都在变
+        停止 = threading.Event()
+        同步轮数 = [0]
+        def 同步循环():
+            价格 = 2000.0
+            while not 停止.wait(同步间隔):
+                价格 += 0.01
+                db.批量更新持仓实时数据([(t, 2000, 价格, 价格 - 2000) for t in range(持仓数)])
+                db.更新command_queue_state(0, 持仓集合, set())
+                同步轮数[0] += 1
+
+        API读取 = [db.读取_所有活跃持仓, db.查询_KOL战绩, db.获取已执行的tickets]
+
+        def 旧版读取(函数):
+            # 改造前：读操作也要排队拿全局锁
+            def 包装():
+                with db.数据库_线程锁:
+                    return 函数()
+            return 包装
+
+        for 模式, 读取列表 in (("旧: 读也拿全局锁", [旧版读取(f) for f in API读取]), ("新: 只读连接不拿锁", API读取)):
+            耗时列表 = {f.__name__: [] for f in API读取}
+            同步轮数[0] = 0
+            停止.clear()
+            同步线程 = threading.Thread(target=同步循环, daemon=True)
+            同步线程.start()
+
+            def API线程(序号):
+                截止 = time.perf_counter() + 秒数
+                i = 序号
+                while time.perf_counter() < 截止:
+                    开始 = time.perf_counter()
+                    读取列表[i % len(读取列表)]()
+                    耗时列表[API读取[i % len(API读取)].__name__].append((time.perf_counter() - 开始) * 1000)
+                    i += 1
+
+            线程列表 = [threading.Thread(target=API线程, args=(n,)) for n in range(读线程数)]
+            for t in 线程列表: t.start()
+            for t in 线程列表: t.join()
+            停止.set()
+            同步线程.join()
+            print(f"  {模式} | 同步循环: {同步轮数[0] / 秒数:.0f} 轮/s")
+            for 名称, 样本 in 耗时列表.items():
+                print(f"    {名称:<16} {len(样本) / 秒数:>6.0f} 次/s | p50: {_百分位(样本, 0.5):>7.2f} ms | p99: {_百分位(样本, 0.99):>7.2f} ms")
+
+# ===========================
+# 项目 4: 轮询开销 (每次整表读取 vs 按变更序号缓存)
+# ===========================
+def 基准_轮询开销(持仓数=200, 待执行数=20, 次数=2000):
+    print(f"\n[轮询开销] 持仓 {持仓数} | 待执行命令 {待执行数} | 每种调用 {次数} 次 (表无变化)")
+    with 临时数据库():
+        with db.数据库事务() as cursor:
+            cursor.executemany(
+                "INSERT INTO active_positions (ticket, kol_name, symbol, direction, entry_price, volume, exit_conditions, status) "
+                "VALUES (?, ?, 'XAUUSD', '做多', 2000, 0.01, '[]', '监控中')",
+                [(t, f"KOL{t % 10}") for t in range(持仓数)]
+            )
+            cursor.executemany(
+                "INSERT INTO command_queue (kol_name, symbol, direction, volume, price, sl, tp, status) "
+                "VALUES ('KOL', 'XAUUSD', '买入', 0.01, 0, 0, 0, '待执行')",
+                [()] * 待执行数
+            )
+        for 名称, 函数, 表 in (("读取_所有活跃持仓", db.读取_所有活跃持仓, "active_positions"),
+                               ("读取_待执行命令", db.读取_待执行命令, "command_queue")):
+            缓存 = db.变更缓存(函数, 表)
+            打印对比(名称, 计时(函数, 次数), 计时(缓存.获取, 次数))
+
+        # 别的连接有提交 (只改价格) 时，还要查一次 change_seq
+        缓存 = db.变更缓存(db.读取_所有活跃持仓, "active_positions")
+        价格 = [2000.0]
+        def 有价格变化():
+            价格[0] += 0.01
+            db.批量更新持仓实时数据([(0, 2000, 价格[0], 价格[0] - 2000)])
+        基线 = 计时(有价格变化, 次数 // 4)
+        耗时 = 计时(lambda: (有价格变化(), 缓存.获取()), 次数 // 4) - 基线
+        print(f"  {'其他连接刚提交过':<24} 变更缓存.获取: {耗时:>8.1f} µs/次 (命中 {缓存.命中} / 重读 {缓存.重读})")
+
+# ===========================
+# 项目 5: KOL 战绩榜 (对 settlements 全表 GROUP BY vs kol_stats 汇总表)
+# ===========================
+def 基准_KOL战绩(结算数=200_000, KOL数=20, 次数=50):
+    print(f"\n[KOL战绩] 结算 {结算数} | KOL {KOL数} | 每种调用 {次数} 次")
+    with 临时数据库():
+        with db.数据库事务() as cursor:
+            cursor.executemany(
+                "INSERT INTO settlements (kol_name, symbol, direction, volume, entry_price, exit_price, profit, close_time) "
+                "VALUES (?, 'XAUUSD', '做多', 0.01, 2000, 2001, ?, ?)",
+                [(f"KOL{i % KOL数}", (i % 7) - 3, f"2026-{1 + i % 12:02d}-{1 + i % 28:02d} 00:00:00") for i in range(结算数)]
+            )
+        开始 = time.perf_counter()
+        db.重建_KOL统计()
+        print(f"  重建_KOL统计 耗时: {(time.perf_counter() - 开始) * 1000:.0f} ms")
+
+        def 旧_查询():
+            cursor = db.获取读连接().cursor()
+            cursor.execute("SELECT kol_name, COUNT(*), SUM(CASE WHEN profit > 0 THEN 1 ELSE 0 END), SUM(profit), AVG(profit) "
+                           "FROM settlements GROUP BY kol_name ORDER BY SUM(profit) DESC")
+            return cursor.fetchall()
+        旧结果 = {r[0]: (r[1], r[2], r[3]) for r in 旧_查询()}
+        新结果 = {r["kol_name"]: (r["total_trades"], r["win_count"], r["total_profit"]) for r in db.查询_KOL战绩()}
+        assert 旧结果 == 新结果, "汇总表与全表统计不一致"
+        打印对比("查询_KOL战绩", 计时(旧_查询, 次数) / 1000, 计时(db.查询_KOL战绩, 次数) / 1000, 单位="ms/次")
+        写入耗时 = 计时(lambda: db.归档_结算记录(None, "KOL0", "XAUUSD", "做多", 0.01, 2000, 2001, 1.0), 次数)
+        print(f"  {'归档_结算记录 (含汇总累加)':<22} {写入耗时:>10.1f} µs/次")
+
+# ===========================
+# 项目 6: 行对象 (dict + 立即 json.loads vs __slots__ 记录 + 懒解析)
+# ===========================
+def _旧版_读取_所有活跃持仓():
+    """改造前的实现：每行一个 dict，exit_conditions 立即解析"""
+    cursor = db.获取读连接().cursor()
+    cursor.row_factory = sqlite3.Row
+    cursor.execute("SELECT * FROM active_positions")
+    positions = []
+    for row in cursor.fetchall():
+        pos = dict(row)
+        try:
+            pos['exit_conditions'] = json.loads(pos['exit_conditions'])
+        except:
+            pass
+        positions.append(pos)
+    return positions
+
+def _内存占用(函数):
+    """函数返回结果常驻的内存 (KB) 和调用过程中的峰值 (KB)"""
+    tracemalloc.start()
+    结果 = 函数()
+    常驻, 峰值 = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del 结果
+    return 常驻 / 1024, 峰值 / 1024
+
+def 基准_行对象(持仓数=2000, 次数=200):
+    print(f"\n[行对象] 持仓 {持仓数} 行 | 每种调用 {次数} 次")
+    with 临时数据库():
+        退出条件 = json.dumps([{"类型": "止盈", "价格": 2010.5}, {"类型": "止损", "价格": 1990.5}], ensure_ascii=False)
+        with db.数据库事务() as cursor:
+            cursor.executemany(
+                "INSERT INTO active_positions (ticket, signal_id, kol_name, symbol, direction, entry_price, volume, tp_goal, exit_conditions, status) "
+                "VALUES (?, ?, ?, 'XAUUSD', '做多', 2000, 0.01, 2010, ?, '监控中')",
+                [(t, t, f"KOL{t % 10}", 退出条件) for t in range(持仓数)]
+            )
+        def 新_读取并访问JSON():
+            return [p["exit_conditions"] for p in db.读取_所有活跃持仓()]
+
+        旧耗时 = 计时(_旧版_读取_所有活跃持仓, 次数) / 1000
+        打印对比("读取 (不访问JSON)", 旧耗时, 计时(db.读取_所有活跃持仓, 次数) / 1000, 单位="ms/次")
+        打印对比("读取 + 访问全部JSON", 旧耗时, 计时(新_读取并访问JSON, 次数) / 1000, 单位="ms/次")
+        旧常驻, 旧峰值 = _内存占用(_旧版_读取_所有活跃持仓)
+        新常驻, 新峰值 = _内存占用(db.读取_所有活跃持仓)
+        打印对比("结果常驻内存", 旧常驻, 新常驻, 单位="KB   ")
+        打印对比("调用峰值内存", 旧峰值, 新峰值, 单位="KB   ")
+
+# ===========================
+# 项目 7: 聊天上下文 (每条消息查库 vs 写穿内存缓存)
+# ===========================
+def _旧版_读取_最近聊天记录(kol_name, limit=2):
+    if db.后台写入.有待写入("chat_history"):
+        db.后台写入.刷新()
+    cursor = db.获取读连接().cursor()
+    cursor.execute("SELECT user_content, ai_response FROM chat_history WHERE kol_name = ? ORDER BY id DESC LIMIT ?", (kol_name, limit))
+    return list(reversed(cursor.fetchall()))
+
+def 基准_聊天上下文(历史条数=50_000, KOL数=20, 次数=500):
+    print(f"\n[聊天上下文] chat_history {历史条数} 行 | {KOL数} 个KOL | 每种 {次数} 条消息 (读上下文 + 写本轮)")
+    with 临时数据库():
+        with db.数据库事务() as cursor:
+            cursor.executemany(
+                "INSERT INTO chat_history (kol_name, user_content, ai_response, is_signal) VALUES (?, ?, ?, 0)",
+                [(f"KOL{i % KOL数}", f"消息{i}", f"回复{i}") for i in range(历史条数)]
+            )
+        db.聊天缓存 = db.聊天上下文缓存()
+        db.预热_聊天缓存()
+        计数 = [0]
+
+        def 一条消息(读取):
+            def 处理():
+                计数[0] += 1
+                kol = f"KOL{计数[0] % KOL数}"
+                读取(kol)
+                db.写入_聊天记录(kol, "新消息", "新回复", False)
+            return 处理
+
+        旧耗时 = 计时(一条消息(_旧版_读取_最近聊天记录), 次数)
+        新耗时 = 计时(一条消息(db.读取_最近聊天记录), 次数)
+        打印对比("每条消息的上下文读取+写入", 旧耗时, 新耗时)
+        print(f"    缓存指标: {db.聊天缓存.指标()}")
+
+# ===========================
+# 项目 8: 多进程争用 (决策端 / 执行端 / 统计端 各自一个进程，同时读写一个库)
+# ===========================
+# 和生产一样每个角色是独立进程 (spawn)，各自的写连接靠 SQLite 文件锁互斥。
+# 每次调用 数据库工具 函数都计时；数据库工具 的函数会吞掉异常只打日志，所以把子进程里的
+# 带时间的日志打印 换成计数器，统计 "写锁被占用" 重试和最终失败的 'database is locked'。
+def _模拟决策端(调用, 编号, 截止, 间隔):
+    n = 0
+    while time.perf_counter() < 截止:
+        kol = f"KOL{编号}_{n % 5}"
+        调用(db.读取_最近聊天记录, kol)
+        调用(db.写入_信号及子命令, kol, "XAUUSD", "做多", "市价", 0, {"止损": 1990},
+            [("买入", 0.01, 0, 1990, 2010), ("买入", 0.01, 0, 1990, 2020)])
+        调用(db.写入_聊天记录, kol, "消息", "回复", True)
+        调用(db.查询_KOL活跃Ticket, kol)
+        n += 1
+        time.sleep(间隔)
+
+def _模拟执行端(调用, 编号, 截止, 间隔, 最多持仓=50):
+    标识 = f"基准执行端-{编号}"
+    ticket = 编号 * 10_000_000
+    while time.perf_counter() < 截止:
+        if 调用(db.有可领取命令):
+            for 命令 in 调用(db.领取_待执行命令, 标识) or []:
+                ticket += 1
+                调用(db.标记_命令已执行, 命令["id"], ticket, 标识)
+                调用(db.写入_持仓记录, ticket, 命令["signal_id"], 命令["kol_name"], "XAUUSD", "做多", 2000, 0.01, 2010, [])
+                调用(db.写入_执行日志, "开仓", f"Ticket:{ticket}")
+        # 只平自己开的单，持仓超过 最多持仓 就平掉最早的
+        自己的 = [p for p in 调用(db.读取_所有活跃持仓) or [] if p.ticket // 10_000_000 == 编号]
+        for p in 自己的[:max(0, len(自己的) - 最多持仓)]:
+            调用(db.移除_持仓记录, p.ticket)
+            调用(db.归档_结算记录, p.signal_id, p.kol_name, "XAUUSD", "做多", 0.01, 2000, 2001, 1.0)
+        time.sleep(间隔)
+
+def _模拟统计端(调用, 编号, 截止, 间隔):
+    价格 = 2000.0
+    while time.perf_counter() < 截止:
+        持仓 = 调用(db.读取_所有活跃持仓) or []
+        价格 += 0.01
+        调用(db.批量更新持仓实时数据, [(p.ticket, 2000, 价格, 价格 - 2000) for p in 持仓])
+        调用(db.更新command_queue_state, 0, {p.ticket for p in 持仓}, set())
+        调用(db.获取等待中的信号)
+        调用(db.获取已执行的tickets)
+        调用(db.查询_KOL战绩)
+        time.sleep(间隔)
+
+_争用角色 = {"决策端": _模拟决策端, "执行端": _模拟执行端, "统计端": _模拟统计端}
+
+def _是锁错误(信息):
+    return "locked" in 信息 or "busy" in 信息
+
+def _争用进程(角色, 编号, 路径, 秒数, 间隔, 起跑, 结果队列):
+    """子进程入口 (spawn 会重新 import 本模块，数据库路径要在这里设)"""
+    db.数据库文件 = 路径
+    计数 = {"锁重试": 0, "锁错误": 0}
+
+    def 记录日志(msg):
+        msg = str(msg)
+        if _是锁错误(msg):
+            计数["锁重试" if "重试" in msg else "锁错误"] += 1
+    db.带时间的日志打印 = 记录日志
+
+    耗时 = collections.defaultdict(list)
+    def 调用(函数, *参数):
+        开始 = time.perf_counter()
+        try:
+            return 函数(*参数)
+        except sqlite3.OperationalError as e:
+            if not _是锁错误(str(e)):
+                raise
+            计数["锁错误"] += 1
+        finally:
+            耗时[函数.__qualname__].append((time.perf_counter() - 开始) * 1000)
+
+    起跑.wait()
+    _争用角色[角色](调用, 编号, time.perf_counter() + 秒数, 间隔)
+    调用(db.后台写入.刷新)  # 队列里的日志/聊天也算进争用
+    db.关闭连接()
+    结果队列.put({"角色": 角色, "编号": 编号, "耗时": dict(耗时), **计数})
+
+def 基准_多进程争用(决策端数=2, 执行端数=2, 统计端数=1, 秒数=5, 决策端间隔=0.01, 执行端间隔=0.01, 统计端间隔=0.05):
+    进程配置 = ([("决策端", i + 1, 决策端间隔) for i in range(决策端数)] +
+              [("执行端", i + 1, 执行端间隔) for i in range(执行端数)] +
+              [("统计端", i + 1, 统计端间隔) for i in range(统计端数)])
+    print(f"\n[多进程争用] 决策端 {决策端数} | 执行端 {执行端数} | 统计端 {统计端数} 个进程 | {秒数}s "
+          f"(间隔 {决策端间隔}/{执行端间隔}/{统计端间隔}s，远高于生产频率)")
+    with 临时数据库() as 路径:
+        db.关闭连接()  # 父进程只负责建库和汇总，不占连接
+        上下文 = multiprocessing.get_context("spawn")
+        起跑 = 上下文.Barrier(len(进程配置) + 1)
+        结果队列 = 上下文.Queue()
+        进程列表 = [上下文.Process(target=_争用进程, args=(角色, 编号, 路径, 秒数, 间隔, 起跑, 结果队列))
+                  for 角色, 编号, 间隔 in 进程配置]
+        for p in 进程列表:
+            p.start()
+        起跑.wait(timeout=60)  # 所有子进程 import 完一起开跑
+        结果列表 = [结果队列.get(timeout=秒数 + 120) for _ in 进程列表]
+        for p in 进程列表:
+            p.join()
+
+        cursor = db.获取读连接().cursor()
+        产出 = {
+            "信号": cursor.execute("SELECT COUNT(*) FROM shadow_signals").fetchone()[0],
+            "已执行命令": cursor.execute("SELECT COUNT(*) FROM command_queue WHERE status='已执行'").fetchone()[0],
+            "结算": cursor.execute("SELECT COUNT(*) FROM settlements").fetchone()[0],
+            "执行日志": cursor.execute("SELECT COUNT(*) FROM execution_logs").fetchone()[0],
+            "聊天记录": cursor.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0],
+        }
+
+    按函数 = collections.defaultdict(list)
+    for 结果 in 结果列表:
+        for 名称, 样本 in 结果["耗时"].items():
+            按函数[名称].extend(样本)
+    函数统计 = {
+        名称: {"次数": len(样本), "吞吐_次每秒": round(len(样本) / 秒数, 1),
+             "p50_ms": round(_百分位(样本, 0.5), 3), "p99_ms": round(_百分位(样本, 0.99), 3), "最大_ms": round(max(样本), 3)}
+        for 名称, 样本 in sorted(按函数.items())
+    }
+    进程统计 = [{"进程": f"{r['角色']}#{r['编号']}", "调用次数": sum(map(len, r["耗时"].values())),
+              "锁重试": r["锁重试"], "锁错误": r["锁错误"]} for r in 结果列表]
+
+    print(f"  产出 ({秒数}s): " + " | ".join(f"{k} {v} ({v / 秒数:.0f}/s)" for k, v in 产出.items()))
+    for 名称, 统计 in 函数统计.items():
+        print(f"    {名称:<20} {统计['吞吐_次每秒']:>8.0f} 次/s | p50: {统计['p50_ms']:>7.2f} ms | p99: {统计['p99_ms']:>7.2f} ms | 最大: {统计['最大_ms']:>7.1f} ms")
+    for 统计 in 进程统计:
+        print(f"    {统计['进程']:<8} 调用 {统计['调用次数']:>7} | 写锁重试 {统计['锁重试']:>4} | database is locked {统计['锁错误']:>4}")
+
+    return {
+        "环境": {"时间": datetime.datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+               "sqlite": sqlite3.sqlite_version, "表结构版本": db.最新版本, "索引集版本": db.索引集版本},
+        "参数": {"决策端数": 决策端数, "执行端数": 执行端数, "统计端数": 统计端数, "秒数": 秒数,
+               "间隔": {"决策端": 决策端间隔, "执行端": 执行端间隔, "统计端": 统计端间隔}},
+        "产出": 产出,
+        "函数": 函数统计,
+        "进程": 进程统计,
+        "锁错误合计": sum(r["锁错误"] for r in 结果列表),
+        "锁重试合计": sum(r["锁重试"] for r in 结果列表),
+    }
+
+# ===========================
+# 项目 9: 数据规模 (同一批查询在 1 万 / 10 万 / 100 万条结算下的耗时)
+# ===========================
+def _规模查询(最近):
+    """[(来源, 名称, 调用)]：仪表盘.py / 统计端.py 一 import 就启动服务，它们的 SQL 照抄在这里；数据库工具 的读函数直接调用。
+    时间窗相对数据里最新的时间 最近 取"""
+    七天前, 三十天前 = 最近 - 7 * 86_400_000, 最近 - 30 * 86_400_000
+
+    def 执行(sql, 参数=()):
+        cursor = db.获取读连接().cursor()
+        cursor.execute(sql, 参数)
+        return cursor.fetchall()
+
+    def 统计摘要():
+        return (执行("SELECT SUM(total_profit), SUM(total_trades), SUM(win_count) FROM kol_stats"),
+                执行("SELECT COUNT(*), SUM(unrealized_pnl) FROM active_positions"))
+
+    挂单SQL = """
+        SELECT
+            c.id, datetime(c.created_ms / 1000, 'unixepoch', 'localtime') AS created_at, c.kol_name, c.symbol,
+            c.direction, c.volume, c.price, c.sl, c.tp, c.mt5_ticket, c.state
+        FROM command_queue c
+        WHERE c.status = '已执行' AND c.state = '挂单'
+        ORDER BY c.created_ms DESC
+    """
+    return [
+        ("仪表盘", "结算全表 (首次加载)", lambda: db.读取_新增行("settlements", 0)),
+        ("仪表盘", "结算近7天", lambda: db.查询_结算区间(七天前)),
+        ("仪表盘", "持仓全表", lambda: 执行("SELECT * FROM active_positions")),
+        ("仪表盘", "KOL战绩", db.查询_KOL战绩),
+        ("仪表盘", "止盈止损习惯 (近30天)", lambda: db.查询_KOL止盈止损统计(三十天前)),
+        ("仪表盘", "挂单列表", lambda: 执行(挂单SQL)),
+        ("仪表盘", "变更序号", db.读取_变更序号),
+        ("统计端", "/stats/summary", 统计摘要),
+        ("统计端", "/stats/positions", db.读取_所有活跃持仓),
+        ("统计端", "/stats/kol/daily", lambda: db.查询_KOL每日战绩("KOL00")),
+        ("统计端", "/stats/history", lambda: db.读取_最近结算(50)),
+        ("统计端", "/stats/history?start&kol", lambda: db.查询_结算区间(七天前, None, "KOL00")),
+        ("统计端", "/stats/signals?start", lambda: db.查询_信号止盈止损(七天前, limit=200)),
+        ("统计端", "/stats/signals/tpsl", db.查询_KOL止盈止损统计),
+        ("统计端", "/stats/positions/risk", db.查询_持仓止损风险),
+        ("统计端", "/metrics", db.获取库维护指标),
+        ("统计端", "监控: 获取等待中的信号", db.获取等待中的信号),
+        ("统计端", "监控: 获取已执行的tickets", db.获取已执行的tickets),
+        ("数据库工具", "读取_待执行命令", db.读取_待执行命令),
+        ("数据库工具", "有可领取命令", db.有可领取命令),
+        ("数据库工具", "查询_KOL活跃Ticket", lambda: db.查询_KOL活跃Ticket("KOL00")),
+        ("数据库工具", "查询_KOL挂单", lambda: db.查询_KOL挂单("KOL00")),
+        ("数据库工具", "检查command_queue中是否存在", lambda: db.检查command_queue中是否存在(10_000_001)),
+        ("数据库工具", "聊天记录回库装载", lambda: db.聊天上下文缓存()._从库装载("KOL00")),
+        ("数据库工具", "预热_聊天缓存", lambda: db.聊天上下文缓存().预热()),
+        ("数据库工具", "查询_信号区间 (近7天)", lambda: db.查询_信号区间(七天前)),
+    ]
+
+def _测时(调用, 最少秒数=0.2, 最多次数=20):
+    """预热一次后重复调用，返回中位耗时 (ms)；单次超过 1s 的只测一次"""
+    开始 = time.perf_counter()
+    调用()
+    样本 = [(time.perf_counter() - 开始) * 1000]
+    if 样本[0] > 1000:
+        return 样本[0]
+    样本 = []
+    总计 = 0.0
+    while len(样本) < 3 or (总计 < 最少秒数 * 1000 and len(样本) < 最多次数):
+        开始 = time.perf_counter()
+        调用()
+        样本.append((time.perf_counter() - 开始) * 1000)
+        总计 += 样本[-1]
+    return _百分位(样本, 0.5)
+
+def _增长类型(指数):
+    if 指数 < 0.2:
+        return "常数"
+    if 指数 < 0.8:
+        return "亚线性"
+    if 指数 < 1.2:
+        return "线性"
+    return "超线性"
+
+def 基准_数据规模(规模列表=(10_000, 100_000, 1_000_000), 聊天倍数=1):
+    print(f"\n[数据规模] 结算 {' / '.join(f'{n:,}' for n in 规模列表)} 条 (聊天记录 ×{聊天倍数})，每条查询取中位耗时")
+    耗时 = collections.defaultdict(dict)
+    行数 = {}
+    for 规模 in 规模列表:
+        with 临时数据库() as 路径:
+            开始 = time.perf_counter()
+            行数[规模] = 生成测试数据.生成(结算数=规模, 聊天倍数=聊天倍数)
+            生成秒数 = time.perf_counter() - 开始
+            最近 = db.获取读连接().execute("SELECT MAX(close_ms) FROM settlements").fetchone()[0]
+            print(f"  规模 {规模:>9,}: 生成 {生成秒数:.1f}s，库 {os.path.getsize(路径) / 1e6:.0f} MB | {行数[规模]}")
+            for 来源, 名称, 调用 in _规模查询(最近):
+                耗时[(来源, 名称)][规模] = _测时(调用)
+
+    首, 末 = 规模列表[0], 规模列表[-1]
+    查询统计 = []
+    print(f"  {'来源':<6} {'查询':<28}" + "".join(f"{f'{n:,}':>12}" for n in 规模列表) + "   增长")
+    for (来源, 名称), 各规模 in 耗时.items():
+        # 双对数斜率: 行数 ×10 时耗时 ×10^指数；太快的查询噪声大，按 0.01ms 下限算
+        指数 = math.log(max(各规模[末], 0.01) / max(各规模[首], 0.01)) / math.log(末 / 首) if 末 > 首 else 0.0
+        查询统计.append({"来源": 来源, "查询": 名称, "耗时_ms": {str(n): round(各规模[n], 3) for n in 规模列表},
+                      "增长指数": round(指数, 2), "增长": _增长类型(指数)})
+        print(f"  {来源:<6} {名称:<28}" + "".join(f"{各规模[n]:>10.2f}ms" for n in 规模列表) + f"   {_增长类型(指数)} ({指数:.2f})")
+    return {
+        "环境": {"时间": datetime.datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+               "sqlite": sqlite3.sqlite_version, "表结构版本": db.最新版本, "索引集版本": db.索引集版本},
+        "参数": {"规模": list(规模列表), "聊天倍数": 聊天倍数},
+        "行数": {str(n): 行数[n] for n in 规模列表},
+        "查询": 查询统计,
+    }
+
+# ===========================
+# 项目 10: 图片压缩 (入库规范化前后，发给 AI 的字节数和请求构造 / 上传耗时)
+# ===========================
+def _图表截图(宽, 高, 种子, 噪点=0):
+    """画一张 K 线截图当夹具：深色背景、网格、蜡烛、价格文字；噪点 > 0 模拟手机拍屏"""
+    import random
+    from PIL import Image, ImageDraw
+    随机 = random.Random(种子)
+    最终尺寸, 宽, 高 = (宽, 高), 宽 * 2, 高 * 2  # 两倍大小画完再缩回来，线条和文字带抗锯齿，接近真实截图
+    图 = Image.new("RGB", (宽, 高), (19, 23, 34))
+    画 = ImageDraw.Draw(图)
+    for x in range(0, 宽, 宽 // 12):
+        画.line([(x, 0), (x, 高)], fill=(42, 46, 57))
+    for y in range(0, 高, 高 // 8):
+        画.line([(0, y), (宽, y)], fill=(42, 46, 57))
+        画.text((宽 - 180, y + 8), f"{2650 + 随机.random() * 40:.2f}", fill=(180, 180, 180), font_size=28)
+    价格, 蜡烛宽 = 高 / 2, max(4, 宽 // 160)
+    for x in range(蜡烛宽, 宽 - 100, 蜡烛宽 * 2):
+        开, 收 = 价格, 价格 + 随机.gauss(0, 高 / 60)
+        高点, 低点 = min(开, 收) - 随机.random() * 高 / 80, max(开, 收) + 随机.random() * 高 / 80
+        颜色 = (38, 166, 154) if 收 < 开 else (239, 83, 80)
+        画.line([(x + 蜡烛宽 // 2, 高点), (x + 蜡烛宽 // 2, 低点)], fill=颜色)
+        画.rectangle([x, min(开, 收), x + 蜡烛宽, max(开, 收) + 1], fill=颜色)
+        价格 = min(max(收, 高 * 0.1), 高 * 0.9)
+    图 = 图.resize(最终尺寸, Image.LANCZOS)
+    宽, 高 = 最终尺寸
+    if 噪点:
+        噪声 = Image.merge("RGB", [Image.effect_noise((宽, 高), 噪点) for _ in range(3)])
+        图 = Image.blend(图, 噪声, 0.15)
+    return 图
+
+def _图片夹具():
+    """[(名称, 原始字节)]：覆盖 Telegram 里常见的几种图"""
+    import io
+    from PIL import Image
+    夹具 = []
+    for 名称, 宽, 高, 格式, 选项 in [
+        ("TG 照片 1280 JPEG q87", 1280, 720, "JPEG", {"quality": 87}),
+        ("TG 照片 2560 JPEG q87", 2560, 1440, "JPEG", {"quality": 87}),
+        ("电脑截图 2560 PNG (文件)", 2560, 1440, "PNG", {}),
+        ("手机截图 1170x2532 PNG", 1170, 2532, "PNG", {}),
+    ]:
+        缓冲 = io.BytesIO()
+        _图表截图(宽, 高, len(夹具)).save(缓冲, 格式, **选项)
+        夹具.append((名称, 缓冲.getvalue()))
+    # 手机拍屏：有噪点、带 EXIF (方向 + 机型)
+    缓冲 = io.BytesIO()
+    exif = Image.Exif()
+    exif[0x0112], exif[0x0110] = 1, "Phone Camera"
+    _图表截图(4032, 3024, 99, 噪点=40).save(缓冲, "JPEG", quality=95, exif=exif.tobytes())
+    夹具.append(("拍屏照片 4032 JPEG q95+EXIF", 缓冲.getvalue()))
+    return 夹具
+
+def 基准_图片压缩(图片目录=None, 上行Mbps=10, 次数=5):
+    import base64
+    import 图片处理
+    if not 图片处理.可用():
+        print("\n[图片压缩] 跳过: 没装 Pillow (pip install pillow)")
+        return None
+    配置 = 图片处理.读取_图片配置()
+    if 图片目录:
+        夹具 = []
+        for 文件 in sorted(os.listdir(图片目录)):
+            if os.path.splitext(文件)[1].lower() in 图片处理.可处理扩展名:
+                with open(os.path.join(图片目录, 文件), "rb") as f:
+                    夹具.append((文件, f.read()))
+    else:
+        夹具 = _图片夹具()
+    print(f"\n[图片压缩] {len(夹具)} 张图，最大边长 {配置['最大边长']} / {配置['格式']} q{配置['质量']}，上传按 {上行Mbps} Mbps 估算")
+
+    def 请求体(数据):
+        # AI分析.分析信号 里每张图就是 base64 塞进 JSON
+        return json.dumps({"messages": [{"role": "user", "content": [
+            {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64," + base64.b64encode(数据).decode()}}]}]})
+
+    def 上传ms(字节数):
+        return 字节数 * 8 / (上行Mbps * 1e6) * 1000
+
+    明细 = []
+    print(f"  {'图片':<28} {'原始KB':>8} {'压缩后KB':>9} {'比例':>6} {'规范化':>9} {'构造请求 旧/新':>16} {'上传 旧/新':>16}")
+    for 名称, 原始 in 夹具:
+        压缩后, _ = 图片处理.压缩(原始, 配置["最大边长"], 配置["格式"], 配置["质量"])
+        规范化ms = 计时(lambda: 图片处理.压缩(原始, 配置["最大边长"], 配置["格式"], 配置["质量"]), 次数) / 1000
+        旧请求, 新请求 = 请求体(原始), 请求体(压缩后)
+        旧构造ms, 新构造ms = 计时(lambda: 请求体(原始), 次数) / 1000, 计时(lambda: 请求体(压缩后), 次数) / 1000
+        明细.append({"图片": 名称, "原始字节": len(原始), "压缩后字节": len(压缩后), "请求字节_旧": len(旧请求),
+                   "请求字节_新": len(新请求), "规范化_ms": round(规范化ms, 2), "构造请求_ms_旧": round(旧构造ms, 2),
+                   "构造请求_ms_新": round(新构造ms, 2), "上传_ms_旧": round(上传ms(len(旧请求)), 1),
+                   "上传_ms_新": round(上传ms(len(新请求)), 1)})
+        print(f"  {名称:<28} {len(原始) / 1024:>8.0f} {len(压缩后) / 1024:>9.0f} {len(压缩后) / len(原始):>6.0%} "
+              f"{规范化ms:>7.1f}ms {旧构造ms:>7.1f}/{新构造ms:<6.1f}ms {上传ms(len(旧请求)):>7.0f}/{上传ms(len(新请求)):<6.0f}ms")
+    旧字节, 新字节 = sum(r["请求字节_旧"] for r in 明细), sum(r["请求字节_新"] for r in 明细)
+    节省ms = sum(r["上传_ms_旧"] + r["构造请求_ms_旧"] - r["上传_ms_新"] - r["构造请求_ms_新"] for r in 明细)
+    print(f"  合计请求体 {旧字节 / 1e6:.2f} MB -> {新字节 / 1e6:.2f} MB (省 {1 - 新字节 / 旧字节:.0%})，"
+          f"每张平均少等 {节省ms / len(明细):.0f} ms (规范化在入库时做，平均 {sum(r['规范化_ms'] for r in 明细) / len(明细):.0f} ms，不在 AI 请求路径上)")
+    return {
+        "环境": {"时间": datetime.datetime.now().isoformat(timespec="seconds"), "python": platform.python_version()},
+        "参数": {**{k: v for k, v in 配置.items() if not k.startswith("__")}, "上行Mbps": 上行Mbps, "图片目录": 图片目录},
+        "图片": 明细,
+    }
+
+# ===========================
+# 入口
+# ===========================
+基准项目 = {
+    "连接开销": 基准_连接开销,
+    "状态同步": 基准_状态同步,
+    "读写并发": 基准_读写并发,
+    "轮询开销": 基准_轮询开销,
+    "KOL战绩": 基准_KOL战绩,
+    "行对象": 基准_行对象,
+    "聊天上下文": 基准_聊天上下文,
+    "多进程争用": 基准_多进程争用,
+    "数据规模": 基准_数据规模,
+    "图片压缩": 基准_图片压缩,
+}
+
+def main():
+    参数 = sys.argv[1:]
+    输出文件 = None
+    if "--json" in 参数:
+        位置 = 参数.index("--json")
+        输出文件 = 参数[位置 + 1]
+        del 参数[位置:位置 + 2]
+    项目参数 = {}
+    if "--规模" in 参数:
+        位置 = 参数.index("--规模")
+        项目参数["数据规模"] = {"规模列表": tuple(int(n) for n in 参数[位置 + 1].split(","))}
+        del 参数[位置:位置 + 2]
+    if "--图片目录" in 参数:
+        位置 = 参数.index("--图片目录")
+        项目参数["图片压缩"] = {"图片目录": 参数[位置 + 1]}
+        del 参数[位置:位置 + 2]
+    选中 = 参数 or list(基准项目)
+    结构化结果 = {}
+    for 名称 in 选中:
+        if 名称 not in 基准项目:
+            print(f"❌ 未知项目: {名称} (可选: {', '.join(基准项目)})")
+            continue
+        结果 = 基准项目[名称](**项目参数.get(名称, {}))
+        if 结果 is not None:
+            结构化结果[名称] = 结果
+    if 输出文件 and 结构化结果:
+        with open(输出文件, "w", encoding="utf-8") as f:
+            json.dump(结构化结果, f, ensure_ascii=False, indent=2)
+        print(f"\n📄 结果已写入 {输出文件}")
+
+if __name__ == "__main__":
+    main()
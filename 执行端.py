@@ -28,6 +28,10 @@ class 执行指挥官:
             print("❌ 无法启动执行端，请检查 MT5 设置")
             exit()
         self.正在运行 = True
+        # 命令按租约领取，可以同时开多个执行端进程一起消费 command_queue
+        self.执行端标识 = db.生成_执行端标识()
+        # 每秒轮询只看变更序号，表没变就复用上次读到的结果
+        self.持仓缓存 = db.变更缓存(db.读取_所有活跃持仓, "active_positions")
 
     def 核心循环(self):
         打印器.执行_启动完成()
@@ -55,14 +59,15 @@ class 执行指挥官:
     # 模块 A: 执行下单
     # ==========================================
     def 处理_待执行命令(self):
-        # 1. 从数据库读取
+        # 1. 先只读检查，没有命令就不抢写锁
         try:
-            待办列表 = db.读取_待执行命令()
+            if not db.有可领取命令():
+                return
         except Exception as e:
             db.带时间的日志打印(f"⚠️ 读取命令队列失败 (可能数据库繁忙): {e}")
             return
         
-        for 任务 in 待办列表:
+        for 任务 in self.逐条领取():
             try:
                 命令ID = 任务['id']
                 SignalID = 任务['signal_id']
@@ -77,15 +82,30 @@ class 执行指挥官:
                 # === [新增] 平仓/清仓逻辑 (优先处理，跳过报价检查) ===
                 if 方向 == "平仓":
                     self.执行_清仓操作(KOL, 品种)
-                    db.标记_命令已执行(命令ID, 0)
+                    db.标记_命令已执行(命令ID, 0, self.执行端标识)
                     continue
 
                 # === [新增] 止盈/保本逻辑 ===
                 if 方向 == "止盈":
                     self.执行_止盈后续操作(KOL, 品种)
-                    db.标记_命令已执行(命令ID, 0)
+                    db.标记_命令已执行(命令ID, 0, self.执行端标识)
                     continue
 
+                # 租约过期重领的：上一个执行端可能已经下过单，先按备注去 MT5 查，查到就不再下
+                备注 = f"Sig_{SignalID}_{命令ID}"
+                if 任务['attempts'] > 1:
+                    try:
+                        已下Ticket = self.MT5.查找备注订单(备注)
+                    except Exception as e:
+                        db.带时间的日志打印(f"⚠️ [执行端] 重领命令 {命令ID} 查 MT5 失败，暂缓执行: {e}")
+                        db.释放_命令(命令ID, self.执行端标识)
+                        continue
+                    if 已下Ticket:
+                        db.带时间的日志打印(f"♻️ [执行端] 命令 {命令ID} 上次已下单 (Ticket:{已下Ticket})，不重复下单")
+                        if db.标记_命令已执行(命令ID, 已下Ticket, self.执行端标识):
+                            self.登记持仓(已下Ticket, 任务, 方向, 价格, 止损, 止盈)
+                        continue
+
                 # ===========================
                 # [新增] 价格与止损预检查 (防止 10015 Invalid Price)
                 # ===========================
@@ -93,6 +113,7 @@ class 执行指挥官:
                 
                 if bid is None or ask is None:
                     db.带时间的日志打印(f"⚠️ [执行端] 无法获取 {品种} 报价，暂缓执行 (等待行情)")
+                    db.释放_命令(命令ID, self.执行端标识)
                     continue
 
                 # [新增] 打印当前状态，不做无头苍蝇
@@ -106,12 +127,12 @@ class 执行指挥官:
                         if "买" in 方向 and bid < 止损:
                             错误信息 = f"🛑 策略失效: 现价({bid}) 已跌破止损({止损})，放弃做多"
                             打印器.执行_下单失败(品种, 手数, 错误信息)
-                            db.标记_命令失败(命令ID, 错误信息)
+                            db.标记_命令失败(命令ID, 错误信息, self.执行端标识)
                             continue
                         elif "卖" in 方向 and ask > 止损:
                             错误信息 = f"🛑 策略失效: 现价({ask}) 已涨破止损({止损})，放弃做空"
                             打印器.执行_下单失败(品种, 手数, 错误信息)
-                            db.标记_命令失败(命令ID, 错误信息)
+                            db.标记_命令失败(命令ID, 错误信息, self.执行端标识)
                             continue
 
                     # --- 优化逻辑: 现价更优且SL合法时，转为市价 ---
@@ -161,15 +182,20 @@ class 执行指挥官:
                             if 止损 >= 基准价:
                                 错误信息 = f"预判拦截: 做多SL({止损}) >= 开仓价({基准价})"
                                 打印器.执行_下单失败(品种, 手数, 错误信息)
-                                db.标记_命令失败(命令ID, 错误信息)
+                                db.标记_命令失败(命令ID, 错误信息, self.执行端标识)
                                 continue
                         elif "卖" in 方向: # 做空: SL 必须 > 价格
                             if 止损 <= 基准价:
                                 错误信息 = f"预判拦截: 做空SL({止损}) <= 开仓价({基准价})"
                                 打印器.执行_下单失败(品种, 手数, 错误信息)
-                                db.标记_命令失败(命令ID, 错误信息)
+                                db.标记_命令失败(命令ID, 错误信息, self.执行端标识)
                                 continue
 
+                # 下单前确认租约还在 (并续上)，过期被别人领走了就交给对方
+                if not db.续租_命令(命令ID, self.执行端标识):
+                    db.带时间的日志打印(f"⚠️ [执行端] 命令 {命令ID} 租约已失效，放弃执行")
+                    continue
+
                 打印器.执行_收到任务(KOL, 品种, 方向, 手数, 价格, 止损, 止盈)
                 # db.带时间的日志打印(f"🔫 [执行] 收到任务: {品种} {方向} {手数}手 (TP:{止盈})")
 
@@ -181,7 +207,7 @@ class 执行指挥官:
                     挂单价格=价格, 
                     止损=止损, 
                     止盈=止盈, 
-                    备注=f"Sig_{SignalID}"
+                    备注=备注
                 )
                 
                 # 3. 处理结果
@@ -191,36 +217,52 @@ class 执行指挥官:
                     # 这里简化处理，直接用入参
                     打印器.执行_下单成功(品种, Ticket, 手数, 价格, 止损, 止盈)
 
-                    # A. 标记命令完成
-                    db.标记_命令已执行(命令ID, Ticket)
+                    # A. 标记命令完成 (租约在下单途中丢了的话，重领的执行端会按备注查到这张单并登记)
+                    if not db.标记_命令已执行(命令ID, Ticket, self.执行端标识):
+                        db.带时间的日志打印(f"⚠️ [执行端] 命令 {命令ID} 已下单但租约已被重领，持仓交给重领方登记")
+                        continue
                     
                     # B. 记录到持仓表
-                    退出描述 = [{"类型": "止盈", "价格": 止盈}, {"类型": "止损", "价格": 止损}]
-                    db.写入_持仓记录(
-                        ticket=Ticket,
-                        signal_id=SignalID,
-                        kol_name=KOL,
-                        symbol=品种,
-                        direction=方向,
-                        entry_price=价格 if "限价" in 方向 else 0,
-                        volume=手数,
-                        tp_goal=止盈,
-                        exit_conditions=退出描述,
-                        status="监控中"
-                    )
+                    self.登记持仓(Ticket, 任务, 方向, 价格, 止损, 止盈)
                 else:
                     # === 🔥 [修改点] 失败处理逻辑 🔥 ===
                     错误信息 = str(结果)
                     打印器.执行_下单失败(品种, 手数, 错误信息)
                     db.带时间的日志打印(f"⚠️ 下单失败: {错误信息} -> 🛑 已丢弃该任务，不再重试")
                     # 调用数据库工具，把状态改成 '失败'，这样下一轮循环就不会再读到它了
-                    db.标记_命令失败(命令ID, 错误信息)
+                    db.标记_命令失败(命令ID, 错误信息, self.执行端标识)
 
             except Exception as inner_e:
                 db.带时间的日志打印(f"❌ [执行端-单任务异常] {inner_e}")
                 db.带时间的日志打印(traceback.format_exc())
                 # 如果是代码报错，也标记为失败，防止卡死
-                db.标记_命令失败(任务['id'], f"程序异常: {str(inner_e)}")
+                db.标记_命令失败(任务['id'], f"程序异常: {str(inner_e)}", self.执行端标识)
+
+    def 逐条领取(self, 每轮上限=10):
+        """一次只领一条，处理完再领下一条：租约只要覆盖一条命令的下单耗时。
+        只往 id 大的方向领，本轮放回去的命令 (如没有报价) 不会马上又被领回来、挡住后面别的品种"""
+        上一个ID = None
+        for _ in range(每轮上限):
+            批 = db.领取_待执行命令(self.执行端标识, 数量=1, 起始ID=上一个ID)
+            if not 批:
+                return
+            上一个ID = 批[0]['id']
+            yield 批[0]
+
+    def 登记持仓(self, Ticket, 任务, 方向, 价格, 止损, 止盈):
+        退出描述 = [{"类型": "止盈", "价格": 止盈}, {"类型": "止损", "价格": 止损}]
+        db.写入_持仓记录(
+            ticket=Ticket,
+            signal_id=任务['signal_id'],
+            kol_name=任务['kol_name'],
+            symbol=任务['symbol'],
+            direction=方向,
+            entry_price=价格 if "限价" in 方向 else 0,
+            volume=任务['volume'],
+            tp_goal=止盈,
+            exit_conditions=退出描述,
+            status="监控中"
+        )
 
     # ==========================================
     # 模块 B: 状态同步与保本逻辑
@@ -228,7 +270,7 @@ class 执行指挥官:
     def 监控_持仓与保本(self):
         # 获取数据库里认为 "活着" 的单子
         try:
-            活跃单列表 = db.读取_所有活跃持仓()
+            活跃单列表 = self.持仓缓存.获取()
         except:
             return # 数据库可能忙
 
@@ -4,7 +4,14 @@ import sqlite3
 import json
 import datetime
 import os
+import time
+import queue
+import atexit
+import collections
+import pathlib
+import shutil
 import threading
+import contextlib
 import traceback # [新增] 用于Debug模式打印堆栈
 
 # ===========================
@@ -12,7 +19,7 @@ import traceback # [新增] 用于Debug模式打印堆栈
 # ===========================
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 数据库文件 = os.path.join(BASE_DIR, "影子订单簿.db")
-数据库_线程锁 = threading.Lock()
+数据库_线程锁 = threading.Lock()  # 写锁：同一进程内的写操作串行执行
 
 def 获取当前时间():
     return datetime.datetime.now().strftime("[%H:%M:%S]")
@@ -20,166 +27,1256 @@ def 获取当前时间():
 def 带时间的日志打印(msg):
     print(f"{获取当前时间()} {msg}")
 
-# [新增] 统一连接函数，确保所有操作都有30秒超时保护
-def 获取连接():
-    return sqlite3.connect(数据库文件, timeout=30)
+def _读取配置段(段名, 默认):
+    """配置.json 里的某一段，缺的键用默认值补 (读不到文件就全用默认值)"""
+    配置 = dict(默认)
+    try:
+        with open(os.path.join(BASE_DIR, "配置.json"), 'r', encoding='utf-8') as f:
+            配置.update(json.load(f).get(段名, {}))
+    except Exception:
+        pass
+    return 配置
 
 # ===========================
-# 核心：初始化表结构
+# 时间 (epoch 毫秒)
 # ===========================
-def 初始化数据库():
-    """检查并创建所有必要的表结构"""
-    try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            
-            # [cite_start][关键修改 1] 开启 WAL 模式，解决读写锁冲突 [cite: 1]
-            conn.execute("PRAGMA journal_mode=WAL;")
-            
-            cursor = conn.cursor()
+# 各表原来的时间列是文本 (大多是本地时间，chat_history / command_queue.created_at 是 UTC)，
+# 迁移 007 给每个时间列配了一个整数毫秒列 (*_ms，UTC epoch)，时间窗查询、排序和冷热判断都走它。
+def 当前毫秒():
+    return int(time.time() * 1000)
 
-            # 1. 原始信号表 (Shadow Signals) - [新增] 父级信号
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS shadow_signals (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp TEXT,
-                    kol_name TEXT,
-                    symbol TEXT,
-                    direction TEXT,        -- "做多" / "做空"
-                    entry_mode TEXT,       -- "市价" 或 "挂单"
-                    entry_price REAL,      -- 挂单价格
-                    tp_sl_config TEXT,     -- JSON: 原始的止盈止损配置
-                    status TEXT            -- "等待执行", "运行中", "已归档"
-                )
-            ''')
-
-            # 2. 待执行任务表 (Command Queue) - [新增] 子命令队列
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS command_queue (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    signal_id INTEGER,      -- 关联父信号ID
-                    kol_name TEXT,
-                    symbol TEXT,
-                    direction TEXT,         -- "买入", "卖出", "买入限价"...
-                    volume REAL,
-                    price REAL,             -- 挂单价格
-                    sl REAL,
-                    tp REAL,
-                    status TEXT,            -- "待执行", "已执行", "已撤销"
-                    mt5_ticket INTEGER,     -- 执行后的 Ticket
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- [Debug] 方便查什么时候生成的
-                    error_msg TEXT          -- [补丁] 错误信息记录
-                )
-            ''')
-
-            # 3. 当前持仓表 (Active Positions) - [升级] 增加关联ID
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS active_positions (
-                    ticket INTEGER PRIMARY KEY, -- MT5 Ticket作为主键
-                    signal_id INTEGER,          -- [新增] 关联父信号ID
-                    kol_name TEXT,
-                    symbol TEXT,
-                    direction TEXT,             -- "做多" / "做空"
-                    entry_price REAL,
-                    volume REAL,
-                    tp_goal REAL,               -- [新增] 这张单子的目标止盈位 (用于显示)
-                    exit_conditions TEXT,       -- JSON: 离场条件 (保留你的设计)
-                    status TEXT                 -- "持仓中", "挂单中"
-                )
-            ''')
-
-            # 4. 结算表 (Settlements) - [升级] 增加关联ID
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS settlements (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    signal_id INTEGER,          -- [新增] 关联父信号ID
-                    kol_name TEXT,              -- 谁开的单
-                    symbol TEXT,                -- 品种
-                    direction TEXT,             -- 方向
-                    volume REAL,                -- 手数
-                    entry_price REAL,           -- 开仓价
-                    exit_price REAL,            -- 平仓价
-                    profit REAL,                -- 最终盈亏 (含手续费/库存费)
-                    close_time TEXT,            -- 平仓时间
-                    hold_duration INTEGER       -- 持仓秒数
-                )
-            ''')
-
-            # 5. 执行日志表 (Execution Logs) - [保留] 流水账
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS execution_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    time TEXT,
-                    action TEXT,    -- "开仓", "平仓", "修改"
-                    details TEXT    -- 详细描述
-                )
-            ''')
-
-            # [新增] 聊天记录表 (Chat History) - 用于上下文记忆
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chat_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    kol_name TEXT,
-                    user_content TEXT,     -- KOL发送的内容
-                    ai_response TEXT,      -- AI回复的内容
-                    is_signal INTEGER,     -- 1=是信号, 0=不是
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-
-            # ==========================================
-            # [新增] 数据库补丁逻辑 (自动修复旧表结构)
-            # ==========================================
-            
-            # 补丁 1: 检查 command_queue 是否缺少 error_msg
-            cursor.execute("PRAGMA table_info(command_queue)")
-            cols = [info[1] for info in cursor.fetchall()]
-            if 'error_msg' not in cols:
-                带时间的日志打印("⚠️ [数据库] 检测到 command_queue 缺少 error_msg，正在自动补全...")
-                cursor.execute("ALTER TABLE command_queue ADD COLUMN error_msg TEXT")
-            if 'state' not in cols:
-                带时间的日志打印("⚠️ [数据库] 检测到 command_queue 缺少 state，正在自动补全...")
-                cursor.execute("ALTER TABLE command_queue ADD COLUMN state TEXT")  # 空值表示未分类，"挂单"、"待成交"、"持仓"、"已结束"
-
-            # 补丁 2: 检查 active_positions 是否缺少 signal_id
-            cursor.execute("PRAGMA table_info(active_positions)")
-            cols = [info[1] for info in cursor.fetchall()]
-            if 'signal_id' not in cols:
-                带时间的日志打印("⚠️ [数据库] 检测到 active_positions 缺少 signal_id，正在自动补全...")
-                cursor.execute("ALTER TABLE active_positions ADD COLUMN signal_id INTEGER")
-            if 'tp_goal' not in cols:
-                带时间的日志打印("⚠️ [数据库] 检测到 active_positions 缺少 tp_goal，正在自动补全...")
-                cursor.execute("ALTER TABLE active_positions ADD COLUMN tp_goal REAL")
-            
-            # 补丁 3: 检查 settlements 是否缺少 signal_id
-            cursor.execute("PRAGMA table_info(settlements)")
-            cols = [info[1] for info in cursor.fetchall()]
-            if 'signal_id' not in cols:
-                带时间的日志打印("⚠️ [数据库] 检测到 settlements 缺少 signal_id，正在自动补全...")
-                cursor.execute("ALTER TABLE settlements ADD COLUMN signal_id INTEGER")
-
-            # 补丁 4: 为 active_positions 添加实时数据字段
-            cursor.execute("PRAGMA table_info(active_positions)")
-            cols = [info[1] for info in cursor.fetchall()]
-            if 'current_price' not in cols:
-                带时间的日志打印("⚠️ [数据库] 检测到 active_positions 缺少 current_price，正在自动补全...")
-                cursor.execute("ALTER TABLE active_positions ADD COLUMN current_price REAL DEFAULT 0")
-            if 'unrealized_pnl' not in cols:
-                带时间的日志打印("⚠️ [数据库] 检测到 active_positions 缺少 unrealized_pnl，正在自动补全...")
-                cursor.execute("ALTER TABLE active_positions ADD COLUMN unrealized_pnl REAL DEFAULT 0")
-            if 'last_update' not in cols:
-                带时间的日志打印("⚠️ [数据库] 检测到 active_positions 缺少 last_update，正在自动补全...")
-                cursor.execute("ALTER TABLE active_positions ADD COLUMN last_update TEXT")
+def 转毫秒(值):
+    """datetime / date / 'YYYY-MM-DD[ HH:MM:SS]' (本地时间) / 毫秒整数 -> epoch 毫秒；None 原样返回"""
+    if 值 is None:
+        return None
+    if isinstance(值, (int, float)):
+        return int(值)
+    if isinstance(值, str):
+        值 = datetime.datetime.fromisoformat(值.strip())
+    elif not isinstance(值, datetime.datetime):
+        值 = datetime.datetime.combine(值, datetime.time())
+    return int(值.timestamp() * 1000)
+
+def 毫秒转文本(毫秒):
+    """epoch 毫秒 -> 本地时间 'YYYY-MM-DD HH:MM:SS'"""
+    return datetime.datetime.fromtimestamp(毫秒 / 1000).strftime("%Y-%m-%d %H:%M:%S")
+
+def _现在():
+    """同一时刻的 (本地时间文本, epoch 毫秒)"""
+    毫秒 = 当前毫秒()
+    return 毫秒转文本(毫秒), 毫秒
+
+# ===========================
+# 连接管理 (读写分离)
+# ===========================
+# 读: 每个线程一条只读长连接 (URI mode=ro)，不拿锁，WAL 下读和写互不阻塞。
+# 写: 每个进程只有一条写连接，由 数据库_线程锁 串行化；BEGIN IMMEDIATE 时如果别的进程
+#     占着写锁，先按 busy_timeout 等待，超时后再退避重试几次。
+# PRAGMA 只在打开连接时执行一次，预编译语句交给 sqlite3 自带的语句缓存 (cached_statements) 复用。
+连接参数 = {
+    "timeout": 30,              # busy_timeout 30秒 (保留原有设置)
+    "cached_statements": 256,   # 预编译语句缓存条数
+    "isolation_level": None,    # 事务由 数据库事务() 显式控制
+}
+写连接PRAGMA = [
+    "PRAGMA auto_vacuum=INCREMENTAL",   # 只对还没建表的新库生效，旧库由 库维护 找安静时机 VACUUM 转换
+    "PRAGMA journal_mode=WAL",      # 读写不互斥
+    "PRAGMA synchronous=NORMAL",    # WAL 下足够安全，省掉每次提交的 fsync
+]
+公共PRAGMA = [
+    "PRAGMA cache_size=-16000",     # 页缓存约 16MB (负数单位为 KB)
+    "PRAGMA mmap_size=268435456",   # 256MB 内存映射读
+    "PRAGMA temp_store=MEMORY",     # 临时表/排序放内存
+]
+写入重试次数 = 3
+写入重试间隔 = 0.5  # 秒，每次重试翻倍
+
+_线程连接 = threading.local()
+_写连接 = {"conn": None, "标识": None}
+
+def _打开连接(路径, 只读):
+    if 只读:
+        uri = pathlib.Path(路径).absolute().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, **连接参数)
+        语句列表 = 公共PRAGMA
+    else:
+        conn = sqlite3.connect(路径, check_same_thread=False, **连接参数)
+        语句列表 = 写连接PRAGMA + 公共PRAGMA
+    for 语句 in 语句列表:
+        conn.execute(语句)
+    return conn
+
+def _获取写连接():
+    """进程唯一的写连接 (调用方需持有 数据库_线程锁)"""
+    标识 = (os.getpid(), 数据库文件)
+    if _写连接["标识"] != 标识:
+        if _写连接["conn"] is not None and _写连接["标识"][0] == os.getpid():
+            _写连接["conn"].close()
+        _写连接["conn"] = _打开连接(数据库文件, 只读=False)
+        _写连接["标识"] = 标识
+    return _写连接["conn"]
+
+def 获取读连接():
+    """返回当前线程的只读长连接 (不用拿锁，调用方不要 close)"""
+    标识 = (os.getpid(), 数据库文件)
+    conn = getattr(_线程连接, "conn", None)
+    if conn is None or _线程连接.标识 != 标识:
+        if _写连接["标识"] != 标识:
+            # 只读连接打不开 WAL 库的 -shm，先让写连接把库和 WAL 文件准备好
+            with 数据库_线程锁:
+                _获取写连接()
+        conn = _打开连接(数据库文件, 只读=True)
+        _线程连接.conn = conn
+        _线程连接.标识 = 标识
+    return conn
+
+# 兼容旧调用：获取连接() 现在返回只读连接，写操作请用 数据库事务()
+获取连接 = 获取读连接
+
+def 关闭连接():
+    """关闭当前线程的只读连接和本进程的写连接 (进程退出前调用，不调用也会在回收时关闭)"""
+    conn = getattr(_线程连接, "conn", None)
+    if conn is not None:
+        conn.close()
+        _线程连接.conn = None
+    with 数据库_线程锁:
+        if _写连接["conn"] is not None:
+            _写连接["conn"].close()
+        _写连接["conn"] = None
+        _写连接["标识"] = None
+
+def _开始写事务(conn):
+    """BEGIN IMMEDIATE 抢写锁，遇到 'database is locked' 退避重试"""
+    for 第几次 in range(写入重试次数 + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            if 第几次 == 写入重试次数:
+                raise
+            等待 = 写入重试间隔 * (2 ** 第几次)
+            带时间的日志打印(f"⚠️ [数据库] 写锁被占用 ({e})，{等待:.1f}秒后重试 ({第几次 + 1}/{写入重试次数})")
+            time.sleep(等待)
+
+@contextlib.contextmanager
+def 数据库事务(附加库=None):
+    """写操作统一入口：持锁 + 进程唯一写连接，正常结束提交，异常回滚
+    附加库: {别名: 文件路径}，事务前 ATTACH、结束后 DETACH (ATTACH 不能在事务里做)"""
+    with 数据库_线程锁:
+        conn = _获取写连接()
+        for 别名, 路径 in (附加库 or {}).items():
+            conn.execute(f"ATTACH DATABASE ? AS {别名}", (路径,))
+        try:
+            _开始写事务(conn)
+            try:
+                yield conn.cursor()
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+        finally:
+            for 别名 in (附加库 or {}):
+                conn.execute(f"DETACH DATABASE {别名}")
+
+# ===========================
+# 核心：表结构迁移 (PRAGMA user_version)
+# ===========================
+# 每个迁移只执行一次，执行完把 user_version 设为它的编号。
+# 改表结构 / 改索引都是在 迁移列表 末尾追加一条，已发布的迁移不要再改。
+# 库已是最新版本时，启动只读一次 user_version。
+
+_新建库 = False  # 执行迁移 时库里还没有表：后面迁移加的列本来就不在，补列不打日志
+
+def _补列(cursor, 表, 列, 定义):
+    """列不存在时 ALTER TABLE 补上 (兼容手工改过表的旧库)"""
+    cursor.execute(f"PRAGMA table_xinfo({表})")  # table_info 不列生成列
+    if 列 not in [info[1] for info in cursor.fetchall()]:
+        if not _新建库:
+            带时间的日志打印(f"⚠️ [数据库] 检测到 {表} 缺少 {列}，正在自动补全...")
+        cursor.execute(f"ALTER TABLE {表} ADD COLUMN {列} {定义}")
+
+def _迁移_001_基线表结构(cursor):
+    """建表，并把 user_version 出现之前各版本的旧库补齐到同一形状 (原来的补丁链)"""
+    # 1. 原始信号表 (Shadow Signals) - [新增] 父级信号
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shadow_signals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT,
+            kol_name TEXT,
+            symbol TEXT,
+            direction TEXT,        -- "做多" / "做空"
+            entry_mode TEXT,       -- "市价" 或 "挂单"
+            entry_price REAL,      -- 挂单价格
+            tp_sl_config TEXT,     -- JSON: 原始的止盈止损配置
+            status TEXT            -- "等待执行", "运行中", "已归档"
+        )
+    ''')
+
+    # 2. 待执行任务表 (Command Queue) - [新增] 子命令队列
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS command_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            signal_id INTEGER,      -- 关联父信号ID
+            kol_name TEXT,
+            symbol TEXT,
+            direction TEXT,         -- "买入", "卖出", "买入限价"...
+            volume REAL,
+            price REAL,             -- 挂单价格
+            sl REAL,
+            tp REAL,
+            status TEXT,            -- "待执行", "已执行", "已撤销"
+            mt5_ticket INTEGER,     -- 执行后的 Ticket
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- [Debug] 方便查什么时候生成的
+            error_msg TEXT          -- [补丁] 错误信息记录
+        )
+    ''')
+
+    # 3. 当前持仓表 (Active Positions) - [升级] 增加关联ID
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS active_positions (
+            ticket INTEGER PRIMARY KEY, -- MT5 Ticket作为主键
+            signal_id INTEGER,          -- [新增] 关联父信号ID
+            kol_name TEXT,
+            symbol TEXT,
+            direction TEXT,             -- "做多" / "做空"
+            entry_price REAL,
+            volume REAL,
+            tp_goal REAL,               -- [新增] 这张单子的目标止盈位 (用于显示)
+            exit_conditions TEXT,       -- JSON: 离场条件 (保留你的设计)
+            status TEXT                 -- "持仓中", "挂单中"
+        )
+    ''')
+
+    # 4. 结算表 (Settlements) - [升级] 增加关联ID
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settlements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            signal_id INTEGER,          -- [新增] 关联父信号ID
+            kol_name TEXT,              -- 谁开的单
+            symbol TEXT,                -- 品种
+            direction TEXT,             -- 方向
+            volume REAL,                -- 手数
+            entry_price REAL,           -- 开仓价
+            exit_price REAL,            -- 平仓价
+            profit REAL,                -- 最终盈亏 (含手续费/库存费)
+            close_time TEXT,            -- 平仓时间
+            hold_duration INTEGER       -- 持仓秒数
+        )
+    ''')
+
+    # 5. 执行日志表 (Execution Logs) - [保留] 流水账
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS execution_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            time TEXT,
+            action TEXT,    -- "开仓", "平仓", "修改"
+            details TEXT    -- 详细描述
+        )
+    ''')
+
+    # [新增] 聊天记录表 (Chat History) - 用于上下文记忆
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kol_name TEXT,
+            user_content TEXT,     -- KOL发送的内容
+            ai_response TEXT,      -- AI回复的内容
+            is_signal INTEGER,     -- 1=是信号, 0=不是
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 补丁 1: command_queue 错误信息与 MT5 状态
+    _补列(cursor, "command_queue", "error_msg", "TEXT")
+    _补列(cursor, "command_queue", "state", "TEXT")  # 空值表示未分类，"挂单"、"待成交"、"持仓"、"已结束"
+    # 补丁 2: 关联父信号 ID 与目标止盈位
+    _补列(cursor, "active_positions", "signal_id", "INTEGER")
+    _补列(cursor, "active_positions", "tp_goal", "REAL")
+    # 补丁 3: settlements 关联父信号 ID
+    _补列(cursor, "settlements", "signal_id", "INTEGER")
+    # 补丁 4: active_positions 实时数据字段
+    _补列(cursor, "active_positions", "current_price", "REAL DEFAULT 0")
+    _补列(cursor, "active_positions", "unrealized_pnl", "REAL DEFAULT 0")
+    _补列(cursor, "active_positions", "last_update", "TEXT")
+
+def _迁移_002_二级索引(cursor):
+    _同步索引集(cursor)
+
+def _迁移_003_挂单失效记录(cursor):
+    """标记失效挂单 / 同步挂单状态.py 写的 cancel_time、cancel_reason"""
+    _补列(cursor, "shadow_signals", "cancel_time", "TEXT")
+    _补列(cursor, "shadow_signals", "cancel_reason", "TEXT")
+
+def _迁移_004_变更序号(cursor):
+    """change_seq: 每张表一个单调递增的变更序号，由触发器维护 (见 变更缓存)"""
+    cursor.execute("CREATE TABLE IF NOT EXISTS change_seq (tbl TEXT PRIMARY KEY, seq INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID")
+    # 键: 表名 = 任何增删改; 表名.删改 = 只有 UPDATE/DELETE (追加型表据此决定增量还是全量重读);
+    # active_positions.实时 = 统计端刷新价格/浮盈 (不算结构变化，执行端不用因此重读)
+    for 表 in ("shadow_signals", "command_queue", "active_positions", "settlements"):
+        for 键 in (表, f"{表}.删改"):
+            cursor.execute("INSERT OR IGNORE INTO change_seq (tbl, seq) VALUES (?, 0)", (键,))
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_seq_{表}_ins AFTER INSERT ON {表}
+            BEGIN UPDATE change_seq SET seq = seq + 1 WHERE tbl = '{表}'; END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_seq_{表}_del AFTER DELETE ON {表}
+            BEGIN UPDATE change_seq SET seq = seq + 1 WHERE tbl IN ('{表}', '{表}.删改'); END
+        """)
+    for 表 in ("shadow_signals", "command_queue", "settlements"):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_seq_{表}_upd AFTER UPDATE ON {表}
+            BEGIN UPDATE change_seq SET seq = seq + 1 WHERE tbl IN ('{表}', '{表}.删改'); END
+        """)
+    结构列 = ("ticket", "signal_id", "kol_name", "symbol", "direction", "entry_price", "volume", "tp_goal", "exit_conditions", "status")
+    实时列 = ("current_price", "unrealized_pnl")
+    cursor.execute("INSERT OR IGNORE INTO change_seq (tbl, seq) VALUES ('active_positions.实时', 0)")
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_seq_active_positions_upd AFTER UPDATE ON active_positions
+        WHEN {" OR ".join(f"OLD.{列} IS NOT NEW.{列}" for 列 in 结构列)}
+        BEGIN UPDATE change_seq SET seq = seq + 1 WHERE tbl IN ('active_positions', 'active_positions.删改'); END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_seq_active_positions_rt AFTER UPDATE OF {", ".join(实时列)} ON active_positions
+        WHEN {" OR ".join(f"OLD.{列} IS NOT NEW.{列}" for 列 in 实时列)}
+        BEGIN UPDATE change_seq SET seq = seq + 1 WHERE tbl = 'active_positions.实时'; END
+    """)
+
+def _迁移_005_KOL统计汇总(cursor):
+    """kol_stats / kol_symbol_daily 汇总表，由 归档_结算记录 在同一事务里累加"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS kol_stats (
+            kol_name TEXT PRIMARY KEY,
+            total_trades INTEGER NOT NULL DEFAULT 0,
+            win_count INTEGER NOT NULL DEFAULT 0,
+            total_profit REAL NOT NULL DEFAULT 0,
+            last_close_time TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS kol_symbol_daily (
+            kol_name TEXT,
+            day TEXT,              -- 平仓日期 YYYY-MM-DD
+            symbol TEXT,
+            trades INTEGER NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0,
+            profit REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (kol_name, day, symbol)
+        ) WITHOUT ROWID
+    ''')
+    _重建KOL统计(cursor)
+
+def _迁移_006_命令租约(cursor):
+    """command_queue 领取租约：执行中 的命令记录领取者和租约到期时间 (见 领取_待执行命令)"""
+    _补列(cursor, "command_queue", "claimed_by", "TEXT")
+    _补列(cursor, "command_queue", "lease_until", "REAL")      # 租约到期 (time.time() 秒)
+    _补列(cursor, "command_queue", "attempts", "INTEGER DEFAULT 0")
+    # 索引集 v3 (idx_cq_lease) 在 迁移 010 同步
+
+def _本地文本转毫秒SQL(列):
+    # 文本是本地时间：'utc' 修饰符先换成 UTC 再取 epoch
+    return f"CAST(strftime('%s', {列}, 'utc') AS INTEGER) * 1000"
+
+def _UTC文本转毫秒SQL(列):
+    return f"CAST(strftime('%s', {列}) AS INTEGER) * 1000"
 
+# 表: [(文本列, 毫秒列, 换算SQL)]，第一个是该表做时间窗查询 / 冷热判断的主时间列
+毫秒时间列 = {
+    "shadow_signals": [("timestamp", "ts_ms", _本地文本转毫秒SQL("timestamp")),
+                       ("cancel_time", "cancel_ms", _本地文本转毫秒SQL("cancel_time"))],
+    # 决策端写的子命令靠 DEFAULT CURRENT_TIMESTAMP (UTC)，插入手动挂单 写的是本地时间
+    "command_queue": [("created_at", "created_ms",
+                       f"CASE WHEN kol_name = '手动' THEN {_本地文本转毫秒SQL('created_at')} ELSE {_UTC文本转毫秒SQL('created_at')} END")],
+    "active_positions": [("last_update", "last_update_ms", _本地文本转毫秒SQL("last_update"))],
+    "settlements": [("close_time", "close_ms", _本地文本转毫秒SQL("close_time"))],
+    "execution_logs": [("time", "time_ms", _本地文本转毫秒SQL("time"))],
+    "chat_history": [("created_at", "created_ms", _UTC文本转毫秒SQL("created_at"))],
+}
+主时间列 = {表: 列表[0][1] for 表, 列表 in 毫秒时间列.items()}
+
+def _回填毫秒列(cursor, 表, 库="main"):
+    """毫秒列为空、文本列有值的行按文本换算补上"""
+    for 文本列, 毫秒列, 换算 in 毫秒时间列[表]:
+        cursor.execute(f"UPDATE {库}.{表} SET {毫秒列} = {换算} WHERE {毫秒列} IS NULL AND {文本列} IS NOT NULL")
+
+def _迁移_007_毫秒时间列(cursor):
+    """每个文本时间列配一个整数 epoch 毫秒列 (*_ms)，回填旧行 (含归档库)。
+    本模块写入时两列一起写；触发器兜底只写了文本列的写入 (老版本进程、同步挂单状态.py、手工 SQL)"""
+    for 表, 列表 in 毫秒时间列.items():
+        for 文本列, 毫秒列, 换算 in 列表:
+            _补列(cursor, 表, 毫秒列, "INTEGER")
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_ms_{表}_{毫秒列}_ins AFTER INSERT ON {表}
+                WHEN NEW.{毫秒列} IS NULL AND NEW.{文本列} IS NOT NULL
+                BEGIN UPDATE {表} SET {毫秒列} = {换算} WHERE rowid = NEW.rowid; END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_ms_{表}_{毫秒列}_upd AFTER UPDATE OF {文本列} ON {表}
+                WHEN NEW.{毫秒列} IS OLD.{毫秒列} AND NEW.{文本列} IS NOT OLD.{文本列}
+                BEGIN UPDATE {表} SET {毫秒列} = {换算} WHERE rowid = NEW.rowid; END
+            """)
+        _回填毫秒列(cursor, 表)
+    # 归档库是独立文件，不在这个事务里；回填是幂等的，迁移失败重跑也没关系
+    for 月份 in 列出_归档月份():
+        conn = sqlite3.connect(_归档文件(月份))
+        try:
+            已有表 = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+            for 表 in 归档表:
+                if 表 not in 已有表:
+                    continue
+                已有列 = {info[1] for info in conn.execute(f"PRAGMA table_info({表})")}
+                for _, 毫秒列, _ in 毫秒时间列[表]:
+                    if 毫秒列 not in 已有列:
+                        conn.execute(f"ALTER TABLE {表} ADD COLUMN {毫秒列} INTEGER")
+                _回填毫秒列(conn.cursor(), 表)
             conn.commit()
+        finally:
             conn.close()
-        
-        带时间的日志打印(f"🛠️ [数据库] 初始化及自检完成，路径: {数据库文件} (模式: WAL)")
+    # 索引集 v4 (时间列索引换成 *_ms) 在 迁移 010 同步
+
+def _JSON取数SQL(列, 路径):
+    # 列是合法 JSON 才取值 (坏 JSON 让 json_extract 报错)；AI 偶尔把价格写成字符串，统一转 REAL
+    return f"CASE WHEN json_valid({列}) THEN CAST(json_extract({列}, '{路径}') AS REAL) END"
+
+def _离场价SQL(类型, 个数=4):
+    # exit_conditions 是 [{"类型": "止盈"/"止损", "价格": x}, ...]；生成列里不能用子查询 (json_each)，按前 个数 个元素展开
+    分支 = " ".join(f"WHEN json_extract(exit_conditions, '$[{i}].类型') = '{类型}' "
+                  f"THEN CAST(json_extract(exit_conditions, '$[{i}].价格') AS REAL)" for i in range(个数))
+    return f"CASE WHEN NOT json_valid(exit_conditions) THEN NULL {分支} END"
+
+# 表: [(列, 类型, 表达式)]，VIRTUAL 生成列：不占行存储，读到时才解析 JSON；建了索引的列值存在索引里
+JSON生成列 = {
+    "shadow_signals": [
+        ("sl", "REAL", _JSON取数SQL("tp_sl_config", "$.sl")),
+        ("tp_count", "INTEGER", "CASE WHEN json_valid(tp_sl_config) THEN json_array_length(tp_sl_config, '$.tps') END"),
+        ("first_tp", "REAL", _JSON取数SQL("tp_sl_config", "$.tps[0]")),
+        ("last_tp", "REAL", _JSON取数SQL("tp_sl_config", "$.tps[#-1]")),
+        # 挂单信号 入场价 到 止损 的距离；市价单 entry_price 是 0，这一列为 NULL
+        ("sl_distance", "REAL", "CASE WHEN entry_price > 0 AND sl > 0 THEN abs(entry_price - sl) END"),
+    ],
+    "active_positions": [
+        ("exit_tp", "REAL", _离场价SQL("止盈")),
+        ("exit_sl", "REAL", _离场价SQL("止损")),
+    ],
+}
+
+def _迁移_008_JSON生成列(cursor):
+    """tp_sl_config / exit_conditions 里常用的字段做成生成列 (SQLite JSON1)，筛选、聚合、建索引都在 SQL 里完成。
+    只能 ADD 成 VIRTUAL (STORED 要重建表)；写入方不用改，生成列由 SQLite 自己算"""
+    for 表, 列表 in JSON生成列.items():
+        for 列, 类型, 表达式 in 列表:
+            _补列(cursor, 表, 列, f"{类型} GENERATED ALWAYS AS ({表达式}) VIRTUAL")
+    # 索引集 v5 (止盈止损生成列) 在 迁移 010 同步
+
+def _迁移_009_已处理消息(cursor):
+    """决策端按侦察兵的 message_id 去重：处理完成才记 (出信号的跟父信号/子命令同一个事务)，重启后的重投也认得"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            msg_key TEXT PRIMARY KEY,  -- chat_id:msg_id
+            is_signal INTEGER,         -- AI 判定为信号 (图片补充据此跳过)
+            signal_id INTEGER,         -- 入库的父信号，没下单为 NULL
+            done_ms INTEGER
+        ) WITHOUT ROWID
+    ''')
+
+def _迁移_010_同步索引集(cursor):
+    """索引集 v3-v5 引用 006-008 才加的列，新库跑 002 时这些索引建不了，在这里补齐"""
+    _同步索引集(cursor)
+
+迁移列表 = [
+    (1, "基线表结构", _迁移_001_基线表结构),
+    (2, "二级索引", _迁移_002_二级索引),
+    (3, "挂单失效记录", _迁移_003_挂单失效记录),
+    (4, "变更序号", _迁移_004_变更序号),
+    (5, "KOL统计汇总", _迁移_005_KOL统计汇总),
+    (6, "命令租约", _迁移_006_命令租约),
+    (7, "毫秒时间列", _迁移_007_毫秒时间列),
+    (8, "JSON生成列", _迁移_008_JSON生成列),
+    (9, "已处理消息", _迁移_009_已处理消息),
+    (10, "同步索引集", _迁移_010_同步索引集),
+]
+最新版本 = 迁移列表[-1][0]
+
+def 读取_表结构版本():
+    with 数据库_线程锁:
+        return _获取写连接().execute("PRAGMA user_version").fetchone()[0]
+
+def 执行迁移():
+    """把库升级到 最新版本，返回执行了几个迁移 (已是最新则只读一次版本号)"""
+    global _新建库
+    if 读取_表结构版本() >= 最新版本:
+        return 0
+    with 数据库_线程锁:
+        _新建库 = not _获取写连接().execute("SELECT 1 FROM sqlite_master WHERE type='table' LIMIT 1").fetchone()
+    已执行 = 0
+    for 版本, 说明, 迁移 in 迁移列表:
+        # 每个迁移一个事务；拿到写锁后再读一次版本，别的进程可能已经迁移过了
+        with 数据库事务() as cursor:
+            cursor.execute("PRAGMA user_version")
+            当前 = cursor.fetchone()[0]
+            if 当前 >= 版本:
+                continue
+            带时间的日志打印(f"⚠️ [数据库] 表结构迁移 {当前} -> {版本} ({说明})")
+            迁移(cursor)
+            cursor.execute(f"PRAGMA user_version = {版本}")
+            已执行 += 1
+    _新建库 = False
+    return 已执行
+
+def 初始化数据库():
+    """检查并升级表结构到最新版本"""
+    try:
+        # [cite_start][关键修改 1] WAL 模式已在打开写连接时统一开启 [cite: 1]
+        执行迁移()
+        带时间的日志打印(f"🛠️ [数据库] 初始化及自检完成，路径: {数据库文件} (模式: WAL, 版本: {最新版本})")
     
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-初始化失败] {e}")
         带时间的日志打印(traceback.format_exc())
 
+# ===========================
+# 二级索引 (版本化管理)
+# ===========================
+# 修改下面任何一条索引都要把 索引集版本 +1，并在 迁移列表 末尾追加一个调用 _同步索引集 的迁移，
+# 迁移时会删掉旧的 idx_ 索引并按当前 索引集 整体重建。
+# 部分索引 (WHERE ...) 只收录热点状态的行，表再大索引也很小。
+索引集版本 = 5
+索引集 = [
+    # command_queue: 执行端每秒轮询待执行命令
+    ("idx_cq_pending", "CREATE INDEX IF NOT EXISTS idx_cq_pending ON command_queue(id) WHERE status='待执行'"),
+    # command_queue: 租约已过期、可以重新领取的 执行中 命令
+    ("idx_cq_lease", "CREATE INDEX IF NOT EXISTS idx_cq_lease ON command_queue(lease_until) WHERE status='执行中'"),
+    # command_queue: 按 Ticket 查找/更新 (检查command_queue中是否存在、更新挂单数据)
+    ("idx_cq_ticket", "CREATE INDEX IF NOT EXISTS idx_cq_ticket ON command_queue(mt5_ticket)"),
+    # command_queue: 已执行命令的 Ticket 集合 (覆盖索引，不回表)
+    ("idx_cq_status_ticket", "CREATE INDEX IF NOT EXISTS idx_cq_status_ticket ON command_queue(status, mt5_ticket)"),
+    # command_queue: 尚未结束的已执行命令 (更新command_queue_state 只扫这部分)
+    ("idx_cq_unfinished", "CREATE INDEX IF NOT EXISTS idx_cq_unfinished ON command_queue(mt5_ticket) WHERE status='已执行' AND state IS NOT '已结束'"),
+    # command_queue: 父信号关联 (获取等待中的信号)
+    ("idx_cq_signal", "CREATE INDEX IF NOT EXISTS idx_cq_signal ON command_queue(signal_id)"),
+    # command_queue: KOL 挂单 (查询_KOL挂单、仪表盘挂单页)
+    ("idx_cq_kol_orders", "CREATE INDEX IF NOT EXISTS idx_cq_kol_orders ON command_queue(kol_name, symbol) WHERE status='已执行' AND state='挂单'"),
+    ("idx_cq_orders_time", "CREATE INDEX IF NOT EXISTS idx_cq_orders_time ON command_queue(created_ms) WHERE status='已执行' AND state='挂单'"),
+    # shadow_signals: 等待执行的父信号
+    ("idx_ss_waiting", "CREATE INDEX IF NOT EXISTS idx_ss_waiting ON shadow_signals(id) WHERE status='等待执行'"),
+    # shadow_signals: 信号时间窗 (全部 / 按 KOL)
+    ("idx_ss_time", "CREATE INDEX IF NOT EXISTS idx_ss_time ON shadow_signals(ts_ms)"),
+    ("idx_ss_kol_time", "CREATE INDEX IF NOT EXISTS idx_ss_kol_time ON shadow_signals(kol_name, ts_ms)"),
+    # shadow_signals: 按 KOL 聚合止盈个数 / 止损距离 (按 KOL 顺序扫，不用临时表分组)，只收带止盈的开仓信号
+    ("idx_ss_kol_tpsl", "CREATE INDEX IF NOT EXISTS idx_ss_kol_tpsl ON shadow_signals(kol_name, ts_ms, tp_count, sl_distance) WHERE tp_count > 0"),
+    # shadow_signals: 按止损距离筛选信号
+    ("idx_ss_sl_distance", "CREATE INDEX IF NOT EXISTS idx_ss_sl_distance ON shadow_signals(sl_distance) WHERE sl_distance IS NOT NULL"),
+    # active_positions: 按 KOL/品种 查持仓
+    ("idx_ap_kol", "CREATE INDEX IF NOT EXISTS idx_ap_kol ON active_positions(kol_name, symbol)"),
+    # chat_history: 每个 KOL 最近 N 条
+    ("idx_chat_kol", "CREATE INDEX IF NOT EXISTS idx_chat_kol ON chat_history(kol_name, id)"),
+    # chat_history / execution_logs: 时间窗与冷数据归档
+    ("idx_chat_time", "CREATE INDEX IF NOT EXISTS idx_chat_time ON chat_history(created_ms)"),
+    ("idx_log_time", "CREATE INDEX IF NOT EXISTS idx_log_time ON execution_logs(time_ms)"),
+    # settlements: 按 KOL 聚合 (覆盖索引) 与按平仓时间排序/筛选
+    ("idx_st_kol_profit", "CREATE INDEX IF NOT EXISTS idx_st_kol_profit ON settlements(kol_name, profit)"),
+    ("idx_st_close_time", "CREATE INDEX IF NOT EXISTS idx_st_close_time ON settlements(close_ms)"),
+    ("idx_st_kol_time", "CREATE INDEX IF NOT EXISTS idx_st_kol_time ON settlements(kol_name, close_ms)"),
+    # active_positions 只有几十行、last_update_ms 每轮都在改，不建时间索引；exit_tp / exit_sl 同理不建索引
+]
+
+def _同步索引集(cursor):
+    """索引版本与库里记录的不一致时，删除旧的 idx_ 索引并按当前 索引集 重建。
+    引用的列还没加的索引 (早期迁移里) 先跳过、不记版本，等后面调用 _同步索引集 的迁移再建"""
+    cursor.execute("CREATE TABLE IF NOT EXISTS db_meta (key TEXT PRIMARY KEY, value TEXT)")
+    cursor.execute("SELECT value FROM db_meta WHERE key='index_version'")
+    行 = cursor.fetchone()
+    if 行 and int(行[0]) == 索引集版本:
+        return
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx!_%' ESCAPE '!'")
+    for (旧索引,) in cursor.fetchall():
+        cursor.execute(f"DROP INDEX IF EXISTS {旧索引}")
+    缺列 = []
+    for 名称, 语句 in 索引集:
+        try:
+            cursor.execute(语句)
+        except sqlite3.OperationalError as e:
+            if "no such column" not in str(e):
+                raise
+            缺列.append(名称)
+    if 缺列:
+        return
+    带时间的日志打印(f"⚠️ [数据库] 索引集版本 {行[0] if 行 else '无'} -> {索引集版本}，已重建索引")
+    cursor.execute("INSERT OR REPLACE INTO db_meta (key, value) VALUES ('index_version', ?)", (str(索引集版本),))
+    cursor.execute("ANALYZE")
+
+# 热点查询 (名称, SQL, 参数)：用 EXPLAIN QUERY PLAN 检查每条都走索引
+热点查询 = [
+    ("读取_待执行命令", "SELECT * FROM command_queue WHERE status = '待执行'", ()),
+    ("有可领取命令", "SELECT id FROM command_queue WHERE status = '待执行' UNION ALL SELECT id FROM command_queue WHERE status = '执行中' AND lease_until < ?", (0.0,)),
+    ("检查command_queue中是否存在", "SELECT id FROM command_queue WHERE mt5_ticket=?", (1,)),
+    ("更新挂单数据", "UPDATE command_queue SET price=?, sl=?, tp=? WHERE mt5_ticket=? AND status='已执行' AND state='挂单'", (0, 0, 0, 1)),
+    ("获取已执行的tickets", "SELECT mt5_ticket FROM command_queue WHERE status='已执行'", ()),
+    ("查询_KOL挂单", "SELECT mt5_ticket, symbol FROM command_queue WHERE kol_name=? AND status='已执行' AND state='挂单' AND symbol=?", ("K", "S")),
+    ("仪表盘_挂单列表", "SELECT * FROM command_queue c WHERE c.status = '已执行' AND c.state = '挂单' ORDER BY c.created_ms DESC", ()),
+    ("更新command_queue_state", "UPDATE command_queue INDEXED BY idx_cq_unfinished SET state='已结束' WHERE status='已执行' AND state IS NOT '已结束' AND mt5_ticket IS NOT NULL AND mt5_ticket NOT IN (SELECT value FROM json_each(?1))", ("[]",)),
+    ("获取等待中的信号", "SELECT s.id, c.mt5_ticket FROM shadow_signals s LEFT JOIN command_queue c ON s.id = c.signal_id AND c.status='已执行' WHERE s.status='等待执行'", ()),
+    ("查询_KOL活跃Ticket", "SELECT ticket FROM active_positions WHERE kol_name = ?", ("K",)),
+    ("读取_最近聊天记录", "SELECT user_content, ai_response FROM chat_history WHERE kol_name = ? ORDER BY id DESC LIMIT ?", ("K", 2)),
+    ("查询_KOL每日战绩", "SELECT * FROM kol_symbol_daily WHERE kol_name = ? AND day >= ? ORDER BY day", ("K", "2026-01-01")),
+    ("读取_最近结算", "SELECT * FROM settlements ORDER BY close_ms DESC LIMIT ?", (50,)),
+    ("查询_结算区间", "SELECT * FROM settlements WHERE kol_name = ? AND close_ms >= ? AND close_ms < ? ORDER BY close_ms DESC", ("K", 0, 1)),
+    ("查询_结算区间(全部KOL)", "SELECT * FROM settlements WHERE 1=1 AND close_ms >= ? AND close_ms < ? ORDER BY close_ms DESC", (0, 1)),
+    ("查询_信号区间", "SELECT * FROM shadow_signals WHERE kol_name = ? AND ts_ms >= ? ORDER BY ts_ms DESC", ("K", 0)),
+    ("查询_KOL止盈止损统计", "SELECT kol_name, COUNT(*), AVG(tp_count), AVG(sl_distance) FROM shadow_signals WHERE tp_count > 0 AND ts_ms >= ? GROUP BY kol_name", (0,)),
+    ("查询_信号止盈止损(止损距离)", "SELECT * FROM shadow_signals WHERE sl_distance <= ?", (1.0,)),
+    ("归档_冷数据(日志)", "SELECT DISTINCT strftime('%Y-%m', time_ms / 1000, 'unixepoch', 'localtime') FROM execution_logs WHERE time_ms < ?", (0,)),
+    ("归档_冷数据(聊天)", "SELECT DISTINCT strftime('%Y-%m', created_ms / 1000, 'unixepoch', 'localtime') FROM chat_history WHERE created_ms < ?", (0,)),
+]
+
+def 检查_热点查询索引():
+    """对 热点查询 跑 EXPLAIN QUERY PLAN，返回没走索引的 [(名称, 计划明细)]，空列表表示全部命中"""
+    未命中 = []
+    cursor = 获取读连接().cursor()
+    for 名称, sql, 参数 in 热点查询:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", 参数)
+        for 行 in cursor.fetchall():
+            明细 = 行[-1]
+            是表访问 = 明细.startswith("SCAN") or 明细.startswith("SEARCH")
+            if 是表访问 and "INDEX" not in 明细 and "PRIMARY KEY" not in 明细:
+                未命中.append((名称, 明细))
+    return 未命中
+
+# ===========================
+# 后台写入队列 (非关键数据：执行日志 / 聊天记录)
+# ===========================
+# 调用方只把记录放进内存队列就返回；后台线程攒够 批量条数 或等满 刷新间隔 后，
+# 一个事务 executemany 写入。进程退出时 (atexit) 把剩下的全部写完。
+后台写入语句 = {
+    "execution_logs": "INSERT INTO execution_logs (time, time_ms, action, details) VALUES (?, ?, ?, ?)",
+    "chat_history": "INSERT INTO chat_history (kol_name, user_content, ai_response, is_signal, created_at, created_ms) VALUES (?, ?, ?, ?, ?, ?)",
+}
+
+class 后台写入器:
+    def __init__(self, 批量条数=200, 刷新间隔=1.0):
+        self.批量条数 = 批量条数
+        self.刷新间隔 = 刷新间隔
+        self._队列 = queue.Queue()
+        self._线程 = None
+        self._线程pid = None
+        self._启动锁 = threading.Lock()
+        self._写入锁 = threading.Lock()  # 后台线程和同步刷新不能同时写同一批
+        self._待写入 = {表: 0 for 表 in 后台写入语句}
+        self._指标 = {"累计入队": 0, "累计写入": 0, "写入失败": 0, "批次数": 0, "最近批次条数": 0, "最近刷新耗时ms": 0.0}
+
+    def 提交(self, 表, 记录):
+        """放入队列立即返回，不碰数据库"""
+        self._确保启动()
+        self._待写入[表] += 1
+        self._指标["累计入队"] += 1
+        self._队列.put((表, 记录))
+
+    def 有待写入(self, 表):
+        return self._待写入.get(表, 0) > 0
+
+    def 指标(self):
+        return dict(self._指标, 队列深度=self._队列.qsize(), 待写入=dict(self._待写入))
+
+    def 刷新(self, 超时=5):
+        """把已入队的记录全部写进数据库再返回 (后台线程不在时由当前线程直接写)"""
+        if self._线程 is not None and self._线程.is_alive() and self._线程pid == os.getpid():
+            完成 = threading.Event()
+            self._队列.put((None, 完成))
+            if 完成.wait(超时):
+                return
+        批次 = []
+        while True:
+            try:
+                表, 记录 = self._队列.get_nowait()
+            except queue.Empty:
+                break
+            if 表 is None:
+                记录.set()
+            else:
+                批次.append((表, 记录))
+        self._写入批次(批次)
+
+    def _确保启动(self):
+        if self._线程 is not None and self._线程pid == os.getpid() and self._线程.is_alive():
+            return
+        with self._启动锁:
+            if self._线程 is None or self._线程pid != os.getpid() or not self._线程.is_alive():
+                self._线程 = threading.Thread(target=self._运行, name="后台写入器", daemon=True)
+                self._线程pid = os.getpid()
+                self._线程.start()
+
+    def _运行(self):
+        while True:
+            表, 记录 = self._队列.get()
+            批次, 待通知 = [], []
+            截止 = time.monotonic() + self.刷新间隔
+            while True:
+                if 表 is None:
+                    待通知.append(记录)
+                    break  # 有人在等刷新，立刻写
+                批次.append((表, 记录))
+                if len(批次) >= self.批量条数:
+                    break
+                try:
+                    表, 记录 = self._队列.get(timeout=max(0.0, 截止 - time.monotonic()))
+                except queue.Empty:
+                    break
+            self._写入批次(批次)
+            for 事件 in 待通知:
+                事件.set()
+
+    def _写入批次(self, 批次):
+        if not 批次:
+            return
+        分组 = {}
+        for 表, 记录 in 批次:
+            分组.setdefault(表, []).append(记录)
+        开始 = time.perf_counter()
+        with self._写入锁:
+            try:
+                with 数据库事务() as cursor:
+                    for 表, 记录列表 in 分组.items():
+                        cursor.executemany(后台写入语句[表], 记录列表)
+                self._指标["累计写入"] += len(批次)
+            except Exception as e:
+                self._指标["写入失败"] += len(批次)
+                带时间的日志打印(f"❌ [数据库-后台写入失败] {len(批次)} 条记录丢弃 | {e}")
+            finally:
+                for 表, 记录列表 in 分组.items():
+                    self._待写入[表] -= len(记录列表)
+        self._指标["批次数"] += 1
+        self._指标["最近批次条数"] = len(批次)
+        self._指标["最近刷新耗时ms"] = round((time.perf_counter() - 开始) * 1000, 2)
+
+后台写入 = 后台写入器()
+atexit.register(后台写入.刷新)
+
+def 获取后台写入指标():
+    """队列深度、累计写入数、最近一次刷新耗时等"""
+    return 后台写入.指标()
+
+# ===========================
+# 库维护 (WAL 检查点 / 增量回收 / optimize)
+# ===========================
+# 自动检查点 (wal_autocheckpoint, PASSIVE) 只把页回写进主库，-wal 文件不会变小；
+# 统计端一直在写，读者就要在越来越长的 WAL 里找页。库维护 线程 (统计端里跑) 每隔一段时间看一眼：
+#   - 库安静 (安静秒数 内 data_version 没变) -> TRUNCATE 检查点，WAL 截到 0，再按空闲页增量回收；
+#   - 不安静但 WAL 超过阈值 -> PASSIVE 检查点 (不等读者、不挡写入)；
+#   - 每隔 optimize间隔秒 跑一次 PRAGMA optimize。
+默认_库维护配置 = {
+    "检查间隔秒": 10,
+    "安静秒数": 5,
+    "WAL阈值MB": 8,
+    "回收阈值页": 1000,       # 空闲页超过这么多才回收
+    "每次回收页": 5000,
+    "optimize间隔秒": 3600,
+    "自动转换增量回收": False,  # 打开后 auto_vacuum 还是 NONE 的旧库安静时自动 VACUUM 一次；默认手动跑 转换增量回收.py
+}
+
+def WAL大小():
+    """-wal 文件字节数 (不存在算 0)"""
+    try:
+        return os.path.getsize(数据库文件 + "-wal")
+    except OSError:
+        return 0
+
+class 库维护器:
+    def __init__(self):
+        self._线程 = None
+        self._线程pid = None
+        self._启动锁 = threading.Lock()
+        self._数据版本 = None
+        self._最后变化 = time.monotonic()
+        self._上次optimize = time.monotonic()
+        self._已尝试转换 = False
+        self._配置 = None
+        self._指标 = {
+            "检查点": {模式: {"次数": 0, "累计ms": 0.0, "最大ms": 0.0} for 模式 in ("PASSIVE", "TRUNCATE")},
+            "最近检查点": None,
+            "回收页数": 0,
+            "optimize次数": 0,
+            "VACUUM转换ms": None,
+        }
+
+    @property
+    def 配置(self):
+        """配置.json -> 库维护 (第一次用到时读)"""
+        if self._配置 is None:
+            self._配置 = _读取配置段("库维护", 默认_库维护配置)
+        return self._配置
+
+    def 检查点(self, 模式="PASSIVE"):
+        """PRAGMA wal_checkpoint(模式)，返回 (busy, WAL帧数, 已回写帧数) 并记录耗时"""
+        开始 = time.perf_counter()
+        with 数据库_线程锁:
+            结果 = tuple(_获取写连接().execute(f"PRAGMA wal_checkpoint({模式})").fetchone())
+        耗时 = round((time.perf_counter() - 开始) * 1000, 2)
+        统计 = self._指标["检查点"].setdefault(模式, {"次数": 0, "累计ms": 0.0, "最大ms": 0.0})
+        统计["次数"] += 1
+        统计["累计ms"] = round(统计["累计ms"] + 耗时, 2)
+        统计["最大ms"] = max(统计["最大ms"], 耗时)
+        self._指标["最近检查点"] = {"模式": 模式, "耗时ms": 耗时, "busy": 结果[0], "WAL帧": 结果[1], "已回写帧": 结果[2],
+                                 "时间": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        return 结果
+
+    def 执行一次(self):
+        """检查一轮，返回做了的动作列表"""
+        配置 = self.配置
+        现在 = time.monotonic()
+        版本 = 获取读连接().execute("PRAGMA data_version").fetchone()[0]
+        if 版本 != self._数据版本:
+            self._数据版本, self._最后变化 = 版本, 现在
+        安静 = 现在 - self._最后变化 >= 配置["安静秒数"]
+        动作 = []
+
+        if 安静 and not self._已尝试转换 and 配置["自动转换增量回收"]:
+            self._已尝试转换 = True
+            try:
+                if self.转换增量回收() is not None:
+                    动作.append("VACUUM")
+            except RuntimeError as e:
+                带时间的日志打印(f"⚠️ [库维护] 跳过 auto_vacuum 转换: {e}")
+
+        if 安静:
+            空闲页 = 获取读连接().execute("PRAGMA freelist_count").fetchone()[0]
+            if 空闲页 >= 配置["回收阈值页"]:
+                with 数据库_线程锁:
+                    # incremental_vacuum 每 step 只回收一页，execute 只 step 一次；executescript 会跑到底
+                    _获取写连接().executescript(f"PRAGMA incremental_vacuum({int(配置['每次回收页'])});")
+                self._指标["回收页数"] += 空闲页 - 获取读连接().execute("PRAGMA freelist_count").fetchone()[0]
+                动作.append("incremental_vacuum")
+            if WAL大小() > 0:
+                self.检查点("TRUNCATE")
+                动作.append("TRUNCATE")
+        elif WAL大小() >= 配置["WAL阈值MB"] * 1024 * 1024:
+            self.检查点("PASSIVE")
+            动作.append("PASSIVE")
+
+        if 现在 - self._上次optimize >= 配置["optimize间隔秒"]:
+            with 数据库_线程锁:
+                _获取写连接().execute("PRAGMA optimize")
+            self._上次optimize = 现在
+            self._指标["optimize次数"] += 1
+            动作.append("optimize")
+        return 动作
+
+    def 转换增量回收(self, 余量倍数=2):
+        """auto_vacuum 还不是 INCREMENTAL 的旧库 VACUUM 一次转过去，返回耗时 ms；已经是了返回 None
+        VACUUM 整库重写，期间所有写入都要等；重写的页经 WAL 落盘，库目录剩余空间不到 余量倍数 x (库 + WAL) 时抛 RuntimeError"""
+        with 数据库_线程锁:
+            conn = _获取写连接()
+            # PRAGMA auto_vacuum 返回连接缓存的库头，别的连接转换过也看不到；先读一次库刷新
+            conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return None
+            需要 = 余量倍数 * (os.path.getsize(数据库文件) + WAL大小())
+            剩余 = shutil.disk_usage(os.path.dirname(os.path.abspath(数据库文件))).free
+            if 剩余 < 需要:
+                raise RuntimeError(f"磁盘剩余 {剩余 / 1e6:.0f}MB，VACUUM 需要约 {需要 / 1e6:.0f}MB")
+            开始 = time.perf_counter()
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")  # auto_vacuum 从 NONE 改过来必须整库重建一次
+        self._指标["VACUUM转换ms"] = round((time.perf_counter() - 开始) * 1000, 2)
+        带时间的日志打印(f"🧹 [库维护] auto_vacuum 已转为 INCREMENTAL (VACUUM {self._指标['VACUUM转换ms']}ms)")
+        return self._指标["VACUUM转换ms"]
+
+    def 指标(self):
+        cursor = 获取读连接().cursor()
+        return dict(
+            self._指标,
+            WAL字节=WAL大小(),
+            库字节=os.path.getsize(数据库文件) if os.path.exists(数据库文件) else 0,
+            空闲页=cursor.execute("PRAGMA freelist_count").fetchone()[0],
+            auto_vacuum={0: "NONE", 1: "FULL", 2: "INCREMENTAL"}.get(cursor.execute("PRAGMA auto_vacuum").fetchone()[0]),
+        )
+
+    def 启动(self):
+        """启动后台维护线程 (每个进程一个，重复调用无副作用)"""
+        with self._启动锁:
+            if self._线程 is None or self._线程pid != os.getpid() or not self._线程.is_alive():
+                self._线程 = threading.Thread(target=self._运行, name="库维护", daemon=True)
+                self._线程pid = os.getpid()
+                self._线程.start()
+
+    def _运行(self):
+        while True:
+            time.sleep(self.配置["检查间隔秒"])
+            try:
+                self.执行一次()
+            except Exception as e:
+                带时间的日志打印(f"❌ [库维护] {e}")
+
+库维护 = 库维护器()
+
+def 获取库维护指标():
+    """WAL 大小、各模式检查点次数/耗时、空闲页、回收页数等"""
+    return 库维护.指标()
+
+# ===========================
+# 冷热分层 (旧数据按月归档到独立库)
+# ===========================
+# 超过 热数据保留天数 的结算/聊天/日志搬到 archive/归档_YYYY-MM.db，主库只留近期数据，
+# 执行端每秒轮询的文件和它的 WAL 保持小巧。归档库是普通 (非 WAL) SQLite 文件，
+# 需要全量历史时用 遍历_历史库 / 查询_全历史 把主库和归档库一起查。
+# 按 主时间列 (*_ms) 判断冷热，月份按本地时间划分
+归档表 = ("settlements", "chat_history", "execution_logs")
+默认_热数据保留天数 = 90
+
+def _读取归档配置():
+    """配置.json -> 数据归档 段 (没有就用默认值)"""
+    return _读取配置段("数据归档", {"热数据保留天数": 默认_热数据保留天数, "归档目录": "archive"})
+
+def _归档目录():
+    目录 = _读取归档配置()["归档目录"]
+    return 目录 if os.path.isabs(目录) else os.path.join(os.path.dirname(数据库文件), 目录)
+
+def _归档文件(月份):
+    return os.path.join(_归档目录(), f"归档_{月份}.db")
+
+def _月份毫秒范围(月份):
+    """'YYYY-MM' -> [本月初, 下月初) 的 epoch 毫秒 (本地时间)"""
+    年, 月 = map(int, 月份.split("-"))
+    return 转毫秒(datetime.datetime(年, 月, 1)), 转毫秒(datetime.datetime(年 + 月 // 12, 月 % 12 + 1, 1))
+
+def 列出_归档月份(起始月=None, 结束月=None):
+    """已有的归档月份 ['2025-01', ...]，可按 'YYYY-MM' 闭区间筛选"""
+    目录 = _归档目录()
+    if not os.path.isdir(目录):
+        return []
+    月份列表 = sorted(f[3:10] for f in os.listdir(目录) if f.startswith("归档_") and f.endswith(".db"))
+    return [m for m in 月份列表 if (起始月 is None or m >= 起始月) and (结束月 is None or m <= 结束月)]
+
+def _同步归档表结构(cursor, 表):
+    """归档库里建同名表；主库后来加过的列也补上，保证 INSERT ... SELECT 列对得上"""
+    cursor.execute("SELECT sql FROM main.sqlite_master WHERE type='table' AND name=?", (表,))
+    建表语句 = cursor.fetchone()[0]
+    cursor.execute(f"CREATE TABLE IF NOT EXISTS arc.{表} {建表语句[建表语句.index('('):]}")
+    cursor.execute(f"PRAGMA arc.table_info({表})")
+    已有列 = {info[1] for info in cursor.fetchall()}
+    cursor.execute(f"PRAGMA main.table_info({表})")
+    列定义 = [(info[1], info[2]) for info in cursor.fetchall()]
+    for 列, 类型 in 列定义:
+        if 列 not in 已有列:
+            cursor.execute(f"ALTER TABLE arc.{表} ADD COLUMN {列} {类型}")
+    if any(毫秒列 not in 已有列 for _, 毫秒列, _ in 毫秒时间列[表]):
+        _回填毫秒列(cursor, 表, 库="arc")  # 迁移 007 之前建的归档库，旧行补上毫秒列
+    return [列 for 列, _ in 列定义]
+
+def 归档_冷数据(保留天数=None):
+    """把超过保留天数的行按月搬进归档库，返回 {表: 搬走行数}"""
+    if 保留天数 is None:
+        保留天数 = _读取归档配置()["热数据保留天数"]
+    截止 = 当前毫秒() - int(保留天数 * 86400_000)
+    os.makedirs(_归档目录(), exist_ok=True)
+    后台写入.刷新()  # 队列里的旧日志先落盘，免得漏搬
+
+    结果 = {}
+    for 表 in 归档表:
+        时间列 = 主时间列[表]
+        结果[表] = 0
+        cursor = 获取读连接().cursor()
+        cursor.execute(f"SELECT DISTINCT strftime('%Y-%m', {时间列} / 1000, 'unixepoch', 'localtime') FROM {表} WHERE {时间列} < ?", (截止,))
+        for (月份,) in cursor.fetchall():
+            if not 月份:
+                continue
+            月初, 下月初 = _月份毫秒范围(月份)
+            条件 = f"{时间列} >= ? AND {时间列} < ?"
+            参数 = (月初, min(下月初, 截止))
+            # WAL 模式下带 ATTACH 的事务跨库不是原子的 (崩溃后可能一个库提交了另一个没有)，分两个事务：
+            # 先拷到归档库并提交，再只删归档库里已有同 id 且内容一致的行。中途崩溃最多两边各留一份，不会丢
+            with 数据库事务(附加库={"arc": _归档文件(月份)}) as wcur:
+                列表 = _同步归档表结构(wcur, 表)
+                列 = ", ".join(列表)
+                wcur.execute(f"SELECT COUNT(*) FROM main.{表} WHERE {条件}", 参数)
+                待搬 = wcur.fetchone()[0]
+                wcur.execute(f"INSERT OR IGNORE INTO arc.{表} ({列}) SELECT {列} FROM main.{表} WHERE {条件}", 参数)
+                已拷 = wcur.rowcount
+            with 数据库事务(附加库={"arc": _归档文件(月份)}) as wcur:
+                一致 = " AND ".join(f"a.{c} IS m.{c}" for c in 列表)
+                wcur.execute(f'''
+                    DELETE FROM main.{表} WHERE rowid IN (
+                        SELECT m.rowid FROM main.{表} m JOIN arc.{表} a ON a.id = m.id AND {一致}
+                        WHERE m.{时间列} >= ? AND m.{时间列} < ?)
+                ''', 参数)
+                已删 = wcur.rowcount
+            if 已删 < 待搬:
+                # INSERT OR IGNORE 跳过的行：归档库里同 id 的是别的内容 (主库重建过)，留在主库人工处理
+                带时间的日志打印(f"⚠️ [数据库] 归档 {表} {月份}: {待搬} 行只拷过去 {已拷} 行，"
+                               f"{待搬 - 已删} 行与归档库 id 冲突，留在主库")
+            结果[表] += 已删
+
+    if any(结果.values()):
+        库维护.检查点("TRUNCATE")
+        带时间的日志打印(f"🗄️ [数据库] 冷数据归档完成 (早于 {毫秒转文本(截止)}): {结果}")
+    return 结果
+
+def 遍历_历史库(起始月=None, 结束月=None):
+    """依次产出 主库 和 各月归档库 的只读游标 (row_factory=sqlite3.Row)"""
+    cursor = 获取读连接().cursor()
+    cursor.row_factory = sqlite3.Row
+    yield cursor
+    for 月份 in 列出_归档月份(起始月, 结束月):
+        conn = sqlite3.connect(pathlib.Path(_归档文件(月份)).absolute().as_uri() + "?mode=ro", uri=True)
+        try:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            yield cursor
+        finally:
+            conn.close()
+
+def 查询_全历史(表, 条件="1=1", 参数=(), 起始月=None, 结束月=None):
+    """主库 + 归档库里满足条件的行 (dict)，按时间列倒序"""
+    时间列 = 主时间列[表]
+    结果 = []
+    for cursor in 遍历_历史库(起始月, 结束月):
+        try:
+            cursor.execute(f"SELECT * FROM {表} WHERE {条件}", 参数)
+        except sqlite3.OperationalError:
+            continue  # 这个月的归档库里没有这张表
+        结果.extend(dict(row) for row in cursor.fetchall())
+    结果.sort(key=lambda r: r.get(时间列) or 0, reverse=True)
+    return 结果
+
+def 查询_时间区间(表, 开始=None, 结束=None, 条件="1=1", 参数=(), 包含归档=False, limit=None, 行工厂=None):
+    """表里 [开始, 结束) 时间窗内满足条件的行 (dict)，按主时间列倒序，走 *_ms 索引。
+    开始/结束 接受 转毫秒 认识的任何值，None 表示不限；包含归档 时只打开时间窗覆盖到的月份
+    行工厂: 给了 (如 Signal.行工厂) 就返回记录对象而不是 dict (不含归档时)"""
+    时间列 = 主时间列[表]
+    开始, 结束 = 转毫秒(开始), 转毫秒(结束)
+    条件, 参数 = [条件], list(参数)
+    if 开始 is not None:
+        条件.append(f"{时间列} >= ?")
+        参数.append(开始)
+    if 结束 is not None:
+        条件.append(f"{时间列} < ?")
+        参数.append(结束)
+    条件 = " AND ".join(条件)
+    if 包含归档 and 表 in 归档表:
+        起始月 = 毫秒转文本(开始)[:7] if 开始 is not None else None
+        结束月 = 毫秒转文本(结束 - 1)[:7] if 结束 is not None else None
+        结果 = 查询_全历史(表, 条件, 参数, 起始月, 结束月)
+        return 结果[:limit] if limit else 结果
+    cursor = 获取读连接().cursor()
+    cursor.row_factory = 行工厂 or sqlite3.Row
+    if limit:
+        cursor.execute(f"SELECT * FROM {表} WHERE {条件} ORDER BY {时间列} DESC LIMIT ?", 参数 + [limit])
+    else:
+        cursor.execute(f"SELECT * FROM {表} WHERE {条件} ORDER BY {时间列} DESC", 参数)
+    if 行工厂:
+        return cursor.fetchall()
+    return [dict(row) for row in cursor.fetchall()]
+
+# ===========================
+# 变更跟踪 (别再整表轮询)
+# ===========================
+# change_seq 由触发器维护 (迁移 004)。先看只读连接的 PRAGMA data_version：
+# 别的连接没提交过就连 change_seq 都不用查；变了再比对关心的表的序号，序号没变就返回上次的结果。
+def 读取_变更序号(*表):
+    """返回 {键: 序号}，键见 _迁移_004_变更序号 (不传参数返回全部)"""
+    cursor = 获取读连接().cursor()
+    if 表:
+        cursor.execute(f"SELECT tbl, seq FROM change_seq WHERE tbl IN ({','.join('?' * len(表))})", 表)
+    else:
+        cursor.execute("SELECT tbl, seq FROM change_seq")
+    return dict(cursor.fetchall())
+
+class 变更缓存:
+    """读取函数() 的结果按表的变更序号缓存；返回的是缓存对象，调用方不要修改。
+    读取函数出错时常常吞掉异常返回空结果，所以最多缓存 最长缓存秒数 就强制重读一次兜底。"""
+    def __init__(self, 读取函数, *表, 最长缓存秒数=30):
+        self.读取函数 = 读取函数
+        self.表 = 表
+        self.最长缓存秒数 = 最长缓存秒数
+        self._数据版本 = None
+        self._序号 = None
+        self._结果 = None
+        self._读取时刻 = 0.0
+        self.命中 = 0
+        self.重读 = 0
+
+    def _未变化(self):
+        """True 表示可以直接用缓存；顺带记录最新的 data_version / 序号"""
+        if self._序号 is None or time.monotonic() - self._读取时刻 > self.最长缓存秒数:
+            return False
+        conn = 获取读连接()
+        数据版本 = (id(conn), conn.execute("PRAGMA data_version").fetchone()[0])
+        if 数据版本 == self._数据版本:
+            return True
+        self._数据版本 = 数据版本
+        return 读取_变更序号(*self.表) == self._序号
+
+    def 获取(self):
+        try:
+            if self._未变化():
+                self.命中 += 1
+                return self._结果
+            conn = 获取读连接()
+            数据版本 = (id(conn), conn.execute("PRAGMA data_version").fetchone()[0])
+            序号 = 读取_变更序号(*self.表)
+        except sqlite3.Error:
+            return self.读取函数()  # change_seq 读不到 (库未迁移等)，退回每次直读
+        self._结果 = self.读取函数()
+        self._数据版本, self._序号, self._读取时刻 = 数据版本, 序号, time.monotonic()
+        self.重读 += 1
+        return self._结果
+
+def 读取_新增行(表, 起始id):
+    """id > 起始id 的行 (dict)，给追加型表做增量读取"""
+    cursor = 获取读连接().cursor()
+    cursor.row_factory = sqlite3.Row
+    cursor.execute(f"SELECT * FROM {表} WHERE id > ? ORDER BY id", (起始id,))
+    return [dict(row) for row in cursor.fetchall()]
+
+class 增量表缓存:
+    """追加型表 (settlements) 的全部行：只新增时按 id 增量追加，有删改 (含冷数据归档) 才整表重读"""
+    def __init__(self, 表):
+        self.表 = 表
+        self._序号 = None
+        self.行 = []
+        self._最大id = 0
+
+    def 获取(self):
+        """返回 (全部行, 本次是否有变化)"""
+        序号 = 读取_变更序号(self.表, f"{self.表}.删改")
+        if 序号 == self._序号:
+            return self.行, False
+        if self._序号 is None or 序号[f"{self.表}.删改"] != self._序号[f"{self.表}.删改"]:
+            self.行 = 读取_新增行(self.表, 0)
+        else:
+            self.行 = self.行 + 读取_新增行(self.表, self._最大id)
+        self._最大id = self.行[-1]["id"] if self.行 else 0
+        self._序号 = 序号
+        return self.行, True
+
+# ===========================
+# 行对象 (__slots__ 记录，JSON 列首次访问才解析)
+# ===========================
+# 代替 dict(row)：每行不再带一个 dict，exit_conditions 之类的 JSON 列不读就不 json.loads。
+# 兼容旧写法：row['ticket'] / row.get('x') / dict(row) 照常可用；要交给 jsonify 时用 转字典()。
+class _懒JSON:
+    """JSON 列描述符：原文存在 _列名_原文，第一次访问时解析并缓存 (解析失败保留原文，同旧逻辑)"""
+    def __init__(self, 列名):
+        self.原文槽 = f"_{列名}_原文"
+        self.缓存槽 = f"_{列名}_值"
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.缓存槽)
+        except AttributeError:
+            原文 = getattr(obj, self.原文槽, None)
+            try:
+                值 = json.loads(原文)
+            except (TypeError, ValueError):
+                值 = 原文
+            setattr(obj, self.缓存槽, 值)
+            return 值
+
+    def __set__(self, obj, 值):
+        setattr(obj, self.缓存槽, 值)
+
+class _记录:
+    __slots__ = ("_额外",)
+    字段 = ()          # 表里的列 (按建表顺序)
+    JSON字段 = ()      # 其中存 JSON 文本、需要懒解析的列
+
+    def __init_subclass__(cls, **kw):
+        super().__init_subclass__(**kw)
+        for 列 in cls.JSON字段:
+            setattr(cls, 列, _懒JSON(列))
+        cls._槽名 = {列: (f"_{列}_原文" if 列 in cls.JSON字段 else 列) for 列 in cls.字段}
+        cls._描述缓存 = (None, None)
+
+    @classmethod
+    def 行工厂(cls, cursor, row):
+        """给 cursor.row_factory 用；同一次查询只算一次 列 -> 槽 的对应"""
+        描述, 槽列表 = cls._描述缓存
+        if 描述 is not cursor.description:
+            描述 = cursor.description
+            槽列表 = tuple((d[0], cls._槽名.get(d[0])) for d in 描述)
+            cls._描述缓存 = (描述, 槽列表)
+        return cls(row, 槽列表)
+
+    def __init__(self, row, 槽列表):
+        """槽列表: 查询结果每一列的 (列名, 槽名)；表后来加的列 / 查询里的计算列没有槽，放进 _额外"""
+        额外 = None
+        for (列, 槽), 值 in zip(槽列表, row):
+            if 槽 is not None:
+                setattr(self, 槽, 值)
+            else:
+                if 额外 is None:
+                    额外 = {}
+                额外[列] = 值
+        self._额外 = 额外
+
+    def keys(self):
+        键 = [列 for 列 in self.字段 if hasattr(self, self._槽名[列])]
+        return 键 + list(self._额外 or ())
+
+    def __getitem__(self, 键):
+        if 键 in self._槽名:
+            try:
+                return getattr(self, 键)
+            except AttributeError:
+                pass
+        elif self._额外 and 键 in self._额外:
+            return self._额外[键]
+        raise KeyError(键)
+
+    def __setitem__(self, 键, 值):
+        if 键 in self._槽名:
+            setattr(self, 键, 值)
+        else:
+            if self._额外 is None:
+                self._额外 = {}
+            self._额外[键] = 值
+
+    def __contains__(self, 键):
+        return 键 in self.keys()
+
+    def get(self, 键, 默认=None):
+        try:
+            return self[键]
+        except KeyError:
+            return 默认
+
+    def 转字典(self):
+        return {键: self[键] for 键 in self.keys()}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.转字典()!r})"
+
+def _定义记录(名称, 字段, JSON字段=()):
+    """按字段表生成 __slots__ 记录类 (JSON 列占两个槽：原文 + 解析结果)"""
+    槽 = []
+    for 列 in 字段:
+        槽 += [f"_{列}_原文", f"_{列}_值"] if 列 in JSON字段 else [列]
+    return type(名称, (_记录,), {"__slots__": tuple(槽), "字段": tuple(字段), "JSON字段": tuple(JSON字段)})
+
+ActivePosition = _定义记录("ActivePosition", (
+    "ticket", "signal_id", "kol_name", "symbol", "direction", "entry_price", "volume", "tp_goal",
+    "exit_conditions", "status", "current_price", "unrealized_pnl", "last_update", "last_update_ms",
+    "exit_tp", "exit_sl",
+), JSON字段=("exit_conditions",))
+Command = _定义记录("Command", (
+    "id", "signal_id", "kol_name", "symbol", "direction", "volume", "price", "sl", "tp", "status",
+    "mt5_ticket", "created_at", "error_msg", "state", "claimed_by", "lease_until", "attempts", "created_ms",
+))
+Settlement = _定义记录("Settlement", (
+    "id", "signal_id", "kol_name", "symbol", "direction", "volume", "entry_price", "exit_price",
+    "profit", "close_time", "hold_duration", "close_ms",
+))
+Signal = _定义记录("Signal", (
+    "id", "timestamp", "kol_name", "symbol", "direction", "entry_mode", "entry_price", "tp_sl_config",
+    "status", "cancel_time", "cancel_reason", "ts_ms", "cancel_ms",
+    "sl", "tp_count", "first_tp", "last_tp", "sl_distance",
+), JSON字段=("tp_sl_config",))
+
 # ===========================
 # 写入与读取 - 信号与命令 (新逻辑)
 # ===========================
@@ -187,19 +1284,15 @@ def 初始化数据库():
 def 写入_父信号(kol_name, symbol, direction, entry_mode, entry_price, tp_sl_config):
     """(决策端用) 记录原始信号，返回 signal_id"""
     try:
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        now, now_ms = _现在()
         config_str = json.dumps(tp_sl_config, ensure_ascii=False)
         
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
+        with 数据库事务() as cursor:
             cursor.execute('''
-                INSERT INTO shadow_signals (timestamp, kol_name, symbol, direction, entry_mode, entry_price, tp_sl_config, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, '等待执行')
-            ''', (now, kol_name, symbol, direction, entry_mode, entry_price, config_str))
-            conn.commit()
+                INSERT INTO shadow_signals (timestamp, ts_ms, kol_name, symbol, direction, entry_mode, entry_price, tp_sl_config, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, '等待执行')
+            ''', (now, now_ms, kol_name, symbol, direction, entry_mode, entry_price, config_str))
             signal_id = cursor.lastrowid
-            conn.close()
         return signal_id
 
     except Exception as e:
@@ -210,15 +1303,11 @@ def 写入_父信号(kol_name, symbol, direction, entry_mode, entry_price, tp_sl
 def 写入_子命令(signal_id, kol_name, symbol, direction, volume, price, sl, tp):
     """(决策端用) 拆单后，将具体的下单指令写入队列"""
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
+        with 数据库事务() as cursor:
             cursor.execute('''
-                INSERT INTO command_queue (signal_id, kol_name, symbol, direction, volume, price, sl, tp, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, '待执行')
-            ''', (signal_id, kol_name, symbol, direction, volume, price, sl, tp))
-            conn.commit()
-            conn.close()
+                INSERT INTO command_queue (signal_id, kol_name, symbol, direction, volume, price, sl, tp, status, created_ms)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, '待执行', ?)
+            ''', (signal_id, kol_name, symbol, direction, volume, price, sl, tp, 当前毫秒()))
         
         # [Debug] 确认写入成功
         # 带时间的日志打印(f"💾 [DB-子命令] 已入队: Signal_{signal_id} | {symbol} {direction} {volume}手 @ {price} (TP:{tp})")
@@ -227,34 +1316,168 @@ def 写入_子命令(signal_id, kol_name, symbol, direction, volume, price, sl,
         带时间的日志打印(f"❌ [数据库-写入子命令失败] {e}")
         带时间的日志打印(traceback.format_exc())
 
-def 读取_待执行命令():
-    """(执行端用) 获取所有待下单的指令"""
+def 写入_信号及子命令(kol_name, symbol, direction, entry_mode, entry_price, tp_sl_config, 子命令列表, 消息键=None):
+    """
+    (决策端用) 父信号 + 全部子命令在同一个事务里写入，返回 signal_id (失败返回 -1)
+    子命令列表: [(direction, volume, price, sl, tp), ...]
+    一次提交只有一次 fsync，执行端也不会读到只写了一半的信号
+    消息键: 侦察兵的 message_id，同一个事务里记进 processed_messages，下单和 "已处理" 要么都在要么都不在
+    """
     try:
-        tasks = []
-        with 数据库_线程锁:
-            conn = 获取连接()
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM command_queue WHERE status = '待执行'")
+        now, now_ms = _现在()
+        config_str = json.dumps(tp_sl_config, ensure_ascii=False)
+
+        with 数据库事务() as cursor:
+            cursor.execute('''
+                INSERT INTO shadow_signals (timestamp, ts_ms, kol_name, symbol, direction, entry_mode, entry_price, tp_sl_config, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, '等待执行')
+            ''', (now, now_ms, kol_name, symbol, direction, entry_mode, entry_price, config_str))
+            signal_id = cursor.lastrowid
+
+            cursor.executemany('''
+                INSERT INTO command_queue (signal_id, kol_name, symbol, direction, volume, price, sl, tp, status, created_ms)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, '待执行', ?)
+            ''', [(signal_id, kol_name, symbol, 子方向, volume, price, sl, tp, now_ms) for 子方向, volume, price, sl, tp in 子命令列表])
+            if 消息键:
+                cursor.execute("INSERT OR IGNORE INTO processed_messages (msg_key, is_signal, signal_id, done_ms) VALUES (?, 1, ?, ?)",
+                               (消息键, signal_id, now_ms))
+        return signal_id
+
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-写入信号及子命令失败] {e}")
+        带时间的日志打印(traceback.format_exc())
+        return -1
+
+def 写入_已处理消息(消息键, 是否信号):
+    """(决策端用) 没下单的消息 (闲聊、风控拦截、被忽略的补充) 处理完记一条；已经记过 (下单事务里) 不覆盖"""
+    with 数据库事务() as cursor:
+        cursor.execute("INSERT OR IGNORE INTO processed_messages (msg_key, is_signal, done_ms) VALUES (?, ?, ?)",
+                       (消息键, int(bool(是否信号)), 当前毫秒()))
+
+def 查询_已处理消息(消息键):
+    """处理过返回 {"is_signal", "signal_id", "done_ms"}，没处理过返回 None"""
+    cursor = 获取读连接().cursor()
+    cursor.execute("SELECT is_signal, signal_id, done_ms FROM processed_messages WHERE msg_key = ?", (消息键,))
+    行 = cursor.fetchone()
+    return dict(zip(("is_signal", "signal_id", "done_ms"), 行)) if 行 else None
+
+def 清理_已处理消息(保留天数=7):
+    """侦察兵的发件箱最多重投 过期秒 (默认 15 分钟)，几天前的记录用不上了；返回删除条数"""
+    with 数据库事务() as cursor:
+        cursor.execute("DELETE FROM processed_messages WHERE done_ms < ?", (当前毫秒() - 保留天数 * 86_400_000,))
+        return cursor.rowcount
+
+# ===========================
+# 命令领取 (多个执行端并行消费 command_queue)
+# ===========================
+# 待执行 --领取--> 执行中 (claimed_by / lease_until) --完成--> 已执行 / 失败
+#                     └─ 租约过期 (执行端崩溃) 后可被任何执行端重新领取
+# 领取是一条 UPDATE ... RETURNING，同一条命令不会同时发给两个执行端。
+# 执行端一次领一条，下单前 续租_命令 确认租约还在；完成 / 失败只改自己领着的命令。
+# 过期重领 (attempts > 1) 意味着上一个执行端可能已经下过单，执行端先按下单备注去 MT5 查。
+默认_租约秒数 = 60
+_可领取命令SQL = """
+    SELECT id FROM command_queue WHERE status = '待执行' {额外条件}
+    UNION ALL
+    SELECT id FROM command_queue WHERE status = '执行中' AND lease_until < ? {额外条件}
+"""
+
+def 生成_执行端标识():
+    import socket
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def 有可领取命令(品种=None):
+    """只读检查，没有可领取的命令时执行端不用去抢写锁"""
+    try:
+        额外条件, 参数 = ("AND symbol = ?", [品种]) if 品种 else ("", [])
+        sql = _可领取命令SQL.format(额外条件=额外条件)
+        cursor = 获取读连接().cursor()
+        cursor.execute(f"SELECT EXISTS ({sql})", 参数 + [time.time()] + 参数)
+        return bool(cursor.fetchone()[0])
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-检查可领取命令失败] {e}")
+        return False
+
+def 领取_待执行命令(执行端标识, 数量=10, 租约秒数=默认_租约秒数, 品种=None, 起始ID=None):
+    """原子领取最多 数量 条命令 (按 id 顺序，含租约过期的)，返回 [Command]；品种 不为空时只领该品种
+    起始ID: 只领 id 比它大的 (执行端一轮里逐条领取时跳过本轮处理过 / 放回去的命令)"""
+    try:
+        现在 = time.time()
+        条件, 参数 = [], []
+        if 品种:
+            条件.append("AND symbol = ?"); 参数.append(品种)
+        if 起始ID is not None:
+            条件.append("AND id > ?"); 参数.append(起始ID)
+        额外条件 = " ".join(条件)
+        with 数据库事务() as cursor:
+            cursor.row_factory = Command.行工厂
+            # UPDATE ... LIMIT 需要编译开关，这里用 id IN (子查询 LIMIT)
+            cursor.execute(f'''
+                UPDATE command_queue
+                SET status = '执行中', claimed_by = ?, lease_until = ?, attempts = IFNULL(attempts, 0) + 1
+                WHERE id IN (SELECT id FROM ({_可领取命令SQL.format(额外条件=额外条件)}) ORDER BY id LIMIT ?)
+                RETURNING *
+            ''', [执行端标识, 现在 + 租约秒数] + 参数 + [现在] + 参数 + [数量])
             rows = cursor.fetchall()
-            for r in rows: tasks.append(dict(r))
-            conn.close()
-        return tasks
+        return sorted(rows, key=lambda r: r.id)
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-领取命令失败] {e}")
+        return []
+
+def 释放_命令(cmd_id, 执行端标识):
+    """领了但这轮没法执行 (如暂时没有报价)，放回 待执行；领取时加的 attempts 退回去，
+    attempts > 1 只表示租约真的过期过 (执行端据此去 MT5 查是否已下过单)"""
+    try:
+        with 数据库事务() as cursor:
+            cursor.execute('''
+                UPDATE command_queue SET status = '待执行', claimed_by = NULL, lease_until = NULL,
+                                         attempts = MAX(IFNULL(attempts, 1) - 1, 0)
+                WHERE id = ? AND status = '执行中' AND claimed_by = ?
+            ''', (cmd_id, 执行端标识))
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-释放命令失败] ID:{cmd_id} | {e}")
+
+def 续租_命令(cmd_id, 执行端标识, 租约秒数=默认_租约秒数):
+    """下单前调用：租约还在就延长并返回 True；已过期被别人领走返回 False，不要再下单"""
+    try:
+        with 数据库事务() as cursor:
+            cursor.execute('''
+                UPDATE command_queue SET lease_until = ?
+                WHERE id = ? AND status = '执行中' AND claimed_by = ?
+            ''', (time.time() + 租约秒数, cmd_id, 执行端标识))
+            return cursor.rowcount > 0
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-续租命令失败] ID:{cmd_id} | {e}")
+        return False
+
+def 读取_待执行命令():
+    """(执行端用) 获取所有待下单的指令 [Command]"""
+    try:
+        cursor = 获取读连接().cursor()
+        cursor.row_factory = Command.行工厂
+        cursor.execute("SELECT * FROM command_queue WHERE status = '待执行'")
+        return cursor.fetchall()
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-读取命令失败] {e}")
         return []
 
-def 标记_命令已执行(cmd_id, ticket):
-    """(执行端用) 标记命令完成，回填 Ticket"""
+def _自己领着的(执行端标识):
+    """标记完成 / 失败的附加条件：给了 执行端标识 时只改自己租约下的命令"""
+    if 执行端标识 is None:
+        return "", []
+    return " AND status='执行中' AND claimed_by=?", [执行端标识]
+
+def 标记_命令已执行(cmd_id, ticket, 执行端标识=None):
+    """(执行端用) 标记命令完成，回填 Ticket，清掉租约；租约已被别人领走时不改，返回 False"""
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
-            cursor.execute("UPDATE command_queue SET status='已执行', mt5_ticket=? WHERE id=?", (ticket, cmd_id))
-            conn.commit()
-            conn.close()
+        条件, 参数 = _自己领着的(执行端标识)
+        with 数据库事务() as cursor:
+            cursor.execute(f"UPDATE command_queue SET status='已执行', mt5_ticket=?, lease_until=NULL WHERE id=?{条件}",
+                           [ticket, cmd_id] + 参数)
+            return cursor.rowcount > 0
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-标记执行失败] ID:{cmd_id} Ticket:{ticket} | {e}")
+        return False
 
 # ===========================
 # 持仓管理与清理逻辑 (核心升级)
@@ -263,9 +1486,7 @@ def 标记_命令已执行(cmd_id, ticket):
 def 写入_持仓记录(ticket, signal_id, kol_name, symbol, direction, entry_price, volume, tp_goal, exit_conditions, status="持仓中"):
     """(执行端用) 下单成功后记录"""
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
+        with 数据库事务() as cursor:
             
             exit_str = json.dumps(exit_conditions, ensure_ascii=False)
             
@@ -274,9 +1495,7 @@ def 写入_持仓记录(ticket, signal_id, kol_name, symbol, direction, entry_pr
                 (ticket, signal_id, kol_name, symbol, direction, entry_price, volume, tp_goal, exit_conditions, status)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (ticket, signal_id, kol_name, symbol, direction, entry_price, volume, tp_goal, exit_str, status))
-            
-            conn.commit()
-            conn.close()
+
         # 带时间的日志打印(f"📝 [DB-持仓] 已登记 Ticket: {ticket} (Signal: {signal_id})")
     
     except Exception as e:
@@ -287,42 +1506,25 @@ def 查询_KOL活跃Ticket(kol_name):
     """(决策端用) 获取该 KOL 所有正在持仓或挂单的 Ticket，用于清理旧单"""
     try:
         tickets = []
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
-            cursor.execute("SELECT ticket FROM active_positions WHERE kol_name = ?", (kol_name,))
-            rows = cursor.fetchall()
-            for r in rows: tickets.append(r[0])
-            conn.close()
+        cursor = 获取读连接().cursor()
+        cursor.execute("SELECT ticket FROM active_positions WHERE kol_name = ?", (kol_name,))
+        rows = cursor.fetchall()
+        for r in rows: tickets.append(r[0])
         return tickets
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-查询活跃Ticket失败] {e}")
         return []
 
 def 读取_所有活跃持仓():
-    """(执行端用) 获取所有活跃持仓记录"""
+    """(执行端用) 获取所有活跃持仓记录 [ActivePosition]，exit_conditions 首次访问时才解析"""
     try:
-        positions = []
-        with 数据库_线程锁:
-            conn = 获取连接()
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-
-            # [修复] 移除status过滤,读取所有记录
-            # 原因: 数据库中实际值是'监盘中',导致查询不到记录
-            cursor.execute("SELECT * FROM active_positions")
-            rows = cursor.fetchall()
+        cursor = 获取读连接().cursor()
+        cursor.row_factory = ActivePosition.行工厂
 
-            for row in rows:
-                pos = dict(row)
-                try:
-                    pos['exit_conditions'] = json.loads(pos['exit_conditions'])
-                    positions.append(pos)
-                except:
-                    # JSON解析失败也保留记录
-                    positions.append(pos)
-            conn.close()
-        return positions
+        # [修复] 移除status过滤,读取所有记录
+        # 原因: 数据库中实际值是'监盘中',导致查询不到记录
+        cursor.execute("SELECT * FROM active_positions")
+        return cursor.fetchall()
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-读取活跃持仓失败] {e}")
         return []
@@ -331,22 +1533,19 @@ def 查询_KOL挂单(kol_name, symbol=None):
     """(执行端用) 获取该 KOL 的所有挂单 (command_queue 中 state='挂单')"""
     try:
         orders = []
-        with 数据库_线程锁:
-            conn = 获取连接()
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+        cursor = 获取读连接().cursor()
+        cursor.row_factory = sqlite3.Row
             
-            sql = "SELECT mt5_ticket, symbol FROM command_queue WHERE kol_name=? AND status='已执行' AND state='挂单'"
-            params = [kol_name]
+        sql = "SELECT mt5_ticket, symbol FROM command_queue WHERE kol_name=? AND status='已执行' AND state='挂单'"
+        params = [kol_name]
             
-            if symbol and symbol.upper() != "ALL":
-                sql += " AND symbol=?"
-                params.append(symbol)
+        if symbol and symbol.upper() != "ALL":
+            sql += " AND symbol=?"
+            params.append(symbol)
                 
-            cursor.execute(sql, params)
-            rows = cursor.fetchall()
-            for r in rows: orders.append(dict(r))
-            conn.close()
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+        for r in rows: orders.append(dict(r))
         return orders
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-查询挂单失败] {e}")
@@ -355,13 +1554,9 @@ def 查询_KOL挂单(kol_name, symbol=None):
 def 移除_持仓记录(ticket):
     """(执行端用) 平仓后移除"""
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
+        with 数据库事务() as cursor:
             # [关键修改 2] 强制类型转换为 int，防止因字符串不匹配导致删不掉
             cursor.execute("DELETE FROM active_positions WHERE ticket = ?", (int(ticket),))
-            conn.commit()
-            conn.close()
         带时间的日志打印(f"🗑️ [DB] 已移除僵尸单 Ticket:{ticket}")
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-移除持仓失败] {e}")
@@ -370,33 +1565,111 @@ def 移除_持仓记录(ticket):
 # 结算与日志 (保留)
 # ===========================
 
+# ===========================
+# KOL 战绩汇总 (kol_stats / kol_symbol_daily)
+# ===========================
+# 榜单查询只读汇总表，代价只跟 KOL 数有关。汇总是全部历史 (含已归档的冷数据)：
+# 冷数据归档只搬 settlements 的行，不动汇总。手工改过 settlements 后跑 重建统计.py。
+_汇总_KOL统计语句 = '''
+    SELECT IFNULL(kol_name, ''), COUNT(*), SUM(CASE WHEN profit > 0 THEN 1 ELSE 0 END), IFNULL(SUM(profit), 0), MAX(close_time)
+    FROM settlements GROUP BY 1
+'''
+_汇总_每日统计语句 = '''
+    SELECT IFNULL(kol_name, ''), IFNULL(substr(close_time, 1, 10), ''), IFNULL(symbol, ''),
+           COUNT(*), SUM(CASE WHEN profit > 0 THEN 1 ELSE 0 END), IFNULL(SUM(profit), 0)
+    FROM settlements GROUP BY 1, 2, 3
+'''
+
+def _累加KOL统计(cursor, 统计行, 每日行):
+    """统计行: [(kol_name, 单数, 胜单, 盈亏, 最近平仓时间)]  每日行: [(kol_name, 日期, symbol, 单数, 胜单, 盈亏)]
+    键为 NULL 的按 '' 记，和 重建 时的 IFNULL 一致 (NULL 主键不会触发 ON CONFLICT，会一单一行)"""
+    cursor.executemany('''
+        INSERT INTO kol_stats (kol_name, total_trades, win_count, total_profit, last_close_time)
+        VALUES (IFNULL(?, ''), ?, ?, ?, ?)
+        ON CONFLICT(kol_name) DO UPDATE SET
+            total_trades = total_trades + excluded.total_trades,
+            win_count = win_count + excluded.win_count,
+            total_profit = total_profit + excluded.total_profit,
+            last_close_time = MAX(IFNULL(last_close_time, ''), IFNULL(excluded.last_close_time, ''))
+    ''', 统计行)
+    cursor.executemany('''
+        INSERT INTO kol_symbol_daily (kol_name, day, symbol, trades, wins, profit)
+        VALUES (IFNULL(?, ''), IFNULL(?, ''), IFNULL(?, ''), ?, ?, ?)
+        ON CONFLICT(kol_name, day, symbol) DO UPDATE SET
+            trades = trades + excluded.trades,
+            wins = wins + excluded.wins,
+            profit = profit + excluded.profit
+    ''', 每日行)
+
+def _重建KOL统计(cursor):
+    """在写事务里清空汇总表，从主库和全部归档库重新汇总 (持有写锁，归档不会同时搬数据)"""
+    cursor.execute("DELETE FROM kol_stats")
+    cursor.execute("DELETE FROM kol_symbol_daily")
+    cursor.execute(_汇总_KOL统计语句)
+    统计行 = [tuple(r) for r in cursor.fetchall()]
+    cursor.execute(_汇总_每日统计语句)
+    _累加KOL统计(cursor, 统计行, [tuple(r) for r in cursor.fetchall()])
+    for 月份 in 列出_归档月份():
+        conn = sqlite3.connect(pathlib.Path(_归档文件(月份)).absolute().as_uri() + "?mode=ro", uri=True)
+        try:
+            统计行 = conn.execute(_汇总_KOL统计语句).fetchall()
+            每日行 = conn.execute(_汇总_每日统计语句).fetchall()
+        except sqlite3.OperationalError:
+            continue  # 这个月的归档库里没有 settlements
+        finally:
+            conn.close()
+        _累加KOL统计(cursor, 统计行, 每日行)
+
+def 重建_KOL统计():
+    """从 settlements (含归档) 重新生成汇总表，返回 KOL 数"""
+    with 数据库事务() as cursor:
+        _重建KOL统计(cursor)
+        cursor.execute("SELECT COUNT(*) FROM kol_stats")
+        return cursor.fetchone()[0]
+
+def 查询_KOL每日战绩(kol_name=None, 起始日=None, 结束日=None):
+    """kol×品种×日 的汇总行 (dict)，日期为 'YYYY-MM-DD' 闭区间"""
+    try:
+        条件, 参数 = [], []
+        if kol_name is not None:
+            条件.append("kol_name = ?"); 参数.append(kol_name)
+        if 起始日:
+            条件.append("day >= ?"); 参数.append(起始日)
+        if 结束日:
+            条件.append("day <= ?"); 参数.append(结束日)
+        cursor = 获取读连接().cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(f"SELECT * FROM kol_symbol_daily {'WHERE ' + ' AND '.join(条件) if 条件 else ''} ORDER BY kol_name, day, symbol", 参数)
+        return [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-查询每日战绩失败] {e}")
+        return []
+
 def 归档_结算记录(signal_id, kol_name, symbol, direction, volume, entry_price, exit_price, profit, open_time_str=""):
     """(执行端用) 平仓后，将战绩写入历史表"""
     try:
-        now = datetime.datetime.now()
-        close_time_str = now.strftime("%Y-%m-%d %H:%M:%S")
+        close_time_str, close_ms = _现在()
         
-        # 计算持仓时间
+        # 计算持仓时间 (total_seconds：超过一天的单子 .seconds 会丢掉整天)
         duration = 0
         if open_time_str:
             try:
-                open_time = datetime.datetime.strptime(open_time_str, "%Y-%m-%d %H:%M:%S")
-                duration = (now - open_time).seconds
+                duration = int((close_ms - 转毫秒(open_time_str)) / 1000)
             except:
                 pass
 
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
+        with 数据库事务() as cursor:
             
             cursor.execute('''
                 INSERT INTO settlements 
-                (signal_id, kol_name, symbol, direction, volume, entry_price, exit_price, profit, close_time, hold_duration)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (signal_id, kol_name, symbol, direction, volume, entry_price, exit_price, profit, close_time_str, duration))
+                (signal_id, kol_name, symbol, direction, volume, entry_price, exit_price, profit, close_time, close_ms, hold_duration)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (signal_id, kol_name, symbol, direction, volume, entry_price, exit_price, profit, close_time_str, close_ms, duration))
+            # 同一事务累加汇总表
+            胜 = 1 if (profit or 0) > 0 else 0
+            _累加KOL统计(cursor, [(kol_name, 1, 胜, profit or 0, close_time_str)],
+                        [(kol_name, close_time_str[:10], symbol, 1, 胜, profit or 0)])
             
-            conn.commit()
-            conn.close()
         带时间的日志打印(f"💰 [战绩归档] {kol_name} | {symbol} | 盈亏: {profit}")
     
     except Exception as e:
@@ -404,68 +1677,156 @@ def 归档_结算记录(signal_id, kol_name, symbol, direction, volume, entry_pr
         带时间的日志打印(traceback.format_exc())
 
 def 写入_执行日志(action, details):
-    """记录流水账"""
+    """记录流水账 (进后台写入队列，立即返回)"""
     try:
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO execution_logs (time, action, details) VALUES (?, ?, ?)", (now, action, details))
-            conn.commit()
-            conn.close()
+        now, now_ms = _现在()
+        后台写入.提交("execution_logs", (now, now_ms, action, details))
     except:
         pass # 日志写入失败就算了，别炸主程序
 
+def 读取_最近结算(limit=50):
+    """最近平仓的结算记录 [Settlement]"""
+    try:
+        cursor = 获取读连接().cursor()
+        cursor.row_factory = Settlement.行工厂
+        cursor.execute("SELECT * FROM settlements ORDER BY close_ms DESC LIMIT ?", (limit,))
+        return cursor.fetchall()
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-读取结算失败] {e}")
+        return []
+
+def 查询_结算区间(开始=None, 结束=None, kol_name=None, 包含归档=False, limit=None):
+    """(统计端/仪表盘用) [开始, 结束) 之间平仓的结算 (dict)，可只看某个 KOL，按平仓时间倒序"""
+    try:
+        if kol_name:
+            return 查询_时间区间("settlements", 开始, 结束, "kol_name = ?", (kol_name,), 包含归档, limit)
+        return 查询_时间区间("settlements", 开始, 结束, 包含归档=包含归档, limit=limit)
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-查询结算区间失败] {e}")
+        return []
+
+def 查询_信号区间(开始=None, 结束=None, kol_name=None, limit=None):
+    """[开始, 结束) 之间收到的父信号 [Signal]，可只看某个 KOL，按时间倒序；tp_sl_config 首次访问时才解析"""
+    try:
+        if kol_name:
+            return 查询_时间区间("shadow_signals", 开始, 结束, "kol_name = ?", (kol_name,), limit=limit, 行工厂=Signal.行工厂)
+        return 查询_时间区间("shadow_signals", 开始, 结束, limit=limit, 行工厂=Signal.行工厂)
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-查询信号区间失败] {e}")
+        return []
+
+def 查询_信号止盈止损(开始=None, 结束=None, kol_name=None, 最少止盈数=None, 最大止损距离=None, limit=None):
+    """(统计端用) 按止盈止损生成列 (sl / tp_count / first_tp / last_tp / sl_distance) 筛选父信号 [Signal]，按时间倒序"""
+    try:
+        条件, 参数 = ["1=1"], []
+        for 片段, 值 in (("kol_name = ?", kol_name), ("tp_count >= ?", 最少止盈数), ("sl_distance <= ?", 最大止损距离)):
+            if 值 is not None:
+                条件.append(片段)
+                参数.append(值)
+        return 查询_时间区间("shadow_signals", 开始, 结束, " AND ".join(条件), 参数, limit=limit, 行工厂=Signal.行工厂)
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-查询信号止盈止损失败] {e}")
+        return []
+
+def 查询_KOL止盈止损统计(开始=None, 结束=None):
+    """(统计端/仪表盘用) 每个 KOL 开仓信号的止盈个数与止损距离分布，走 idx_ss_kol_tpsl 按 KOL 分组。
+    止损距离只统计挂单信号 (市价单没有入场价)"""
+    try:
+        条件, 参数 = ["tp_count > 0"], []
+        for 片段, 值 in (("ts_ms >= ?", 转毫秒(开始)), ("ts_ms < ?", 转毫秒(结束))):
+            if 值 is not None:
+                条件.append(片段)
+                参数.append(值)
+        cursor = 获取读连接().cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(f'''
+            SELECT
+                kol_name,
+                COUNT(*) AS signal_count,
+                AVG(tp_count) AS avg_tp_count,
+                MAX(tp_count) AS max_tp_count,
+                COUNT(sl_distance) AS limit_count,
+                AVG(sl_distance) AS avg_sl_distance,
+                MIN(sl_distance) AS min_sl_distance,
+                MAX(sl_distance) AS max_sl_distance
+            FROM shadow_signals
+            WHERE {" AND ".join(条件)}
+            GROUP BY kol_name
+            ORDER BY signal_count DESC
+        ''', 参数)
+        return [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-查询止盈止损统计失败] {e}")
+        return []
+
+def 查询_持仓止损风险(kol_name=None):
+    """(统计端/仪表盘用) 带止损的活跃持仓 (dict)：距止损 = |现价 - 止损价|，止损风险 = |开仓价 - 止损价| × 手数 (未乘合约大小)，
+    离止损最近的排前面"""
+    try:
+        cursor = 获取读连接().cursor()
+        cursor.row_factory = sqlite3.Row
+        sql = '''
+            SELECT
+                ticket, kol_name, symbol, direction, entry_price, current_price, volume, exit_tp, exit_sl,
+                CASE WHEN current_price > 0 THEN abs(current_price - exit_sl) END AS sl_gap,
+                CASE WHEN entry_price > 0 THEN abs(entry_price - exit_sl) * volume END AS sl_risk
+            FROM active_positions
+            WHERE exit_sl > 0
+        '''
+        参数 = []
+        if kol_name:
+            sql += " AND kol_name = ?"
+            参数.append(kol_name)
+        cursor.execute(sql + " ORDER BY sl_gap IS NULL, sl_gap", 参数)
+        return [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-查询持仓止损风险失败] {e}")
+        return []
+
 def 查询_KOL战绩():
-    """返回所有KOL的统计数据"""
+    """返回所有KOL的统计数据 (读 kol_stats 汇总表，含已归档的历史)"""
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+        cursor = 获取读连接().cursor()
+        cursor.row_factory = sqlite3.Row
             
-            cursor.execute('''
-                SELECT 
-                    kol_name,
-                    COUNT(*) as total_trades,
-                    SUM(CASE WHEN profit > 0 THEN 1 ELSE 0 END) as win_count,
-                    SUM(profit) as total_profit,
-                    AVG(profit) as avg_profit
-                FROM settlements
-                GROUP BY kol_name
-                ORDER BY total_profit DESC
-            ''')
+        cursor.execute('''
+            SELECT 
+                kol_name,
+                total_trades,
+                win_count,
+                total_profit,
+                total_profit / total_trades as avg_profit
+            FROM kol_stats
+            WHERE total_trades > 0
+            ORDER BY total_profit DESC
+        ''')
             
-            rows = cursor.fetchall()
-            conn.close()
+        rows = cursor.fetchall()
         return [dict(row) for row in rows]
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-查询战绩失败] {e}")
         return []
 
-def 标记_命令失败(cmd_id, 错误信息):
-    """(执行端用) 遇到严重错误（如金额不足、参数错误），标记失败不再重试"""
+def 标记_命令失败(cmd_id, 错误信息, 执行端标识=None):
+    """(执行端用) 遇到严重错误（如金额不足、参数错误），标记失败不再重试；租约已被别人领走时不改，返回 False"""
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
+        条件, 参数 = _自己领着的(执行端标识)
+        with 数据库事务() as cursor:
             # 将状态改为 '失败'，并记录错误原因
-            cursor.execute("UPDATE command_queue SET status='失败', error_msg=? WHERE id=?", (错误信息, cmd_id))
-            conn.commit()
-            conn.close()
+            cursor.execute(f"UPDATE command_queue SET status='失败', error_msg=?, lease_until=NULL WHERE id=?{条件}",
+                           [错误信息, cmd_id] + 参数)
+            return cursor.rowcount > 0
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-标记失败异常] ID:{cmd_id} | {e}")
+        return False
         # 如果连更新失败都报错（通常是列不存在），则说明数据库结构严重过时，这里就不再抛出异常了，防止外层循环炸
 
 def 更新持仓实时数据(ticket, entry_price, 当前价格, 浮动盈亏):
     """(统计端用) 更新持仓的实时价格和浮动盈亏, 如果发现开仓价为0，则一并修正。"""
     try:
-        import datetime
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        now, now_ms = _现在()
 
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
+        with 数据库事务() as cursor:
 
             safe_ticket = int(ticket)
 
@@ -474,13 +1835,12 @@ def 更新持仓实时数据(ticket, entry_price, 当前价格, 浮动盈亏):
                 SET current_price = ?, 
                     unrealized_pnl = ?, 
                     last_update = ?,
+                    last_update_ms = ?,
                     entry_price = CASE WHEN entry_price = 0 OR entry_price IS NULL THEN ? ELSE entry_price END
                 WHERE ticket = ?
-            ''', (当前价格, 浮动盈亏, now, entry_price, safe_ticket))
+            ''', (当前价格, 浮动盈亏, now, now_ms, entry_price, safe_ticket))
 
             affected = cursor.rowcount
-            conn.commit()
-            conn.close()
 
             return affected > 0
 
@@ -488,6 +1848,51 @@ def 更新持仓实时数据(ticket, entry_price, 当前价格, 浮动盈亏):
         带时间的日志打印(f"❌ [数据库-更新实时数据失败] Ticket:{ticket} | {e}")
         return False
 
+def 批量更新持仓实时数据(更新列表):
+    """
+    (统计端用) 批量版 更新持仓实时数据，一个事务 executemany 写完
+    更新列表: [(ticket, entry_price, 当前价格, 浮动盈亏), ...]，应包含当前全部持仓
+    跟库里存的值比，价格和浮盈都没变 (开仓价也不用补) 的行直接跳过；
+    返回 (实际写入数, 无变化跳过数, 未登记数)，未登记 = active_positions 里还没有这个 ticket
+    执行端重新登记 (INSERT OR REPLACE) 的行实时字段是空的，自然会重写；没全部跳过才去拿写锁
+    """
+    try:
+        cursor = 获取读连接().cursor()
+        cursor.execute("SELECT ticket, current_price, unrealized_pnl, entry_price FROM active_positions")
+        已存 = {row[0]: row[1:] for row in cursor.fetchall()}
+        now, now_ms = _现在()
+        待写入 = []
+        跳过数 = 未登记数 = 0
+        for ticket, entry_price, 当前价格, 浮动盈亏 in 更新列表:
+            safe_ticket = int(ticket)
+            if safe_ticket not in 已存:
+                未登记数 += 1  # 执行端还没登记到 active_positions，下一轮再写
+                continue
+            旧价格, 旧浮盈, 旧开仓价 = 已存[safe_ticket]
+            if 旧价格 != 当前价格 or 旧浮盈 != 浮动盈亏 or (not 旧开仓价 and entry_price):
+                待写入.append((当前价格, 浮动盈亏, now, now_ms, entry_price, safe_ticket))
+            else:
+                跳过数 += 1
+
+        写入数 = 0
+        if 待写入:
+            with 数据库事务() as cursor:
+                cursor.executemany('''
+                    UPDATE active_positions
+                    SET current_price = ?,
+                        unrealized_pnl = ?,
+                        last_update = ?,
+                        last_update_ms = ?,
+                        entry_price = CASE WHEN entry_price = 0 OR entry_price IS NULL THEN ? ELSE entry_price END
+                    WHERE ticket = ?
+                ''', 待写入)
+                写入数 = cursor.rowcount
+        return 写入数, 跳过数, 未登记数
+
+    except Exception as e:
+        带时间的日志打印(f"❌ [数据库-批量更新实时数据失败] {e}")
+        return 0, 0, 0
+
 
 # ===========================
 # 统计端专用函数 (监控与同步)
@@ -496,17 +1901,14 @@ def 更新持仓实时数据(ticket, entry_price, 当前价格, 浮动盈亏):
 def 获取等待中的信号():
     """获取所有等待执行的信号及其关联的 MT5 Ticket"""
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT s.id, c.mt5_ticket
-                FROM shadow_signals s
-                LEFT JOIN command_queue c ON s.id = c.signal_id AND c.status='已执行'
-                WHERE s.status='等待执行'
-            """)
-            结果 = cursor.fetchall()
-            conn.close()
+        cursor = 获取读连接().cursor()
+        cursor.execute("""
+            SELECT s.id, c.mt5_ticket
+            FROM shadow_signals s
+            LEFT JOIN command_queue c ON s.id = c.signal_id AND c.status='已执行'
+            WHERE s.status='等待执行'
+        """)
+        结果 = cursor.fetchall()
         return 结果
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-获取等待信号失败] {e}")
@@ -515,29 +1917,22 @@ def 获取等待中的信号():
 def 标记失效挂单(signal_id):
     """标记挂单已失效"""
     try:
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
+        now, now_ms = _现在()
+        with 数据库事务() as cursor:
             cursor.execute("""
                 UPDATE shadow_signals
-                SET status='已取消', cancel_time=?, cancel_reason='MT5挂单已失效'
+                SET status='已取消', cancel_time=?, cancel_ms=?, cancel_reason='MT5挂单已失效'
                 WHERE id=?
-            """, (now, signal_id))
-            conn.commit()
-            conn.close()
+            """, (now, now_ms, signal_id))
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-标记失效挂单失败] {e}")
 
 def 获取已执行的tickets():
     """获取所有已执行命令的 MT5 Ticket 集合"""
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
-            cursor.execute("SELECT mt5_ticket FROM command_queue WHERE status='已执行'")
-            tickets = {row[0] for row in cursor.fetchall() if row[0]}
-            conn.close()
+        cursor = 获取读连接().cursor()
+        cursor.execute("SELECT mt5_ticket FROM command_queue WHERE status='已执行'")
+        tickets = {row[0] for row in cursor.fetchall() if row[0]}
         return tickets
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-获取已执行tickets失败] {e}")
@@ -546,12 +1941,9 @@ def 获取已执行的tickets():
 def 检查command_queue中是否存在(mt5_ticket):
     """检查 command_queue 中是否已存在该 ticket"""
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM command_queue WHERE mt5_ticket=?", (mt5_ticket,))
-            结果 = cursor.fetchone()
-            conn.close()
+        cursor = 获取读连接().cursor()
+        cursor.execute("SELECT id FROM command_queue WHERE mt5_ticket=?", (mt5_ticket,))
+        结果 = cursor.fetchone()
         return 结果 is not None
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-检查ticket失败] {e}")
@@ -560,14 +1952,12 @@ def 检查command_queue中是否存在(mt5_ticket):
 def 插入手动挂单(symbol, direction, volume, price, sl, tp, mt5_ticket):
     """将手动挂单写入 command_queue"""
     try:
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
+        now, now_ms = _现在()
+        with 数据库事务() as cursor:
             cursor.execute('''
                 INSERT INTO command_queue
-                (signal_id, kol_name, symbol, direction, volume, price, sl, tp, status, mt5_ticket, created_at, state)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                (signal_id, kol_name, symbol, direction, volume, price, sl, tp, status, mt5_ticket, created_at, created_ms, state)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 None,  # signal_id
                 "手动",  # kol_name
@@ -580,44 +1970,44 @@ def 插入手动挂单(symbol, direction, volume, price, sl, tp, mt5_ticket):
                 "已执行",  # status
                 mt5_ticket,
                 now,
+                now_ms,
                 "挂单"  # state
             ))
-            conn.commit()
-            conn.close()
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-插入手动挂单失败] {e}")
 
 def 更新command_queue_state(mt5_ticket, 真实Ticket_集合, 挂单_ticket_集合):
-    """更新 command_queue 的 state 状态"""
+    """
+    更新 command_queue 的 state 状态 (集合运算版，mt5_ticket 参数保留兼容，未使用)
+    MT5 当前的持仓/挂单 Ticket 以 JSON 数组传进 SQL (json_each)，两条 UPDATE 完成：
+      1. 还在 MT5 里的单子 -> '持仓' / '挂单' (按 Ticket 走索引)
+      2. 尚未结束、但 MT5 里已经没有的单子 -> '已结束'
+    已经是 '已结束' 的历史命令不会再被扫描，耗时不随历史总单数增长
+    """
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
-
-            # 查询所有已执行的命令
-            cursor.execute("SELECT id, mt5_ticket, state FROM command_queue WHERE status='已执行'")
-            所有命令 = cursor.fetchall()
+        持仓_json = json.dumps(sorted(int(t) for t in 真实Ticket_集合))
+        挂单_json = json.dumps(sorted(int(t) for t in 挂单_ticket_集合))
 
-            更新数 = 0
-            for cmd_id, ticket, 当前_state in 所有命令:
-                if ticket is None:
-                    continue
-
-                新_state = None
-                if int(ticket) in 真实Ticket_集合:
-                    新_state = "持仓"
-                elif int(ticket) in 挂单_ticket_集合:
-                    新_state = "挂单"
-                else:
-                    新_state = "已结束"
+        with 数据库事务() as cursor:
+            cursor.execute('''
+                UPDATE command_queue
+                SET state = CASE WHEN mt5_ticket IN (SELECT value FROM json_each(?1)) THEN '持仓' ELSE '挂单' END
+                WHERE status='已执行'
+                  AND mt5_ticket IN (SELECT value FROM json_each(?1) UNION ALL SELECT value FROM json_each(?2))
+                  AND state IS NOT (CASE WHEN mt5_ticket IN (SELECT value FROM json_each(?1)) THEN '持仓' ELSE '挂单' END)
+            ''', (持仓_json, 挂单_json))
+            更新数 = cursor.rowcount
 
-                if 新_state != 当前_state:
-                    cursor.execute("UPDATE command_queue SET state=? WHERE id=?", (新_state, cmd_id))
-                    更新数 += 1
+            # 规划器会偏向 idx_cq_status_ticket (扫全部已执行命令)，这里显式指定部分索引
+            cursor.execute('''
+                UPDATE command_queue INDEXED BY idx_cq_unfinished
+                SET state = '已结束'
+                WHERE status='已执行' AND state IS NOT '已结束'
+                  AND mt5_ticket IS NOT NULL
+                  AND mt5_ticket NOT IN (SELECT value FROM json_each(?1) UNION ALL SELECT value FROM json_each(?2))
+            ''', (持仓_json, 挂单_json))
+            更新数 += cursor.rowcount
 
-            if 更新数 > 0:
-                conn.commit()
-            conn.close()
         return 更新数
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-更新state失败] {e}")
@@ -626,57 +2016,126 @@ def 更新command_queue_state(mt5_ticket, 真实Ticket_集合, 挂单_ticket_集
 def 更新挂单数据(mt5_ticket, price, sl, tp):
     """更新挂单的 price/sl/tp 字段"""
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
+        with 数据库事务() as cursor:
             cursor.execute("""
                 UPDATE command_queue
                 SET price=?, sl=?, tp=?
                 WHERE mt5_ticket=? AND status='已执行' AND state='挂单'
             """, (price, sl, tp, mt5_ticket))
             affected = cursor.rowcount
-            conn.commit()
-            conn.close()
         return affected > 0
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-更新挂单数据失败] {e}")
         return False
 
+# ===========================
+# 聊天上下文缓存 (每个 KOL 最近 N 轮对话，写穿)
+# ===========================
+# 决策端每条消息都要拿上一轮对话拼 AI 上下文，而上一轮正是本进程刚写的。
+# 缓存在 写入_聊天记录 时同步追加，启动时 预热_聊天缓存() 从库里装一次，之后构建上下文不碰数据库。
+# 只有决策端写 chat_history，所以进程内缓存和库是一致的。
+# 从库装载 (刷盘 + 查询 + 放进字典) 和 写入 (入队 + 追加) 都在同一把锁里做：
+# 一条记录要么已经在装载结果里，要么在环建好之后才追加，不会丢也不会重复。
+class 聊天上下文缓存:
+    def __init__(self):
+        self._锁 = threading.Lock()
+        self._环 = {}  # kol_name -> deque[(user_content, ai_response)]，maxlen = 该 KOL 的 N
+        self._配置 = None
+        self.命中 = 0
+        self.未命中 = 0
+
+    def 条数(self, kol_name):
+        """配置.json -> 聊天上下文: 默认条数 / KOL条数{名称: N}"""
+        if self._配置 is None:
+            self._配置 = _读取配置段("聊天上下文", {"默认条数": 2, "KOL条数": {}})
+        return int(self._配置["KOL条数"].get(kol_name, self._配置["默认条数"]))
+
+    def _从库装载(self, kol_name):
+        """调用方持有 self._锁；装好的环放进字典并返回"""
+        N = self.条数(kol_name)
+        if 后台写入.有待写入("chat_history"):
+            后台写入.刷新()
+        cursor = 获取读连接().cursor()
+        # 倒序取最近的N条
+        cursor.execute('''
+            SELECT user_content, ai_response 
+            FROM chat_history 
+            WHERE kol_name = ? 
+            ORDER BY id DESC 
+            LIMIT ?
+        ''', (kol_name, N))
+        环 = self._环[kol_name] = collections.deque(reversed(cursor.fetchall()), maxlen=N)
+        return 环
+
+    def 预热(self, kol列表=None):
+        """装载给定 KOL (默认 chat_history 里出现过的全部 KOL)，返回装载的 KOL 数"""
+        if kol列表 is None:
+            cursor = 获取读连接().cursor()
+            cursor.execute("SELECT DISTINCT kol_name FROM chat_history")
+            kol列表 = [r[0] for r in cursor.fetchall() if r[0]]
+        for kol_name in kol列表:
+            with self._锁:
+                self._从库装载(kol_name)
+        return len(kol列表)
+
+    def 追加(self, kol_name, user_content, ai_response, 落库=None):
+        """落库: 写库的函数 (入队)，和追加一起在锁里做，不会夹在别的线程的装载中间"""
+        with self._锁:
+            if 落库 is not None:
+                落库()
+            环 = self._环.get(kol_name)
+            if 环 is not None:
+                环.append((user_content, ai_response))
+            # 没装载过的 KOL 不建环，下次读取时从库装载 (刚写的记录会先刷盘)
+
+    def 最近(self, kol_name, limit):
+        """最近 limit 轮 [(user_content, ai_response)]，旧的在前"""
+        with self._锁:
+            环 = self._环.get(kol_name)
+            if 环 is not None and limit <= 环.maxlen:
+                self.命中 += 1
+                return list(环)[-limit:] if limit > 0 else []
+            self.未命中 += 1
+            if limit <= self.条数(kol_name):
+                环 = self._从库装载(kol_name)
+                return list(环)[-limit:] if limit > 0 else []
+        # 要的比缓存的多，直接查库 (不改缓存)
+        if 后台写入.有待写入("chat_history"):
+            后台写入.刷新()
+        cursor = 获取读连接().cursor()
+        cursor.execute("SELECT user_content, ai_response FROM chat_history WHERE kol_name = ? ORDER BY id DESC LIMIT ?", (kol_name, limit))
+        return list(reversed(cursor.fetchall()))
+
+    def 指标(self):
+        with self._锁:
+            return {"KOL数": len(self._环), "命中": self.命中, "未命中": self.未命中}
+
+聊天缓存 = 聊天上下文缓存()
+
+def 预热_聊天缓存(kol列表=None):
+    return 聊天缓存.预热(kol列表)
+
 def 写入_聊天记录(kol_name, user_content, ai_response, is_signal):
-    """记录KOL消息和AI的回复"""
+    """记录KOL消息和AI的回复 (进后台写入队列，立即返回；同时追加到上下文缓存)"""
     try:
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO chat_history (kol_name, user_content, ai_response, is_signal)
-                VALUES (?, ?, ?, ?)
-            ''', (kol_name, user_content, ai_response, 1 if is_signal else 0))
-            conn.commit()
-            conn.close()
+        # created_at 在入队时取 (UTC，与原来的 CURRENT_TIMESTAMP 一致)，不受刷新延迟影响
+        created_ms = 当前毫秒()
+        created_at = datetime.datetime.fromtimestamp(created_ms / 1000, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        记录 = (kol_name, user_content, ai_response, 1 if is_signal else 0, created_at, created_ms)
+        聊天缓存.追加(kol_name, user_content, ai_response, 落库=lambda: 后台写入.提交("chat_history", 记录))
     except Exception as e:
         带时间的日志打印(f"❌ [数据库-写入聊天记录失败] {e}")
 
-def 读取_最近聊天记录(kol_name, limit=2):
-    """获取最近的聊天记录，用于构建AI上下文"""
+def 读取_最近聊天记录(kol_name, limit=None):
+    """获取最近的聊天记录，用于构建AI上下文 (limit 默认取该 KOL 配置的条数，命中缓存时不查库)"""
     try:
         history = []
-        with 数据库_线程锁:
-            conn = 获取连接()
-            cursor = conn.cursor()
-            # 倒序取最近的N条
-            cursor.execute('''
-                SELECT user_content, ai_response 
-                FROM chat_history 
-                WHERE kol_name = ? 
-                ORDER BY id DESC 
-                LIMIT ?
-            ''', (kol_name, limit))
-            rows = cursor.fetchall()
-            conn.close()
+        if limit is None:
+            limit = 聊天缓存.条数(kol_name)
+        rows = 聊天缓存.最近(kol_name, limit)
         
-        # 数据库取出来是 [最新, 次新...]，需要反转为 [旧, 新...] 给AI
-        for r in reversed(rows):
+        # 缓存里是 [旧, 新...]，直接按顺序给AI
+        for r in rows:
             user_text = r[0]
             ai_text = r[1]
             if user_text:
@@ -699,13 +2158,14 @@ if __name__ == "__main__":
     
     print("\n--- 测试父子信号写入 ---")
     # 模拟写入一个父信号
-    sid = 写入_父信号("测试KOL", "XAUUSDm", "做多", "市价", 0, {"sl": 2000, "tps": [2010, 2020]})
+    # 模拟写入一个父信号，并拆单写入两个子命令 (同一事务)
+    sid = 写入_信号及子命令("测试KOL", "XAUUSDm", "做多", "市价", 0, {"sl": 2000, "tps": [2010, 2020]}, [
+        ("买入", 0.01, 0, 2000, 2010),
+        ("买入", 0.01, 0, 2000, 2020),
+    ])
     print(f"创建父信号 ID: {sid}")
 
     if sid != -1:
-        # 模拟拆单写入两个子命令
-        写入_子命令(sid, "测试KOL", "XAUUSDm", "买入", 0.01, 0, 2000, 2010)
-        写入_子命令(sid, "测试KOL", "XAUUSDm", "买入", 0.01, 0, 2000, 2020)
         
         cmds = 读取_待执行命令()
         print(f"读取到 {len(cmds)} 条待执行命令")
@@ -714,4 +2174,452 @@ if __name__ == "__main__":
             
         print("✅ 数据库工具测试通过")
     else:
-        print("❌ 父信号写入失败")
\ No newline at end of file
+        print("❌ 父信号写入失败")
+
+    print("\n--- 测试热点查询索引命中 ---")
+    未命中 = 检查_热点查询索引()
+    for 名称, 明细 in 未命中:
+        print(f" - ❌ {名称}: {明细}")
+    assert not 未命中, "存在未走索引的热点查询"
+    print(f"✅ {len(热点查询)} 条热点查询全部走索引")
+    print("\n--- 测试后台写入队列 ---")
+    写入_聊天记录("测试KOL", "问", "答", False)
+    assert 读取_最近聊天记录("测试KOL", limit=1)[-1]["content"] == "答", "刷新后应能读到刚写的聊天记录"
+    for i in range(500):
+        写入_执行日志("队列测试", str(i))
+    后台写入.刷新()
+    指标 = 获取后台写入指标()
+    assert 指标["队列深度"] == 0 and 指标["写入失败"] == 0, 指标
+    print(f"✅ 后台写入: {指标}")
+
+    print("\n--- 测试表结构迁移 (各历史形状 -> 最新版本) ---")
+    import tempfile
+    _旧表 = {
+        "shadow_signals": "id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT, kol_name TEXT, symbol TEXT, direction TEXT, entry_mode TEXT, entry_price REAL, tp_sl_config TEXT, status TEXT",
+        "command_queue": "id INTEGER PRIMARY KEY AUTOINCREMENT, signal_id INTEGER, kol_name TEXT, symbol TEXT, direction TEXT, volume REAL, price REAL, sl REAL, tp REAL, status TEXT, mt5_ticket INTEGER, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+        "active_positions": "ticket INTEGER PRIMARY KEY, kol_name TEXT, symbol TEXT, direction TEXT, entry_price REAL, volume REAL, exit_conditions TEXT, status TEXT",
+        "settlements": "id INTEGER PRIMARY KEY AUTOINCREMENT, kol_name TEXT, symbol TEXT, direction TEXT, volume REAL, entry_price REAL, exit_price REAL, profit REAL, close_time TEXT, hold_duration INTEGER",
+        "execution_logs": "id INTEGER PRIMARY KEY AUTOINCREMENT, time TEXT, action TEXT, details TEXT",
+    }
+    _聊天表 = "id INTEGER PRIMARY KEY AUTOINCREMENT, kol_name TEXT, user_content TEXT, ai_response TEXT, is_signal INTEGER, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+    _补丁 = [
+        ("command_queue", "error_msg TEXT"), ("command_queue", "state TEXT"),
+        ("active_positions", "signal_id INTEGER"), ("active_positions", "tp_goal REAL"),
+        ("settlements", "signal_id INTEGER"),
+        ("active_positions", "current_price REAL DEFAULT 0"), ("active_positions", "unrealized_pnl REAL DEFAULT 0"), ("active_positions", "last_update TEXT"),
+    ]
+
+    def _建旧库(路径, 补丁数, 聊天表, 额外=()):
+        conn = sqlite3.connect(路径)
+        for 表, 列定义 in _旧表.items():
+            conn.execute(f"CREATE TABLE {表} ({列定义})")
+        if 聊天表:
+            conn.execute(f"CREATE TABLE chat_history ({_聊天表})")
+        for 表, 列 in _补丁[:补丁数]:
+            conn.execute(f"ALTER TABLE {表} ADD COLUMN {列}")
+        for 语句 in 额外:
+            conn.execute(语句)
+        conn.execute("INSERT INTO settlements (kol_name, profit) VALUES ('旧KOL', 1.5)")
+        conn.commit()
+        conn.close()
+
+    def _表结构(路径):
+        conn = sqlite3.connect(路径)
+        表列 = {表: {r[1] for r in conn.execute(f"PRAGMA table_xinfo({表})")}
+               for (表,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite%'")}
+        索引 = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx!_%' ESCAPE '!'")}
+        版本 = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.close()
+        return 表列, 索引, 版本
+
+    _原库 = 数据库文件
+    _临时目录 = tempfile.mkdtemp(prefix="kol_migrate_")
+    历史形状 = {
+        "空库": None,
+        "最早版本 (无补丁、无聊天表)": lambda 路径: _建旧库(路径, 0, False),
+        "补丁1-3 + 聊天表": lambda 路径: _建旧库(路径, 5, True),
+        "补丁链完整": lambda 路径: _建旧库(路径, 8, True),
+        "补丁链完整 + 索引集v2 + 手工加过cancel_time": lambda 路径: _建旧库(路径, 8, True, [
+            "CREATE TABLE db_meta (key TEXT PRIMARY KEY, value TEXT)",
+            "INSERT INTO db_meta VALUES ('index_version', '2')",
+            "CREATE INDEX idx_cq_pending ON command_queue(id) WHERE status='待执行'",
+            "CREATE INDEX idx_st_close_time ON settlements(close_time)",
+            "ALTER TABLE shadow_signals ADD COLUMN cancel_time TEXT",
+        ]),
+    }
+    try:
+        基准结构 = None
+        for 序号, (名称, 建库) in enumerate(历史形状.items()):
+            关闭连接()
+            数据库文件 = os.path.join(_临时目录, f"形状{序号}.db")
+            if 建库:
+                建库(数据库文件)
+            执行数 = 执行迁移()
+            assert 执行迁移() == 0, "迁移应该只执行一次"
+            关闭连接()
+            结构 = _表结构(数据库文件)
+            基准结构 = 基准结构 or 结构
+            assert 结构 == 基准结构, f"{名称}: 迁移后结构与新库不一致"
+            assert 结构[2] == 最新版本 and {"cancel_time", "cancel_reason"} <= 结构[0]["shadow_signals"]
+            if 建库:
+                conn = sqlite3.connect(数据库文件)
+                assert conn.execute("SELECT profit FROM settlements WHERE kol_name='旧KOL'").fetchone()[0] == 1.5, f"{名称}: 旧数据丢失"
+                conn.close()
+            print(f"✅ {名称}: 执行 {执行数} 个迁移 -> v{结构[2]}")
+    finally:
+        关闭连接()
+        数据库文件 = _原库
+        import shutil
+        shutil.rmtree(_临时目录, ignore_errors=True)
+
+    print("\n--- 测试冷数据归档 ---")
+    _临时目录 = tempfile.mkdtemp(prefix="kol_archive_")
+    try:
+        关闭连接()
+        数据库文件 = os.path.join(_临时目录, "影子订单簿.db")
+        初始化数据库()
+        with 数据库事务() as cursor:
+            cursor.executemany(
+                "INSERT INTO settlements (kol_name, profit, close_time) VALUES (?, ?, ?)",
+                [("A", 1.0, "2025-01-05 10:00:00"), ("A", -2.0, "2025-02-05 10:00:00"), ("B", 3.0, "2025-02-06 10:00:00")]
+            )
+            cursor.execute("INSERT INTO execution_logs (time, action, details) VALUES ('2025-01-01 00:00:00', '旧', '')")
+            cursor.execute("INSERT INTO chat_history (kol_name, user_content, created_at) VALUES ('A', '旧', '2025-01-01 00:00:00')")
+        归档_结算记录(None, "A", "XAUUSD", "做多", 0.01, 2000, 2001, 5.0)
+        搬走 = 归档_冷数据(保留天数=30)
+        assert 搬走 == {"settlements": 3, "chat_history": 1, "execution_logs": 1}, 搬走
+        assert 列出_归档月份() == ["2025-01", "2025-02"]
+        assert len(查询_全历史("settlements")) == 4 and len(查询_全历史("settlements", 起始月="2025-02")) == 3
+        # 直接 INSERT 的 3 条没走 归档_结算记录，汇总里只有 1 条；重建后连归档库一起算上
+        assert {r["kol_name"]: r["total_trades"] for r in 查询_KOL战绩()} == {"A": 1}
+        assert 重建_KOL统计() == 2
+        全部 = {r["kol_name"]: r for r in 查询_KOL战绩()}
+        assert 全部["A"]["total_trades"] == 3 and 全部["A"]["total_profit"] == 4.0 and 全部["A"]["win_count"] == 2, 全部
+        assert [(r["day"], r["profit"]) for r in 查询_KOL每日战绩("A")][:2] == [("2025-01-05", 1.0), ("2025-02-05", -2.0)]
+        归档_冷数据(保留天数=0)
+        assert {r["kol_name"]: r for r in 查询_KOL战绩()} == 全部, "归档不应改变汇总"
+        assert 归档_冷数据(保留天数=30) == {"settlements": 0, "chat_history": 0, "execution_logs": 0}
+        # 主库里出现和归档库同 id 的另一条旧记录：拷不过去就不能删
+        with 数据库事务() as cursor:
+            cursor.execute("INSERT INTO settlements (id, kol_name, profit, close_time) VALUES (1, 'C', 9.0, '2025-01-07 10:00:00')")
+        assert 归档_冷数据(保留天数=30)["settlements"] == 0
+        assert [r["kol_name"] for r in 查询_全历史("settlements", "id = 1")] == ["C", "A"]
+        # 没有 KOL 名的结算：增量累加和重建一样记在 '' 名下
+        for _ in range(2):
+            归档_结算记录(None, None, None, "做多", 0.01, 2000, 2001, 1.0)
+        无名 = [r for r in 查询_KOL战绩() if not r["kol_name"]]
+        assert len(无名) == 1 and 无名[0]["kol_name"] == "" and 无名[0]["total_trades"] == 2, 无名
+        重建_KOL统计()
+        assert [r for r in 查询_KOL战绩() if not r["kol_name"]] == 无名
+        print(f"✅ 冷数据归档: {搬走} -> {列出_归档月份()}")
+    finally:
+        关闭连接()
+        数据库文件 = _原库
+        shutil.rmtree(_临时目录, ignore_errors=True)
+
+    print("\n--- 测试变更序号 ---")
+    _临时目录 = tempfile.mkdtemp(prefix="kol_seq_")
+    try:
+        关闭连接()
+        数据库文件 = os.path.join(_临时目录, "影子订单簿.db")
+        初始化数据库()
+        持仓缓存 = 变更缓存(读取_所有活跃持仓, "active_positions")
+        assert 持仓缓存.获取() == [] and 持仓缓存.获取() == [] and (持仓缓存.重读, 持仓缓存.命中) == (1, 1)
+        写入_持仓记录(ticket=1, signal_id=None, kol_name="A", symbol="XAUUSD", direction="做多",
+                    entry_price=2000, volume=0.01, tp_goal=0, exit_conditions={}, status="持仓中")
+        assert len(持仓缓存.获取()) == 1 and 持仓缓存.重读 == 2
+        序号 = 读取_变更序号()
+        批量更新持仓实时数据([(1, 2000, 2001.5, 1.5)])
+        新序号 = 读取_变更序号()
+        assert 新序号["active_positions"] == 序号["active_positions"], "刷新价格不应算结构变化"
+        assert 新序号["active_positions.实时"] == 序号["active_positions.实时"] + 1
+        持仓缓存.获取()
+        assert 持仓缓存.重读 == 2, "只改了价格，执行端不用重读"
+        assert 批量更新持仓实时数据([(1, 2000, 2001.5, 1.5), (2, 2000, 2001.5, 1.5)]) == (0, 1, 1), "没变化 / 未登记的不写，分开计数"
+        写入_持仓记录(ticket=1, signal_id=None, kol_name="A", symbol="XAUUSD", direction="做多",
+                    entry_price=2000, volume=0.01, tp_goal=0, exit_conditions={}, status="持仓中")
+        assert 批量更新持仓实时数据([(1, 2000, 2001.5, 1.5)]) == (1, 0, 0), "重新登记清空了实时字段，要重写"
+
+        结算缓存 = 增量表缓存("settlements")
+        归档_结算记录(None, "A", "XAUUSD", "做多", 0.01, 2000, 2001, 1.0)
+        assert len(结算缓存.获取()[0]) == 1 and 结算缓存.获取() == (结算缓存.行, False)
+        归档_结算记录(None, "B", "XAUUSD", "做多", 0.01, 2000, 2001, 2.0)
+        行, 有变化 = 结算缓存.获取()
+        assert 有变化 and [r["kol_name"] for r in 行] == ["A", "B"]
+        with 数据库事务() as cursor:
+            cursor.execute("DELETE FROM settlements WHERE kol_name='A'")
+        assert [r["kol_name"] for r in 结算缓存.获取()[0]] == ["B"], "有删除时应整表重读"
+        print(f"✅ 变更序号: {读取_变更序号()}")
+    finally:
+        关闭连接()
+        数据库文件 = _原库
+        shutil.rmtree(_临时目录, ignore_errors=True)
+
+    print("\n--- 测试命令领取 ---")
+    _临时目录 = tempfile.mkdtemp(prefix="kol_claim_")
+    try:
+        关闭连接()
+        数据库文件 = os.path.join(_临时目录, "影子订单簿.db")
+        初始化数据库()
+        for i in range(50):
+            写入_子命令(1, "K", "XAUUSD" if i % 2 else "EURUSD", "买入", 0.01, 0, 0, 0)
+        已领取 = []
+        def _执行端(标识):
+            while True:
+                批 = 领取_待执行命令(标识, 数量=3)
+                if not 批:
+                    return
+                已领取.extend(r["id"] for r in 批)
+                for r in 批:
+                    assert 续租_命令(r["id"], 标识)
+                    assert 标记_命令已执行(r["id"], 1000 + r["id"], 标识)
+        线程列表 = [threading.Thread(target=_执行端, args=(f"w{n}",)) for n in range(4)]
+        for t in 线程列表: t.start()
+        for t in 线程列表: t.join()
+        assert sorted(已领取) == list(range(1, 51)), "每条命令应该恰好被领取一次"
+        assert not 有可领取命令()
+
+        写入_子命令(2, "K", "XAUUSD", "买入", 0.01, 0, 0, 0)
+        写入_子命令(2, "K", "EURUSD", "买入", 0.01, 0, 0, 0)
+        assert [r["symbol"] for r in 领取_待执行命令("w1", 品种="EURUSD")] == ["EURUSD"]
+        批 = 领取_待执行命令("w1", 租约秒数=-1)  # 立刻过期，模拟执行端崩溃
+        assert len(批) == 1 and 有可领取命令()
+        重领 = 领取_待执行命令("w2")
+        assert [r["id"] for r in 重领] == [批[0]["id"]] and 重领[0]["claimed_by"] == "w2" and 重领[0]["attempts"] == 2
+        释放_命令(重领[0]["id"], "w1")  # 不是自己的租约，不能释放
+        assert not 有可领取命令()
+        释放_命令(重领[0]["id"], "w2")  # 放回去不算一次尝试
+        cursor = 获取读连接().cursor()
+        cursor.execute("SELECT attempts FROM command_queue WHERE id = ?", (重领[0]["id"],))
+        assert cursor.fetchone()[0] == 1
+        assert 领取_待执行命令("w3", 起始ID=重领[0]["id"]) == [], "起始ID 之前的不领"
+        assert [r["id"] for r in 领取_待执行命令("w3")] == [重领[0]["id"]]
+        # w3 的租约过期被 w4 领走：w3 不能再续租，也不能标记完成 / 失败
+        with 数据库事务() as cursor:
+            cursor.execute("UPDATE command_queue SET lease_until = 0 WHERE id = ?", (重领[0]["id"],))
+        assert [r["id"] for r in 领取_待执行命令("w4", 数量=1)] == [重领[0]["id"]]
+        assert not 续租_命令(重领[0]["id"], "w3")
+        assert not 标记_命令已执行(重领[0]["id"], 999, "w3") and not 标记_命令失败(重领[0]["id"], "超时", "w3")
+        cursor = 获取读连接().cursor()
+        cursor.execute("SELECT status, claimed_by FROM command_queue WHERE id = ?", (重领[0]["id"],))
+        assert tuple(cursor.fetchone()) == ("执行中", "w4")
+        assert 标记_命令已执行(重领[0]["id"], 999, "w4")
+        print(f"✅ 命令领取: 4 个执行端并发领取 50 条无重复，过期重领 / 释放 / 续租 / 按品种领取正常，丢了租约改不了状态")
+    finally:
+        关闭连接()
+        数据库文件 = _原库
+        shutil.rmtree(_临时目录, ignore_errors=True)
+
+    print("\n--- 测试行对象 ---")
+    _临时目录 = tempfile.mkdtemp(prefix="kol_rows_")
+    try:
+        关闭连接()
+        数据库文件 = os.path.join(_临时目录, "影子订单簿.db")
+        初始化数据库()
+        写入_持仓记录(ticket=7, signal_id=1, kol_name="A", symbol="XAUUSD", direction="做多",
+                    entry_price=2000, volume=0.01, tp_goal=2010, exit_conditions=[{"类型": "止盈", "价格": 2010}])
+        with 数据库事务() as cursor:
+            cursor.execute("INSERT INTO active_positions (ticket, kol_name, exit_conditions) VALUES (8, 'B', '不是JSON')")
+        持仓 = {p.ticket: p for p in 读取_所有活跃持仓()}
+        p = 持仓[7]
+        assert not hasattr(p, "__dict__") and p._exit_conditions_原文.startswith("[")
+        assert not hasattr(p, "_exit_conditions_值"), "没访问前不应解析"
+        assert p["exit_conditions"][0]["价格"] == 2010 and p.exit_conditions is p["exit_conditions"]
+        assert 持仓[8]["exit_conditions"] == "不是JSON", "解析失败保留原文"
+        assert p.get("kol_name") == "A" and p.get("不存在", 0) == 0 and "ticket" in p
+        assert dict(p) == p.转字典() and json.loads(json.dumps(p.转字典(), ensure_ascii=False))["ticket"] == 7
+        cursor = 获取读连接().cursor()
+        cursor.row_factory = ActivePosition.行工厂
+        行 = cursor.execute("SELECT ticket, COUNT(*) AS n, kol_name FROM active_positions WHERE ticket=7").fetchone()
+        assert 行.keys() == ["ticket", "kol_name", "n"] and 行["n"] == 1 and not hasattr(行, "symbol")
+        写入_子命令(1, "K", "XAUUSD", "买入", 0.01, 0, 0, 0)
+        命令 = 领取_待执行命令("w1")[0]
+        assert isinstance(命令, Command) and 命令["status"] == "执行中" and 命令.claimed_by == "w1"
+        print(f"✅ 行对象: {p!r}"[:120])
+    finally:
+        关闭连接()
+        数据库文件 = _原库
+        shutil.rmtree(_临时目录, ignore_errors=True)
+
+    print("\n--- 测试聊天上下文缓存 ---")
+    _临时目录 = tempfile.mkdtemp(prefix="kol_chat_")
+    try:
+        关闭连接()
+        数据库文件 = os.path.join(_临时目录, "影子订单簿.db")
+        初始化数据库()
+        for i in range(5):
+            写入_聊天记录("A", f"问{i}", f"答{i}", False)
+        后台写入.刷新()
+        聊天缓存 = 聊天上下文缓存()
+        聊天缓存._配置 = {"默认条数": 2, "KOL条数": {"A": 3}}
+        assert 预热_聊天缓存() == 1 and 聊天缓存.条数("A") == 3 and 聊天缓存.条数("B") == 2
+        assert [h["content"] for h in 读取_最近聊天记录("A")] == [
+            "KOL名称: A\n历史消息:\n问2", "答2", "KOL名称: A\n历史消息:\n问3", "答3", "KOL名称: A\n历史消息:\n问4", "答4"]
+        写入_聊天记录("A", "问5", "答5", True)  # 写穿: 不刷盘也能读到
+        assert 后台写入.有待写入("chat_history") and 读取_最近聊天记录("A", limit=1)[-1]["content"] == "答5"
+        assert 聊天缓存.命中 == 2 and 聊天缓存.未命中 == 0
+        assert len(读取_最近聊天记录("A", limit=5)) == 10, "超过缓存条数时回库查"
+        写入_聊天记录("B", "问", "答", False)  # 没预热的 KOL 首次读取时从库装载
+        assert 读取_最近聊天记录("B")[-1]["content"] == "答" and 聊天缓存.指标()["KOL数"] == 2
+        # 没装载过的 KOL 一边写一边读 (首次读取从库装载)，环里最后要和库里一致，不丢不重
+        def _写():
+            for i in range(200):
+                写入_聊天记录("C", f"问{i}", f"答{i}", False)
+        def _读():
+            for _ in range(200):
+                with 聊天缓存._锁:
+                    聊天缓存._环.pop("C", None)  # 反复逼它重新装载
+                聊天缓存.最近("C", 2)
+        线程列表 = [threading.Thread(target=_写), threading.Thread(target=_读)]
+        for t in 线程列表: t.start()
+        for t in 线程列表: t.join()
+        assert list(聊天缓存._环["C"]) == [("问198", "答198"), ("问199", "答199")], list(聊天缓存._环["C"])
+        后台写入.刷新()
+        cursor = 获取读连接().cursor()
+        cursor.execute("SELECT COUNT(*) FROM chat_history WHERE kol_name = 'C'")
+        assert cursor.fetchone()[0] == 200
+        print(f"✅ 聊天上下文缓存: {聊天缓存.指标()}")
+    finally:
+        关闭连接()
+        数据库文件 = _原库
+        shutil.rmtree(_临时目录, ignore_errors=True)
+
+    print("\n--- 测试毫秒时间列 ---")
+    _临时目录 = tempfile.mkdtemp(prefix="kol_ms_")
+    try:
+        关闭连接()
+        数据库文件 = os.path.join(_临时目录, "影子订单簿.db")
+        初始化数据库()
+        两天前 = (datetime.datetime.now() - datetime.timedelta(days=2, hours=1)).strftime("%Y-%m-%d %H:%M:%S")
+        归档_结算记录(None, "A", "XAUUSD", "做多", 0.01, 2000, 2001, 5.0, open_time_str=两天前)
+        新单 = 读取_最近结算(1)[0]
+        assert 新单.hold_duration in (176400, 176401), f"持仓超过一天不能丢整天: {新单.hold_duration}"
+        assert abs(新单.close_ms - 当前毫秒()) < 5000 and 毫秒转文本(新单.close_ms) == 新单.close_time
+        with 数据库事务() as cursor:
+            # 只写文本列的老写法 -> 触发器补毫秒列 (本地时间 / UTC 按列区分)
+            cursor.executemany("INSERT INTO settlements (kol_name, profit, close_time) VALUES (?, ?, ?)",
+                               [("A", 1.0, "2025-01-05 10:00:00"), ("B", 2.0, "2025-01-20 10:00:00"), ("A", 3.0, "2025-02-05 10:00:00")])
+            cursor.execute("INSERT INTO chat_history (kol_name, created_at) VALUES ('A', '2025-01-01 00:00:00')")
+            cursor.execute("INSERT INTO command_queue (kol_name, status) VALUES ('A', '已执行')")
+            cursor.execute("UPDATE settlements SET close_ms = NULL WHERE kol_name = 'B'")
+            _回填毫秒列(cursor, "settlements")
+        cursor = 获取读连接().cursor()
+        assert cursor.execute("SELECT close_ms FROM settlements WHERE kol_name='B'").fetchone()[0] == 转毫秒("2025-01-20 10:00:00")
+        assert cursor.execute("SELECT created_ms FROM chat_history").fetchone()[0] == 1735689600000
+        assert abs(cursor.execute("SELECT created_ms FROM command_queue").fetchone()[0] - 当前毫秒()) < 5000
+        assert [r["profit"] for r in 查询_结算区间("2025-01-01", "2025-02-01")] == [2.0, 1.0]
+        assert [r["profit"] for r in 查询_结算区间("2025-01-01", datetime.date(2025, 3, 1), kol_name="A")] == [3.0, 1.0]
+        assert len(查询_结算区间(开始=datetime.datetime.now() - datetime.timedelta(hours=1))) == 1
+        归档_冷数据(保留天数=30)
+        assert 查询_结算区间("2025-01-01", "2025-02-01") == [] and 列出_归档月份() == ["2025-01", "2025-02"]
+        assert [r["profit"] for r in 查询_结算区间("2025-01-10", "2025-02-01", 包含归档=True)] == [2.0]
+        assert [r["profit"] for r in 查询_结算区间(kol_name="A", 包含归档=True)] == [5.0, 3.0, 1.0]
+        print(f"✅ 毫秒时间列: 持仓 {新单.hold_duration}s，时间窗查询 (含归档) 正常")
+    finally:
+        关闭连接()
+        数据库文件 = _原库
+        shutil.rmtree(_临时目录, ignore_errors=True)
+
+    print("\n--- 测试库维护 ---")
+    _临时目录 = tempfile.mkdtemp(prefix="kol_maint_")
+    try:
+        关闭连接()
+        # 旧库: auto_vacuum=NONE 时建的表
+        数据库文件 = os.path.join(_临时目录, "影子订单簿.db")
+        conn = sqlite3.connect(数据库文件)
+        conn.execute("CREATE TABLE execution_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, time TEXT, action TEXT, details TEXT)")
+        conn.close()
+        初始化数据库()
+        库维护 = 库维护器()
+        库维护._配置 = dict(默认_库维护配置, 安静秒数=0, 回收阈值页=10, optimize间隔秒=0)
+        with 数据库事务() as cursor:
+            cursor.executemany("INSERT INTO execution_logs (time, action, details) VALUES ('', '维护', ?)", [("x" * 500,) for _ in range(2000)])
+        with 数据库事务() as cursor:
+            cursor.execute("DELETE FROM execution_logs")
+        assert WAL大小() > 0 and 库维护.指标()["auto_vacuum"] == "NONE"
+        动作 = 库维护.执行一次()  # 安静秒数=0: 第一轮就算安静
+        指标 = 库维护.指标()
+        assert "VACUUM" not in 动作 and "TRUNCATE" in 动作 and "optimize" in 动作, 动作
+        assert 指标["auto_vacuum"] == "NONE" and 指标["WAL字节"] == 0 and 指标["检查点"]["TRUNCATE"]["次数"] == 1, "默认不自动 VACUUM"
+        try:
+            库维护.转换增量回收(余量倍数=10 ** 12)
+            raise AssertionError("磁盘不够时不应 VACUUM")
+        except RuntimeError:
+            pass
+        assert 库维护.转换增量回收() > 0 and 库维护.转换增量回收() is None
+        assert 库维护.指标()["auto_vacuum"] == "INCREMENTAL"
+        with 数据库事务() as cursor:
+            cursor.executemany("INSERT INTO execution_logs (time, action, details) VALUES ('', '维护', ?)", [("x" * 500,) for _ in range(2000)])
+        with 数据库事务() as cursor:
+            cursor.execute("DELETE FROM execution_logs")
+        空闲页 = 库维护.指标()["空闲页"]
+        动作 = 库维护.执行一次()
+        assert "incremental_vacuum" in 动作 and 库维护.指标()["空闲页"] == 0 and 库维护.指标()["回收页数"] == 空闲页 > 100, 动作
+        # 一直有写入 (不安静) 时只在 WAL 超过阈值后做 PASSIVE
+        库维护._配置 = dict(库维护.配置, 安静秒数=3600, WAL阈值MB=0)
+        写入_子命令(1, "K", "XAUUSD", "买入", 0.01, 0, 0, 0)
+        assert 库维护.执行一次() == ["PASSIVE", "optimize"]
+        print(f"✅ 库维护: {json.dumps({k: v for k, v in 库维护.指标().items() if k != '最近检查点'}, ensure_ascii=False)}")
+    finally:
+        库维护 = 库维护器()
+        关闭连接()
+        数据库文件 = _原库
+        shutil.rmtree(_临时目录, ignore_errors=True)
+
+    print("\n--- 测试已处理消息 ---")
+    _临时目录 = tempfile.mkdtemp(prefix="kol_msg_")
+    try:
+        关闭连接()
+        数据库文件 = os.path.join(_临时目录, "影子订单簿.db")
+        初始化数据库()
+        assert 查询_已处理消息("1:100") is None
+        sid = 写入_信号及子命令("测试KOL", "XAUUSDm", "做多", "市价", 0, {"sl": 2000, "tps": [2010]}, [("买入", 0.01, 0, 2000, 2010)], 消息键="1:100")
+        写入_已处理消息("1:100", False)  # 下单事务里已经记过，不覆盖
+        写入_已处理消息("1:101", False)
+        assert 查询_已处理消息("1:100")["signal_id"] == sid and 查询_已处理消息("1:100")["is_signal"] == 1
+        assert 查询_已处理消息("1:101")["is_signal"] == 0 and 查询_已处理消息("1:101")["signal_id"] is None
+        assert 清理_已处理消息() == 0
+        print("✅ 已处理消息: 下单和已处理同一事务，重复写入不覆盖")
+    finally:
+        关闭连接()
+        数据库文件 = _原库
+        shutil.rmtree(_临时目录, ignore_errors=True)
+
+    print("\n--- 测试JSON生成列 ---")
+    _临时目录 = tempfile.mkdtemp(prefix="kol_json_")
+    try:
+        关闭连接()
+        数据库文件 = os.path.join(_临时目录, "影子订单簿.db")
+        初始化数据库()
+        写入_信号及子命令("A", "XAUUSD", "做多", "挂单", 2000, {"sl": 1990, "tps": [2010, "2020", 2030]}, [])
+        写入_信号及子命令("A", "XAUUSD", "做空", "市价", 0, {"sl": 2050, "tps": [2030]}, [])
+        写入_信号及子命令("B", "XAUUSD", "做多", "挂单", 1995, {"sl": 1990, "tps": [2000, 2005]}, [])
+        写入_信号及子命令("B", "XAUUSD", "平仓", "市价", 0, {}, [])
+        with 数据库事务() as cursor:
+            cursor.execute("INSERT INTO shadow_signals (kol_name, tp_sl_config, entry_price) VALUES ('C', '不是JSON', 1)")
+        信号 = {(r["kol_name"], r["direction"]): r for r in 查询_信号区间()}
+        r = 信号[("A", "做多")]
+        assert (r["sl"], r["tp_count"], r["first_tp"], r["last_tp"], r["sl_distance"]) == (1990, 3, 2010, 2030, 10)
+        assert 信号[("A", "做空")]["sl_distance"] is None and 信号[("B", "平仓")]["tp_count"] is None
+        assert 信号[("C", None)]["sl"] is None, "坏 JSON 生成列为 NULL，不报错"
+        assert isinstance(r, Signal) and not hasattr(r, "_tp_sl_config_值"), "没访问前不应解析"
+        assert r.tp_sl_config["tps"][0] == 2010 and 信号[("C", None)].tp_sl_config == "不是JSON"
+        assert [r["entry_price"] for r in 查询_信号止盈止损(最大止损距离=5)] == [1995]
+        assert [r["direction"] for r in 查询_信号止盈止损(kol_name="A", 最少止盈数=2)] == ["做多"]
+        统计 = {r["kol_name"]: r for r in 查询_KOL止盈止损统计()}
+        assert 统计["A"]["signal_count"] == 2 and 统计["A"]["avg_tp_count"] == 2 and 统计["A"]["avg_sl_distance"] == 10
+        assert set(统计) == {"A", "B"} and 查询_KOL止盈止损统计(结束="2000-01-01") == []
+        写入_持仓记录(ticket=7, signal_id=1, kol_name="A", symbol="XAUUSD", direction="做多", entry_price=2000, volume=0.1,
+                    tp_goal=2010, exit_conditions=[{"类型": "止盈", "价格": 2010}, {"类型": "止损", "价格": 1990}])
+        写入_持仓记录(ticket=8, signal_id=None, kol_name="手动", symbol="XAUUSD", direction="做多", entry_price=2000,
+                    volume=0.1, tp_goal=0, exit_conditions={})
+        批量更新持仓实时数据([(7, 2000, 1995, -0.5)])
+        p = {p.ticket: p for p in 读取_所有活跃持仓()}
+        assert (p[7].exit_tp, p[7].exit_sl, p[8].exit_sl) == (2010, 1990, None)
+        风险 = 查询_持仓止损风险()
+        assert len(风险) == 1 and 风险[0]["sl_gap"] == 5 and abs(风险[0]["sl_risk"] - 1.0) < 1e-9
+        print(f"✅ JSON生成列: {统计['A']}")
+    finally:
+        关闭连接()
+        数据库文件 = _原库
+        shutil.rmtree(_临时目录, ignore_errors=True)
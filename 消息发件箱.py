@@ -0,0 +1,185 @@
+# 消息发件箱.py
+# -*- coding: utf-8 -*-
+"""
+监听TG -> 决策端 的持久化发件箱 (独立的 发件箱.db，不占 影子订单簿.db 的写锁)。
+收到消息先落盘再返回，投递成功才标记；决策端重启 / 变慢期间的消息不会丢，监听TG 重启后接着投。
+    - 按 Telegram 消息 (chat_id:msg_id) 去重：重连后重复推送的更新只记一次
+    - 每个 KOL 只投最早一条待投递的 (队头)，失败按指数退避重试，后面的排队等它，顺序不乱
+    - 超过 过期秒 还没投出去的标记为过期、不再补发 (行情早就变了，晚到的信号比丢了更危险)
+投递本身 (HTTP、并发) 在 监听TG.Webhook投递器 里，这里只管存取。
+每次提交都 fsync，投递器 把所有调用放到一个专用线程里 (asyncio 事件循环不等磁盘)。
+
+自检: python 消息发件箱.py (临时目录里跑去重 / 退避 / 顺序 / 过期 / 补图 / 清理)
+"""
+import os
+import json
+import time
+import sqlite3
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+默认_发件箱文件 = os.path.join(BASE_DIR, "发件箱.db")
+
+def 当前毫秒():
+    return int(time.time() * 1000)
+
+class 发件箱:
+    """一条连接，不加锁：建好之后只能在同一个线程里用 (投递器 的 发件箱线程)"""
+
+    def __init__(self, 路径=默认_发件箱文件, 退避起始秒=1, 退避上限秒=60, 过期秒=900, 保留天数=7):
+        self.路径 = 路径
+        self.退避起始秒 = 退避起始秒
+        self.退避上限秒 = 退避上限秒
+        self.过期秒 = 过期秒
+        self.保留天数 = 保留天数
+        self.重复 = 0
+        # 在主线程建、在 发件箱线程 用，所以关掉同线程检查；同一时刻只有一个线程碰它
+        self.conn = sqlite3.connect(路径, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")  # 落盘就是它的用处，每次提交都 fsync
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                msg_key TEXT UNIQUE,       -- chat_id:msg_id，去重
+                author TEXT,               -- KOL 名称，同一个 KOL 按 id 顺序投递
+                payload TEXT,              -- JSON: 推给决策端的内容
+                status TEXT,               -- "待投递" / "已投递" / "过期"
+                attempts INTEGER DEFAULT 0,
+                created_ms INTEGER,
+                next_try_ms INTEGER,       -- 下次可以重试的时间
+                done_ms INTEGER,           -- 投递成功 / 过期的时间
+                last_error TEXT
+            )
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(author, id) WHERE status='待投递'")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_done ON outbox(done_ms) WHERE status!='待投递'")
+        # 待投递条数的计数器：背压每条消息都要看，不能每次 COUNT(*)
+        self.待投递数 = self.conn.execute("SELECT COUNT(*) FROM outbox WHERE status='待投递'").fetchone()[0]
+
+    def 写入(self, 消息键, 作者, 载荷, 延迟秒=0):
+        """落盘一条待投递消息，延迟秒 之后才投 (等图片)；同一个 消息键 已经写过返回 False"""
+        现在 = 当前毫秒()
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO outbox (msg_key, author, payload, status, created_ms, next_try_ms) VALUES (?, ?, ?, '待投递', ?, ?)",
+            (消息键, 作者, json.dumps(载荷, ensure_ascii=False), 现在, 现在 + int(延迟秒 * 1000)))
+        if cursor.rowcount == 0:
+            self.重复 += 1
+            return False
+        self.待投递数 += 1
+        return True
+
+    def 补图(self, 消息键, 图片):
+        """还在延迟期里 (没投过) 的消息把图片并进去并立即可投，返回 True；已经投了 / 在途 / 不存在返回 False"""
+        行 = self.conn.execute("SELECT payload FROM outbox WHERE msg_key=? AND status='待投递' AND attempts=0 AND next_try_ms>?",
+                              (消息键, 当前毫秒())).fetchone()
+        if not 行:
+            return False
+        载荷 = {**json.loads(行["payload"]), "images": 图片}
+        self.conn.execute("UPDATE outbox SET payload=?, next_try_ms=? WHERE msg_key=?",
+                          (json.dumps(载荷, ensure_ascii=False), 当前毫秒(), 消息键))
+        return True
+
+    def 队头(self, 排除作者=()):
+        """每个 KOL 最早一条待投递的消息 (已到重试时间、作者不在 排除作者 里)，[sqlite3.Row]"""
+        行列表 = self.conn.execute('''
+            SELECT o.* FROM outbox o
+            JOIN (SELECT MIN(id) AS id FROM outbox WHERE status='待投递' GROUP BY author) h ON o.id = h.id
+            ORDER BY o.id
+        ''').fetchall()
+        现在 = 当前毫秒()
+        return [r for r in 行列表 if r["next_try_ms"] <= 现在 and r["author"] not in 排除作者]
+
+    def 已过期(self, 行):
+        return 当前毫秒() - 行["created_ms"] > self.过期秒 * 1000
+
+    def 标记已投递(self, 编号):
+        if self.conn.execute("UPDATE outbox SET status='已投递', done_ms=?, attempts=attempts+1 WHERE id=? AND status='待投递'",
+                             (当前毫秒(), 编号)).rowcount:
+            self.待投递数 -= 1
+
+    def 标记失败(self, 编号, 错误):
+        """记一次失败并按指数退避排下次重试，返回等待秒数"""
+        尝试次数 = self.conn.execute("SELECT attempts FROM outbox WHERE id=?", (编号,)).fetchone()[0] + 1
+        等待 = min(self.退避起始秒 * 2 ** (尝试次数 - 1), self.退避上限秒)
+        self.conn.execute("UPDATE outbox SET attempts=?, next_try_ms=?, last_error=? WHERE id=?",
+                          (尝试次数, 当前毫秒() + int(等待 * 1000), str(错误)[:500], 编号))
+        return 等待
+
+    def 标记过期(self, 编号):
+        if self.conn.execute("UPDATE outbox SET status='过期', done_ms=? WHERE id=? AND status='待投递'",
+                             (当前毫秒(), 编号)).rowcount:
+            self.待投递数 -= 1
+
+    def 深度(self):
+        """待投递条数 (计数器，不查库；任何线程都可以读)"""
+        return self.待投递数
+
+    def 清理(self):
+        """删掉 保留天数 之前已投递 / 过期的记录，返回删除条数"""
+        return self.conn.execute("DELETE FROM outbox WHERE status!='待投递' AND done_ms < ?",
+                                 (当前毫秒() - self.保留天数 * 86_400_000,)).rowcount
+
+    def 指标(self):
+        最早 = self.conn.execute("SELECT MIN(created_ms) FROM outbox WHERE status='待投递'").fetchone()[0]
+        过期 = self.conn.execute("SELECT COUNT(*) FROM outbox WHERE status='过期'").fetchone()[0]
+        return {"待投递": self.待投递数, "最老待投递秒": round((当前毫秒() - 最早) / 1000, 1) if 最早 else 0.0,
+                "重复": self.重复, f"近{self.保留天数}天过期": 过期}
+
+    def 关闭(self):
+        self.conn.close()
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    临时目录 = tempfile.mkdtemp(prefix="kol_outbox_")
+    路径 = os.path.join(临时目录, "发件箱.db")
+    try:
+        箱 = 发件箱(路径, 退避起始秒=1, 退避上限秒=4, 过期秒=60)
+        print("--- 测试去重 ---")
+        assert 箱.写入("1:1", "A", {"content": "a1"}) and 箱.写入("1:2", "A", {"content": "a2"}) and 箱.写入("2:1", "B", {"content": "b1"})
+        assert not 箱.写入("1:1", "A", {"content": "a1"}) and 箱.重复 == 1 and 箱.深度() == 3
+        print("✅ 同一个消息键只写一次，深度计数 3")
+
+        print("--- 测试顺序 (每个 KOL 只给队头) ---")
+        头 = 箱.队头()
+        assert [r["msg_key"] for r in 头] == ["1:1", "2:1"], [r["msg_key"] for r in 头]
+        assert [r["msg_key"] for r in 箱.队头(排除作者={"A"})] == ["2:1"]
+        print("✅ A 的第二条排在第一条后面，在途的作者被排除")
+
+        print("--- 测试指数退避 ---")
+        a1 = 头[0]["id"]
+        assert [箱.标记失败(a1, "超时") for _ in range(4)] == [1, 2, 4, 4]
+        assert [r["msg_key"] for r in 箱.队头()] == ["2:1"], "退避中的队头不给出，后面的也不越过它"
+        箱.conn.execute("UPDATE outbox SET next_try_ms=0 WHERE id=?", (a1,))
+        箱.标记已投递(a1)
+        箱.标记已投递(a1)  # 重复标记不重复扣计数
+        assert [r["msg_key"] for r in 箱.队头()] == ["1:2", "2:1"] and 箱.深度() == 2
+        print("✅ 退避 1/2/4/4 秒封顶，投递成功后轮到下一条")
+
+        print("--- 测试过期 ---")
+        箱.conn.execute("UPDATE outbox SET created_ms=created_ms-61000 WHERE msg_key='2:1'")
+        b1 = [r for r in 箱.队头() if r["author"] == "B"][0]
+        assert 箱.已过期(b1) and not 箱.已过期(箱.队头()[0])
+        箱.标记过期(b1["id"])
+        assert 箱.深度() == 1 and 箱.指标()["近7天过期"] == 1
+        print("✅ 超过 过期秒 的标记过期，不再给出")
+
+        print("--- 测试延迟写入 / 补图 ---")
+        assert 箱.写入("3:1", "C", {"author": "C", "content": "c1", "images": []}, 延迟秒=30)
+        assert "C" not in {r["author"] for r in 箱.队头()}, "延迟期里不给出"
+        assert 箱.补图("3:1", ["c1.jpg"]) and not 箱.补图("3:1", ["c1.jpg"]) and not 箱.补图("1:2", ["x.jpg"])
+        c1 = [r for r in 箱.队头() if r["author"] == "C"][0]
+        assert json.loads(c1["payload"])["images"] == ["c1.jpg"]
+        箱.标记已投递(c1["id"])
+        print("✅ 延迟的文字等到图片后合并立即投，已经可投的不再改载荷")
+
+        print("--- 测试清理 / 重启 ---")
+        箱.conn.execute("UPDATE outbox SET done_ms=0 WHERE status!='待投递'")
+        assert 箱.清理() == 3
+        箱.关闭()
+        箱 = 发件箱(路径)
+        assert 箱.深度() == 1 and [r["msg_key"] for r in 箱.队头()] == ["1:2"]
+        箱.关闭()
+        print("✅ 过了保留期的记录删除，重开后计数和待投递都还在")
+    finally:
+        shutil.rmtree(临时目录, ignore_errors=True)
@@ -0,0 +1,204 @@
+# 生成测试数据.py
+# -*- coding: utf-8 -*-
+"""
+往一个一次性的新库里灌模拟数据，用来看系统在几十万 / 上百万行时的表现 (性能基准.py 的 数据规模 项目也用它)。
+分布尽量贴近真实：
+    - KOL 发单量按 Zipf 分布 (头部几个 KOL 占大半)，每个 KOL 有自己的胜率
+    - 品种以 XAUUSD 为主；止损距离按价格百分比，1~4 个止盈位，市价 / 挂单 6:4
+    - 信号到达间隔是指数分布 (有扎堆有空档)；一个止盈位一条子命令，少量撤销 / 失败
+    - 已执行的子命令按胜率打到止盈或止损，生成结算、开平仓日志；每条结算配若干条聊天记录
+    - 最后追加当前持仓、挂单和等待执行的信号
+所有表按真实写入的样子填 (文本时间列 + *_ms 列)，生成完重建 KOL 汇总表。
+
+用法:
+    python 生成测试数据.py D:/测试/影子订单簿.db                      # 默认 10 万条结算
+    python 生成测试数据.py 测试.db --结算数 1000000 --聊天倍数 5 --种子 7
+目标文件必须不存在，不会覆盖正在用的库。
+"""
+import os
+import sys
+import json
+import time
+import random
+import datetime
+
+import 数据库工具 as db
+
+# 品种: (权重, 基准价, 每手每 1.0 价格变动的盈亏)
+品种参数 = {
+    "XAUUSD": (70, 2000.0, 100.0),
+    "XAGUSD": (8, 25.0, 5000.0),
+    "BTCUSD": (8, 60000.0, 1.0),
+    "EURUSD": (6, 1.08, 100000.0),
+    "GBPUSD": (4, 1.27, 100000.0),
+    "USDJPY": (4, 150.0, 1000.0),
+}
+止盈个数权重 = {1: 30, 2: 35, 3: 25, 4: 10}
+子命令状态权重 = {"已执行": 92, "已撤销": 3, "失败": 5}
+每批信号数 = 5000
+
+def _本地文本(毫秒):
+    return datetime.datetime.fromtimestamp(毫秒 / 1000).strftime("%Y-%m-%d %H:%M:%S")
+
+def _UTC文本(毫秒):
+    return datetime.datetime.fromtimestamp(毫秒 / 1000, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+class _生成器:
+    def __init__(self, 随机, KOL数):
+        self.随机 = 随机
+        self.KOL列表 = [f"KOL{i:02d}" for i in range(KOL数)]
+        self.KOL权重 = [1 / (i + 1) for i in range(KOL数)]
+        self.KOL胜率 = {k: 随机.uniform(0.4, 0.65) for k in self.KOL列表}
+        self.品种列表 = list(品种参数)
+        self.品种权重 = [品种参数[s][0] for s in self.品种列表]
+        self.行 = {表: [] for 表 in ("shadow_signals", "command_queue", "settlements", "execution_logs", "chat_history", "active_positions")}
+        self.信号id = self.命令id = 0
+        self.结算数 = 0
+
+    def _开仓参数(self, 品种):
+        r = self.随机
+        价格 = 品种参数[品种][1] * (1 + r.gauss(0, 0.03))
+        止损距离 = 价格 * r.uniform(0.002, 0.01)
+        做多 = r.random() < 0.55
+        方向 = "做多" if 做多 else "做空"
+        止损 = 价格 - 止损距离 if 做多 else 价格 + 止损距离
+        个数 = r.choices(list(止盈个数权重), list(止盈个数权重.values()))[0]
+        tps = [round(价格 + (1 if 做多 else -1) * 止损距离 * (0.6 + 0.6 * i) * r.uniform(0.8, 1.2), 5) for i in range(个数)]
+        return 方向, round(价格, 5), round(止损, 5), tps
+
+    def 信号(self, 毫秒, 结局="结算", 聊天倍数=0):
+        """一条父信号及其子命令；结局: 结算 / 持仓 / 挂单 / 等待执行"""
+        r = self.随机
+        self.信号id += 1
+        kol = r.choices(self.KOL列表, self.KOL权重)[0]
+        品种 = r.choices(self.品种列表, self.品种权重)[0]
+        文本时间 = _本地文本(毫秒)
+
+        if 结局 == "结算" and r.random() < 0.08:  # 平仓 / 止盈 指令
+            指令 = r.choice(["平仓", "止盈"])
+            self.行["shadow_signals"].append((self.信号id, 文本时间, 毫秒, kol, 品种, 指令, "市价", 0, "{}", "已归档"))
+            self.命令id += 1
+            self.行["command_queue"].append((self.命令id, self.信号id, kol, 品种, 指令, 0, 0, 0, 0, "已执行", None,
+                                             _UTC文本(毫秒), 毫秒, None, None))
+            return
+
+        方向, 价格, 止损, tps = self._开仓参数(品种)
+        挂单 = 结局 == "挂单" or (结局 != "持仓" and r.random() < 0.4)
+        入场价 = 价格 if 挂单 else 0
+        状态 = {"结算": "已归档", "等待执行": "等待执行"}.get(结局, "运行中")
+        self.行["shadow_signals"].append((self.信号id, 文本时间, 毫秒, kol, 品种, 方向, "挂单" if 挂单 else "市价", 入场价,
+                                         json.dumps({"sl": 止损, "tps": tps}), 状态))
+        if 结局 == "等待执行":
+            return
+
+        总手数 = round(r.choice([0.01, 0.02, 0.05, 0.1, 0.2, 0.5]) * len(tps), 2)
+        子方向 = ("买入" if 方向 == "做多" else "卖出") + ("限价" if 挂单 else "")
+        胜率 = self.KOL胜率[kol]
+        合约 = 品种参数[品种][2]
+        for 序号, tp in enumerate(tps):
+            self.命令id += 1
+            手数 = max(0.01, round(总手数 / len(tps), 2))
+            创建 = 毫秒 + r.randint(50, 2000)
+            状态 = "已执行" if 结局 != "结算" else r.choices(list(子命令状态权重), list(子命令状态权重.values()))[0]
+            ticket = 10_000_000 + self.命令id if 状态 == "已执行" else None
+            state = {"结算": "已结束", "持仓": "持仓", "挂单": "挂单"}[结局] if 状态 == "已执行" else None
+            错误 = "TRADE_RETCODE_INVALID_STOPS" if 状态 == "失败" else None
+            self.行["command_queue"].append((self.命令id, self.信号id, kol, 品种, 子方向, 手数, 入场价, 止损, tp, 状态, ticket,
+                                             _UTC文本(创建), 创建, 错误, state))
+            if 状态 != "已执行":
+                continue
+            if 结局 == "结算":
+                self._结算(kol, 品种, 方向, 手数, 价格, 止损, tp, 创建, 胜率 * 0.85 ** 序号, 合约, 聊天倍数)  # 越远的止盈位越难到
+            elif 结局 == "持仓":
+                现价 = round(价格 * (1 + r.gauss(0, 0.002)), 5)
+                浮盈 = round((现价 - 价格) * (1 if 方向 == "做多" else -1) * 手数 * 合约, 2)
+                离场 = json.dumps([{"类型": "止盈", "价格": tp}, {"类型": "止损", "价格": 止损}], ensure_ascii=False)
+                self.行["active_positions"].append((ticket, self.信号id, kol, 品种, 方向, 价格, 手数, tp, 离场, "监控中",
+                                                    现价, 浮盈, 文本时间, 毫秒))
+            self.行["execution_logs"].append((_本地文本(创建), 创建, "开仓", f"{kol} {品种} {子方向} {手数} 手 Ticket:{ticket}"))
+
+    def _结算(self, kol, 品种, 方向, 手数, 价格, 止损, tp, 创建, 胜率, 合约, 聊天倍数):
+        r = self.随机
+        平仓价 = tp if r.random() < 胜率 else 止损
+        滑点 = 价格 * r.gauss(0, 0.0003)
+        盈亏 = round(((平仓价 + 滑点) - 价格) * (1 if 方向 == "做多" else -1) * 手数 * 合约 - 手数 * 7, 2)
+        持仓秒数 = int(r.expovariate(1 / 7200)) + 30
+        平仓 = 创建 + 持仓秒数 * 1000
+        self.结算数 += 1
+        self.行["settlements"].append((self.信号id, kol, 品种, 方向, 手数, 价格, round(平仓价, 5), 盈亏,
+                                       _本地文本(平仓), 平仓, 持仓秒数))
+        self.行["execution_logs"].append((_本地文本(平仓), 平仓, "平仓", f"{kol} {品种} 盈亏 {盈亏}"))
+        for i in range(int(聊天倍数) + (r.random() < 聊天倍数 % 1)):
+            时间 = 创建 - r.randint(0, 3_600_000)
+            是信号 = int(i == 0)
+            内容 = f"{品种} {方向} 现价附近进 止损{止损:.2f} 止盈{tp:.2f}" if 是信号 else r.choice(["行情回调中，耐心等待", "今晚非农注意风险", "早盘观望", "止盈一半保本"])
+            回复 = json.dumps({"is_signal": bool(是信号), "symbol": 品种, "direction": 方向 if 是信号 else None}, ensure_ascii=False)
+            self.行["chat_history"].append((kol, 内容, 回复, 是信号, _UTC文本(时间), 时间))
+
+    def 写入(self):
+        """攒下的行一个事务写入，写完清空"""
+        with db.数据库事务() as cursor:
+            cursor.executemany("INSERT INTO shadow_signals (id, timestamp, ts_ms, kol_name, symbol, direction, entry_mode, entry_price, "
+                               "tp_sl_config, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.行["shadow_signals"])
+            cursor.executemany("INSERT INTO command_queue (id, signal_id, kol_name, symbol, direction, volume, price, sl, tp, status, "
+                               "mt5_ticket, created_at, created_ms, error_msg, state) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               self.行["command_queue"])
+            cursor.executemany("INSERT INTO settlements (signal_id, kol_name, symbol, direction, volume, entry_price, exit_price, profit, "
+                               "close_time, close_ms, hold_duration) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.行["settlements"])
+            cursor.executemany("INSERT INTO execution_logs (time, time_ms, action, details) VALUES (?, ?, ?, ?)", self.行["execution_logs"])
+            cursor.executemany("INSERT INTO chat_history (kol_name, user_content, ai_response, is_signal, created_at, created_ms) "
+                               "VALUES (?, ?, ?, ?, ?, ?)", self.行["chat_history"])
+            cursor.executemany("INSERT INTO active_positions (ticket, signal_id, kol_name, symbol, direction, entry_price, volume, tp_goal, "
+                               "exit_conditions, status, current_price, unrealized_pnl, last_update, last_update_ms) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.行["active_positions"])
+        for 列表 in self.行.values():
+            列表.clear()
+
+def 生成(结算数=100_000, 聊天倍数=2, 天数=365, KOL数=20, 持仓数=50, 挂单数=20, 等待数=5, 种子=42):
+    """往 db.数据库文件 (须是刚初始化的空库) 写模拟数据，返回 {表: 行数}。
+    结算数 达到后停；聊天倍数 是每条结算配的聊天记录数 (可以是小数)"""
+    随机 = random.Random(种子)
+    生成器 = _生成器(随机, KOL数)
+    现在 = db.当前毫秒()
+    # 结算 ≈ 信号 × 0.92 (开仓) × 2.15 (平均止盈位) × 0.92 (执行成功)，按这个估算平均到达间隔
+    平均间隔 = 天数 * 86_400_000 / max(1, 结算数 / 1.8)
+    毫秒 = 现在 - 天数 * 86_400_000
+    while 生成器.结算数 < 结算数:
+        for _ in range(每批信号数):
+            毫秒 = min(毫秒 + int(随机.expovariate(1 / 平均间隔)), 现在 - 3_600_000)
+            生成器.信号(毫秒, "结算", 聊天倍数)
+            if 生成器.结算数 >= 结算数:
+                break
+        生成器.写入()
+    for 结局, 个数 in (("持仓", 持仓数), ("挂单", 挂单数), ("等待执行", 等待数)):
+        for _ in range(个数):
+            生成器.信号(现在 - 随机.randint(0, 3_600_000), 结局)
+    生成器.写入()
+    db.重建_KOL统计()
+    with db.数据库事务() as cursor:
+        cursor.execute("ANALYZE")
+    # 已打开的读连接还拿着空表时的统计信息 (计划会选错索引)，关掉重开，和刚启动的进程看到的一样
+    db.关闭连接()
+    cursor = db.获取读连接().cursor()
+    return {表: cursor.execute(f"SELECT COUNT(*) FROM {表}").fetchone()[0] for 表 in 生成器.行}
+
+if __name__ == "__main__":
+    参数 = sys.argv[1:]
+    选项 = {"--结算数": 100_000, "--聊天倍数": 2.0, "--天数": 365, "--KOL数": 20, "--种子": 42}
+    for 名称 in list(选项):
+        if 名称 in 参数:
+            位置 = 参数.index(名称)
+            选项[名称] = type(选项[名称])(参数[位置 + 1])
+            del 参数[位置:位置 + 2]
+    if len(参数) != 1:
+        print(__doc__)
+        sys.exit(1)
+    路径 = os.path.abspath(参数[0])
+    if os.path.exists(路径) or 路径 == os.path.abspath(db.数据库文件):
+        print(f"❌ {路径} 已存在，只往新文件里生成")
+        sys.exit(1)
+    db.数据库文件 = 路径
+    db.初始化数据库()
+    开始 = time.perf_counter()
+    行数 = 生成(选项["--结算数"], 选项["--聊天倍数"], 选项["--天数"], 选项["--KOL数"], 种子=选项["--种子"])
+    db.带时间的日志打印(f"✅ [生成] {行数}，耗时 {time.perf_counter() - 开始:.1f}s，文件 {os.path.getsize(路径) / 1e6:.0f} MB: {路径}")
@@ -8,9 +8,13 @@ import time
 import datetime
 import socks 
 import requests 
+import collections
+import concurrent.futures
 import logging  # ✅ 新增：引入日志模块
 from telethon import TelegramClient, events
 from urllib.parse import urlparse
+from 消息发件箱 import 发件箱
+from 媒体仓库 import 媒体仓库
 
 # ================= 🔇 日志静音设置 (关键) =================
 # 屏蔽掉 "Server closed the connection" 这类底层重连噪音
@@ -114,6 +118,30 @@ def 刷新_业务配置():
         全局配置["只允许白名单"] = 全局开关.get("只允许白名单信号", True)
     except: pass
 
+def 读取_投递配置():
+    """配置.json -> 消息投递 (没有就用默认值)"""
+    默认 = {"并发数": 4, "超时秒": 30, "背压上限": 500, "背压等待秒": 30,
+            "重试起始秒": 1, "重试上限秒": 60, "过期秒": 900, "保留天数": 7}
+    try:
+        with open(配置文件路径, 'r', encoding='utf-8') as f:
+            return {**默认, **json.load(f).get("消息投递", {})}
+    except Exception:
+        return 默认
+
+def 读取_媒体配置():
+    """配置.json -> 媒体下载 (没有就用默认值)"""
+    默认 = {"模式": "文字优先", "并发数": 3, "下载超时秒": 60, "默认等待秒": 3, "KOL等待秒": {}}
+    try:
+        with open(配置文件路径, 'r', encoding='utf-8') as f:
+            return {**默认, **json.load(f).get("媒体下载", {})}
+    except Exception:
+        return 默认
+
+def 是图片(message):
+    """照片和图片文件才下载；视频、GIF (Telegram 里其实是 mp4)、语音、普通文件 AI分析 都不收"""
+    mime = message.file.mime_type if message.file else None
+    return bool(mime) and mime.startswith("image/") and mime != "image/gif"
+
 def get_topic_id(event):
     reply = event.message.reply_to
     if not reply: return None
@@ -122,7 +150,191 @@ def get_topic_id(event):
     return reply.reply_to_msg_id
 
 # ===========================
-# 2. 核心逻辑
+# 2. Webhook 投递 (不阻塞事件循环)
+# ===========================
+class Webhook投递器:
+    """
+    监听新消息 把消息写进 发件箱 (落盘) 就返回；投递循环 每轮取每个 KOL 最早一条到期的待投递消息，
+    最多 并发数 条同时在途，用同一个 requests.Session (连接池 keep-alive) 在线程里 POST (asyncio.to_thread)，
+    慢请求不会挡住 Telegram 更新的处理。
+    失败按指数退避重试，同一个 KOL 后面的消息等它 (先开仓后平仓不会颠倒)；决策端按 message_id 去重，重投不会重复下单。
+    发件箱 每次提交都 fsync，所有调用都排到一个专用线程上 (_库)，事件循环只等结果不等磁盘。
+    """
+    def __init__(self, 地址, 发件箱, 并发数=4, 超时=5, 背压上限=500, 背压等待秒=30):
+        self.地址 = 地址
+        self.发件箱 = 发件箱
+        self.超时 = 超时
+        self.背压上限 = 背压上限
+        self.背压等待秒 = 背压等待秒
+        self.会话 = requests.Session()
+        适配器 = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=并发数)
+        self.会话.mount("http://", 适配器)
+        self.会话.mount("https://", 适配器)
+        self.并发 = asyncio.Semaphore(并发数)
+        self.在途 = set()           # 正在投递的 KOL
+        self.唤醒 = asyncio.Event()  # 有新消息 / 有投递结束
+        self.成功 = self.失败 = self.过期 = 0
+        self.耗时 = collections.deque(maxlen=500)  # 最近的单次投递耗时 (ms)
+        self.最近错误 = None
+        self._任务 = None
+        self._库线程 = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="发件箱")
+
+    async def _库(self, 函数, *参数):
+        """在 发件箱线程 上执行 发件箱 的方法 (同一条连接只在这一个线程里用，调用按提交顺序执行)"""
+        return await asyncio.get_running_loop().run_in_executor(self._库线程, 函数, *参数)
+
+    def 启动(self):
+        待补投 = self.发件箱.深度()
+        if 待补投:
+            print(f"📮 发件箱里有 {待补投} 条上次没投出去的消息，开始补投")
+        self._任务 = asyncio.create_task(self._投递循环())
+
+    async def 投递(self, 消息键, 载荷, 延迟秒=0):
+        """先落盘再返回 (延迟秒 之后才投)。积压超过 背压上限 时最多等 背压等待秒 让投递追上 (放慢收消息，但不丢消息)"""
+        if self.发件箱.深度() >= self.背压上限:
+            print(f"⚠️ 发件箱积压 {self.发件箱.深度()} 条 (上限 {self.背压上限})，等待投递追上...")
+            截止 = time.monotonic() + self.背压等待秒
+            while self.发件箱.深度() >= self.背压上限 and time.monotonic() < 截止:
+                await asyncio.sleep(0.5)
+        if await self._库(self.发件箱.写入, 消息键, 载荷["author"], 载荷, 延迟秒):
+            self.唤醒.set()
+        else:
+            print(f"♻️ 重复消息 {消息键}，已忽略")
+
+    async def 补图(self, 消息键, 图片):
+        """图片并进还在等图片的文字消息，并进去了返回 True (没并进去由调用方另发补充)"""
+        if await self._库(self.发件箱.补图, 消息键, 图片):
+            self.唤醒.set()
+            return True
+        return False
+
+    async def _投递循环(self):
+        上次清理 = 0
+        while True:
+            self.唤醒.clear()
+            for 行 in await self._库(self.发件箱.队头, set(self.在途)):
+                if self.发件箱.已过期(行):
+                    await self._库(self.发件箱.标记过期, 行["id"])
+                    self.过期 += 1
+                    print(f"⌛ [{行['author']}] 消息 {行['msg_key']} 超过 {self.发件箱.过期秒}s 未投出 (重试 {行['attempts']} 次)，不再补发")
+                    self.唤醒.set()  # 这个 KOL 的下一条可以投了
+                    continue
+                await self.并发.acquire()
+                self.在途.add(行["author"])
+                asyncio.create_task(self._投递一条(行))
+            if time.monotonic() - 上次清理 > 3600:
+                上次清理 = time.monotonic()
+                await self._库(self.发件箱.清理)
+            # 等新消息 / 投递结束；退避中的消息最多晚 1 秒被捡起
+            try:
+                await asyncio.wait_for(self.唤醒.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _投递一条(self, 行):
+        开始 = time.perf_counter()
+        try:
+            载荷 = {**json.loads(行["payload"]), "message_id": 行["msg_key"]}
+            响应 = await asyncio.to_thread(self.会话.post, self.地址, json=载荷, timeout=self.超时)
+            响应.raise_for_status()
+            await self._库(self.发件箱.标记已投递, 行["id"])
+            self.成功 += 1
+            结果 = f"✅ 已推送 [{行['author']}] {响应.status_code}"
+        except Exception as e:
+            self.失败 += 1
+            self.最近错误 = str(e)
+            等待 = await self._库(self.发件箱.标记失败, 行["id"], e)
+            结果 = f"❌ 推送失败 [{行['author']}] 第 {行['attempts'] + 1} 次: {e}，{等待:g}s 后重试"
+        finally:
+            self.在途.discard(行["author"])
+            self.并发.release()
+            self.唤醒.set()
+        耗时 = (time.perf_counter() - 开始) * 1000
+        self.耗时.append(耗时)
+        print(f"{结果} ({耗时:.0f} ms，待投递 {self.发件箱.深度()})")
+
+    async def 指标(self):
+        样本 = sorted(self.耗时)
+        分位 = lambda 比例: round(样本[min(len(样本) - 1, int(len(样本) * 比例))], 1) if 样本 else 0.0
+        return {**await self._库(self.发件箱.指标), "成功": self.成功, "失败": self.失败, "过期": self.过期,
+                "p50_ms": 分位(0.5), "p99_ms": 分位(0.99), "最近错误": self.最近错误}
+
+    async def 关闭(self):
+        """等在途的投递结束 (最多一个请求超时)，没投完的留在发件箱里下次启动补投，再关闭连接池和发件箱"""
+        if self._任务:
+            self._任务.cancel()
+        截止 = time.monotonic() + self.超时 + 1
+        while self.在途 and time.monotonic() < 截止:
+            await asyncio.sleep(0.1)
+        剩余 = self.发件箱.深度()
+        if 剩余:
+            print(f"📮 还有 {剩余} 条消息留在发件箱，下次启动补投")
+        self.会话.close()
+        await self._库(self.发件箱.关闭)
+        self._库线程.shutdown()
+
+# ===========================
+# 3. 媒体下载 (后台并发，不拖慢文字)
+# ===========================
+class 媒体下载器:
+    """附件交给后台任务下载，最多 并发数 个同时进行；下完在线程里入库 (图片规范化、按内容哈希存，重复的只留一份)"""
+    def __init__(self, client, 仓库, 并发数=3, 超时=60):
+        self.client = client
+        self.仓库 = 仓库
+        self.超时 = 超时
+        self.并发 = asyncio.Semaphore(并发数)
+        self.成功 = self.失败 = 0
+        self.字节 = 0
+        self.耗时 = collections.deque(maxlen=500)  # 最近的单次下载耗时 (ms，不含排队)
+        self.规范化前字节 = self.规范化后字节 = 0
+        self.规范化耗时 = collections.deque(maxlen=500)
+
+    def 提交(self, message, 文件名):
+        """开始后台下载，返回 asyncio.Task (结果是保存的绝对路径，失败为 None)"""
+        return asyncio.create_task(self._下载(message, 文件名))
+
+    async def _下载(self, message, 文件名):
+        async with self.并发:
+            开始 = time.perf_counter()
+            try:
+                # [修正] 不强制指定 .jpg，让 Telethon 自动识别后缀 (如 .mp4, .gif)
+                # 避免将动图/视频强行存为 jpg 传给 AI 导致 400 错误
+                路径 = await asyncio.wait_for(
+                    self.client.download_media(message, file=os.path.join(self.仓库.目录, 文件名)), self.超时)
+            except Exception as e:
+                路径 = None
+                print(f"⚠️ 媒体下载失败 {文件名}: {e!r}")
+            耗时 = (time.perf_counter() - 开始) * 1000
+        if not 路径:
+            self.失败 += 1
+            return None
+        大小 = os.path.getsize(路径)
+        self.成功 += 1
+        self.字节 += 大小
+        self.耗时.append(耗时)
+        print(f"🖼️ 下载完成 {os.path.basename(路径)} ({大小 / 1024:.0f} KB, {耗时:.0f} ms)")
+        开始 = time.perf_counter()
+        try:
+            路径 = await asyncio.to_thread(self.仓库.入库, 路径)  # 解码/编码吃 CPU，不放在事件循环里
+        except Exception as e:
+            print(f"⚠️ 媒体入库失败，用下载的原文件 {文件名}: {e!r}")
+        else:
+            self.规范化耗时.append((time.perf_counter() - 开始) * 1000)
+            self.规范化前字节 += 大小
+            self.规范化后字节 += os.path.getsize(路径)
+        return os.path.abspath(路径)
+
+    def 指标(self):
+        def 分位(耗时, 比例):
+            样本 = sorted(耗时)
+            return round(样本[min(len(样本) - 1, int(len(样本) * 比例))], 1) if 样本 else 0.0
+        return {"下载成功": self.成功, "下载失败": self.失败, "下载MB": round(self.字节 / 1e6, 2),
+                "下载p50_ms": 分位(self.耗时, 0.5), "下载p99_ms": 分位(self.耗时, 0.99),
+                "图片压缩比": round(self.规范化后字节 / self.规范化前字节, 3) if self.规范化前字节 else 1.0,
+                "规范化p50_ms": 分位(self.规范化耗时, 0.5)}
+
+# ===========================
+# 4. 核心逻辑
 # ===========================
 async def 启动侦察兵():
     Key信息 = 加载_Key配置()
@@ -132,6 +344,13 @@ async def 启动侦察兵():
         
     全局配置["Webhook地址"] = Key信息["webhook"]
     刷新_业务配置()
+    投递配置 = 读取_投递配置()
+    投递器 = Webhook投递器(
+        全局配置["Webhook地址"],
+        发件箱(退避起始秒=投递配置["重试起始秒"], 退避上限秒=投递配置["重试上限秒"],
+              过期秒=投递配置["过期秒"], 保留天数=投递配置["保留天数"]),
+        投递配置["并发数"], 投递配置["超时秒"], 投递配置["背压上限"], 投递配置["背压等待秒"])
+    媒体配置 = 读取_媒体配置()
     
     session_path = os.path.join(当前目录, str(Key信息["session"]) + "_scout_final")
     
@@ -143,6 +362,33 @@ async def 启动侦察兵():
         connection_retries=None,
         retry_delay=5
     )
+    仓库 = 媒体仓库(图片缓存目录)
+    媒体 = 媒体下载器(client, 仓库, 媒体配置["并发数"], 媒体配置["下载超时秒"])
+    文字链 = {}      # KOL -> 最近一条带文字消息的 "已写入发件箱" 事件 (并发的处理函数里同一个 KOL 的文字按到达顺序写进发件箱)
+    后台任务 = set()  # 持有补发图片任务的引用，防止被回收
+
+    def 等待秒数(KOL):
+        """等待图片 模式下这个 KOL 最多等图片多久；文字优先 模式不等"""
+        if 媒体配置["模式"] != "等待图片":
+            return 0
+        return 媒体配置["KOL等待秒"].get(KOL, 媒体配置["默认等待秒"])
+
+    async def 补发图片(KOL, 消息键, 内容, 下载任务):
+        """
+        等图片下载完 (失败就不发)。纯图片: 这时才写发件箱。
+        有文字: 文字还在发件箱里等图片 (等待图片 模式) 就并进去一起投；已经投了再发一条 "补充" (带原消息键)。
+        """
+        try:
+            路径 = await 下载任务
+            if not 路径:
+                return
+            载荷 = {"author": KOL, "content": 内容, "images": [路径]}
+            if not 内容.strip():
+                await 投递器.投递(消息键, 载荷)
+            elif not await 投递器.补图(消息键, [路径]):
+                await 投递器.投递(f"{消息键}:图片", {**载荷, "补充": 消息键})
+        except Exception as e:
+            print(f"❌ 补发图片失败 [{KOL}] {消息键}: {e!r}")
 
     @client.on(events.NewMessage)
     async def 监听新消息(event):
@@ -170,19 +416,8 @@ async def 启动侦察兵():
                     最终内容 = f"【前文】{旧文}\n-----\n{最终内容}"
             except: pass
 
-        # === 2. 图片处理 ===
-        图片路径列表 = []
-        if event.message.media:
-            try:
-                # [修正] 不强制指定 .jpg，让 Telethon 自动识别后缀 (如 .mp4, .gif)
-                # 避免将动图/视频强行存为 jpg 传给 AI 导致 400 错误
-                fname_base = f"{匹配到的KOL}_{event.id}"
-                save_path_base = os.path.join(图片缓存目录, fname_base)
-                saved_path = await client.download_media(event.message, file=save_path_base)
-                if saved_path:
-                    图片路径列表.append(os.path.abspath(saved_path))
-            except Exception as e:
-                print(f"⚠️ 媒体下载失败: {e}")
+        # === 2. 媒体处理 (后台下载，不在这里等) ===
+        下载任务 = 媒体.提交(event.message, f"{匹配到的KOL}_{event.id}") if event.message.media and 是图片(event.message) else None
 
         # === 3. UI 打印 ===
         now = datetime.datetime.now().strftime("%H:%M:%S")
@@ -190,26 +425,55 @@ async def 启动侦察兵():
         print("=" * 35)
         print(f"🤖 [{匹配到的KOL}] ID: {topic_id}")
         
-        if 图片路径列表:
-            print("🖼️")
+        if 下载任务:
+            print("🖼️ (后台下载中)")
+        elif event.message.media:
+            print(f"🎞️ (跳过非图片附件: {event.message.file.mime_type if event.message.file else type(event.message.media).__name__})")
         
         print("📄")
         print(最终内容) 
 
-        # === 4. 推送 ===
-        try:
-            requests.post(
-                全局配置["Webhook地址"], 
-                json={"author": 匹配到的KOL, "content": 最终内容, "images": 图片路径列表}, 
-                timeout=5
-            )
-        except Exception as e:
-            print("")#(f"❌ Webhook Err: {e}")
+        # === 4. 推送 (文字在这里落盘再返回，背压也在这里等；图片下载和补充交给后台任务) ===
+        消息键 = f"{chat_id}:{event.id}"
+        if 最终内容.strip():
+            上一条 = 文字链.get(匹配到的KOL)
+            已写入 = 文字链[匹配到的KOL] = asyncio.Event()
+            try:
+                if 上一条:
+                    await 上一条.wait()
+                # 等待图片 模式: 文字先落盘但推迟 等待秒数 再投，图片在这之前下完就并进去一起投
+                await 投递器.投递(消息键, {"author": 匹配到的KOL, "content": 最终内容, "images": []},
+                              等待秒数(匹配到的KOL) if 下载任务 else 0)
+            finally:
+                已写入.set()  # 出错也放行这个 KOL 后面的消息
+        if 下载任务:
+            任务 = asyncio.create_task(补发图片(匹配到的KOL, 消息键, 最终内容, 下载任务))
+            后台任务.add(任务)
+            任务.add_done_callback(后台任务.discard)
 
     async def 热更新守护():
+        上次已处理 = 0
+        轮次 = 0
         while True:
             await asyncio.sleep(10)
             刷新_业务配置()
+            轮次 += 1
+            # 每 5 分钟有新投递或还有积压时打印一次投递指标
+            指标 = await 投递器.指标()
+            if 轮次 % 30 == 0 and (指标["成功"] + 指标["失败"] > 上次已处理 or 指标["待投递"]):
+                上次已处理 = 指标["成功"] + 指标["失败"]
+                print(f"📊 投递指标: {指标} | 媒体: {媒体.指标()} | 仓库: {仓库.指标()}")
+
+    async def 仓库清理守护():
+        """启动时先清一次 (老版本留下的 {KOL}_{id} 文件也按时间 / 容量规则处理)，之后每 清理间隔秒 一次"""
+        while True:
+            try:
+                结果 = await asyncio.to_thread(仓库.清理)
+                if 结果["删除"]:
+                    print(f"🧹 temp_images 清理: {结果}")
+            except Exception as e:
+                print(f"⚠️ temp_images 清理失败: {e!r}")
+            await asyncio.sleep(仓库.清理间隔秒)
 
     print(f"\n🕵️‍♀️ 侦察兵正在连接 (v2.9 UI风格版 + 静音模式)...")
     if Key信息["proxy"]:
@@ -224,8 +488,13 @@ async def 启动侦察兵():
     print(f"📋 监听群组: {全局配置['目标群组ID']}")
     print(f"📋 监听话题: {list(全局配置['KOL名单'].keys())}")
     
+    投递器.启动()
     asyncio.create_task(热更新守护())
-    await client.run_until_disconnected()
+    asyncio.create_task(仓库清理守护())
+    try:
+        await client.run_until_disconnected()
+    finally:
+        await 投递器.关闭()
 
 if __name__ == "__main__":
     # [新增] 自动重启机制，防止因 Telethon 解析错误(如 TypeNotFoundError)导致程序退出
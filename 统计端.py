@@ -7,7 +7,7 @@ import datetime
 import threading
 import time
 import traceback
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 
 # 引入项目基建
 import 数据库工具 as db
@@ -16,6 +16,7 @@ from MT5工具 import MT5助手
 # ================= 配置区域 =================
 监听端口 = 5020
 实时监控频率 = 3
+归档检查间隔 = 6 * 3600  # 冷数据归档每 6 小时检查一次 (保留天数见 配置.json -> 数据归档)
 启用详细日志 = False  # 设为 True 时才输出监控日志，默认关闭以避免刷屏
 
 # ================= 全局对象 =================
@@ -37,6 +38,10 @@ def 实时监控持仓():
 
     上一次完整日志_字符串 = ""
     是否首轮 = True
+    # 数据库侧只在对应表有变更时才重读 (MT5 侧每轮照常拉取)
+    持仓缓存 = db.变更缓存(db.读取_所有活跃持仓, "active_positions")
+    等待信号缓存 = db.变更缓存(db.获取等待中的信号, "shadow_signals", "command_queue")
+    已执行ticket缓存 = db.变更缓存(db.获取已执行的tickets, "command_queue")
     当前日志_缓冲 = []  # 缓存当前轮次的所有日志
 
     def 缓冲打印(消息):
@@ -87,9 +92,9 @@ def 实时监控持仓():
 
             真实持仓_列表 = MT5.获取所有持仓()
             挂单_ticket_集合 = MT5.获取挂单ticket集合()
-            数据库持仓_列表 = db.读取_所有活跃持仓()
+            数据库持仓_列表 = 持仓缓存.获取()
             数据库_ticket_集合 = {p['ticket'] for p in 数据库持仓_列表}
-            等待中的信号 = db.获取等待中的信号()
+            等待中的信号 = 等待信号缓存.获取()
 
             # --- 状态构建与比对 ---
             当前数据 = {
@@ -136,7 +141,7 @@ def 实时监控持仓():
             # 检测手动买入持仓
             缓冲打印("🔍 [手动检测] 正在检测手动买入持仓...")
             try:
-                已执行_ticket集合 = db.获取已执行的tickets()
+                已执行_ticket集合 = 已执行ticket缓存.获取()
                 手动持仓_ticket集合 = 真实Ticket_集合 - 已执行_ticket集合
                 if 手动持仓_ticket集合:
                     缓冲打印(f"    👉 检测到 {len(手动持仓_ticket集合)} 个手动买入持仓: {手动持仓_ticket集合}")
@@ -164,7 +169,7 @@ def 实时监控持仓():
             # 检测手动挂单
             缓冲打印("🔍 [手动检测] 正在检测手动挂单...")
             try:
-                已执行_ticket集合 = db.获取已执行的tickets()
+                已执行_ticket集合 = 已执行ticket缓存.获取()
                 手动挂单_ticket集合 = 挂单_ticket_集合 - 已执行_ticket集合
                 if 手动挂单_ticket集合:
                     缓冲打印(f"    👉 检测到 {len(手动挂单_ticket集合)} 个手动挂单: {手动挂单_ticket集合}")
@@ -223,22 +228,23 @@ def 实时监控持仓():
                     except Exception as e:
                         缓冲打印(f"❌ [清洗出错] Ticket:{持仓.get('ticket')} | {e}")
 
-            # 更新持仓实时数据
-            更新成功数, 更新失败数 = 0, 0
+            # 更新持仓实时数据 (收集后一次批量写入，价格/浮盈没变的行自动跳过)
             if len(真实持仓_列表) > 0:
+                实时数据列表 = []
+                报价缓存 = {}
                 for MT5订单 in 真实持仓_列表:
                     try:
                         ticket = int(MT5订单.ticket)
-                        bid, ask = MT5.获取实时报价(MT5订单.symbol)
+                        if MT5订单.symbol not in 报价缓存:
+                            报价缓存[MT5订单.symbol] = MT5.获取实时报价(MT5订单.symbol)
+                        bid, ask = 报价缓存[MT5订单.symbol]
                         current_price = bid if MT5订单.type == 0 else ask
-                        if db.更新持仓实时数据(ticket, MT5订单.price_open, current_price, MT5订单.profit):
-                            更新成功数 += 1
-                        else:
-                            更新失败数 += 1
+                        实时数据列表.append((ticket, MT5订单.price_open, current_price, MT5订单.profit))
                     except Exception as 更新错误:
                         缓冲打印(f"❌ [更新失败] Ticket:{ticket} | {更新错误}")
-                        更新失败数 += 1
-                缓冲打印(f"✅ [更新] 完成: 成功 {更新成功数}/{len(真实持仓_列表)}, 失败 {更新失败数}")
+                写入数, 跳过数, 未登记数 = db.批量更新持仓实时数据(实时数据列表)
+                缓冲打印(f"✅ [更新] 完成: 写入 {写入数}/{len(真实持仓_列表)}, 无变化跳过 {跳过数}"
+                         + (f", 未登记 {未登记数}" if 未登记数 else ""))
 
             缓冲打印("✅ [同步] 本轮同步结束")
 
@@ -250,6 +256,30 @@ def 实时监控持仓():
             traceback.print_exc()
 
 
+# ================= 冷数据归档线程 =================
+def 定时归档():
+    while True:
+        try:
+            db.归档_冷数据()
+        except Exception as e:
+            打印(f"❌ [归档] 冷数据归档失败: {e}")
+        time.sleep(归档检查间隔)
+
+def 请求全量历史():
+    """?full=1 时连同归档库一起查"""
+    return request.args.get("full", "0") in ("1", "true")
+
+def 时间窗参数():
+    """?start=&end= (YYYY-MM-DD[ HH:MM:SS] 或 epoch 毫秒) -> (开始毫秒, 结束毫秒)，没传的是 None；格式不对抛 ValueError"""
+    结果 = []
+    for 键 in ("start", "end"):
+        值 = request.args.get(键)
+        try:
+            结果.append(db.转毫秒(int(值) if 值 and 值.isdigit() else (值 or None)))
+        except ValueError:
+            raise ValueError(f"{键} 格式不对: {值!r} (应为 YYYY-MM-DD[ HH:MM:SS] 或 epoch 毫秒)")
+    return tuple(结果)
+
 # ================= Flask API =================
 @app.route('/health', methods=['GET'])
 def 健康检查():
@@ -258,14 +288,12 @@ def 健康检查():
 @app.route('/stats/summary', methods=['GET'])
 def 获取统计摘要():
     try:
-        with db.数据库_线程锁:
-            conn = db.获取连接()
-            cursor = conn.cursor()
-            cursor.execute("SELECT SUM(profit), COUNT(*), SUM(CASE WHEN profit > 0 THEN 1 ELSE 0 END) FROM settlements")
-            结算结果 = cursor.fetchone()
-            cursor.execute("SELECT COUNT(*), SUM(unrealized_pnl) FROM active_positions")
-            活跃结果 = cursor.fetchone()
-            conn.close()
+        cursor = db.获取读连接().cursor()
+        # kol_stats 汇总表 (含已归档历史)，代价只跟 KOL 数有关
+        cursor.execute("SELECT SUM(total_profit), SUM(total_trades), SUM(win_count) FROM kol_stats")
+        结算结果 = cursor.fetchone()
+        cursor.execute("SELECT COUNT(*), SUM(unrealized_pnl) FROM active_positions")
+        活跃结果 = cursor.fetchone()
         return jsonify({
             "总盈亏": round(结算结果[0] or 0, 2),
             "总交易数": 结算结果[1] or 0,
@@ -278,28 +306,70 @@ def 获取统计摘要():
 
 @app.route('/stats/positions', methods=['GET'])
 def 获取持仓():
-    return jsonify({"positions": db.读取_所有活跃持仓()}), 200
+    return jsonify({"positions": [p.转字典() for p in db.读取_所有活跃持仓()]}), 200
 
 @app.route('/stats/kol', methods=['GET'])
 def 获取KOL统计():
     return jsonify({"kol_stats": db.查询_KOL战绩()}), 200
 
+@app.route('/stats/kol/daily', methods=['GET'])
+def 获取KOL每日统计():
+    """?kol=名称&start=YYYY-MM-DD&end=YYYY-MM-DD (都可选)"""
+    return jsonify({"daily": db.查询_KOL每日战绩(request.args.get("kol"), request.args.get("start"), request.args.get("end"))}), 200
+
 @app.route('/stats/history', methods=['GET'])
 def 获取历史():
+    """?start=&end= (YYYY-MM-DD[ HH:MM:SS] 或 epoch 毫秒，左闭右开) &kol=名称 按时间窗查，都不传就是最近 50 条"""
     try:
-        历史记录 = []
-        with db.数据库_线程锁:
-            conn = db.获取连接()
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM settlements ORDER BY close_time DESC LIMIT 50")
-            行数据 = cursor.fetchall()
-            for r in 行数据: 历史记录.append(dict(r))
-            conn.close()
+        开始, 结束 = 时间窗参数()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        kol = request.args.get("kol")
+        if 开始 is not None or 结束 is not None or kol:
+            return jsonify({"history": db.查询_结算区间(开始, 结束, kol, 包含归档=请求全量历史())}), 200
+        if 请求全量历史():
+            return jsonify({"history": db.查询_全历史("settlements")}), 200
+        历史记录 = [r.转字典() for r in db.读取_最近结算(50)]
         return jsonify({"history": 历史记录}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/stats/signals', methods=['GET'])
+def 获取信号():
+    """?start=&end=&kol=&min_tps=最少止盈个数&max_sl_distance=最大止损距离&limit= (都可选)，筛选在 SQL 里按生成列做"""
+    try:
+        开始, 结束 = 时间窗参数()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        参数 = request.args
+        信号列表 = db.查询_信号止盈止损(
+            开始, 结束, 参数.get("kol"), 参数.get("min_tps", type=int), 参数.get("max_sl_distance", type=float),
+            参数.get("limit", 200, type=int))
+        return jsonify({"signals": [s.转字典() for s in 信号列表]}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/stats/signals/tpsl', methods=['GET'])
+def 获取止盈止损统计():
+    """?start=&end= 每个 KOL 的止盈个数 / 止损距离分布"""
+    try:
+        开始, 结束 = 时间窗参数()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"tpsl": db.查询_KOL止盈止损统计(开始, 结束)}), 200
+
+@app.route('/stats/positions/risk', methods=['GET'])
+def 获取持仓止损风险():
+    """?kol= 带止损的持仓，离止损最近的在前"""
+    return jsonify({"positions": db.查询_持仓止损风险(request.args.get("kol"))}), 200
+
+@app.route('/metrics', methods=['GET'])
+def 运行指标():
+    """WAL 大小 / 检查点耗时 / 空闲页，以及本进程的后台写入队列"""
+    return jsonify({"库维护": db.获取库维护指标(), "后台写入": db.获取后台写入指标()}), 200
+
 # ================= 主程序入口 =================
 if __name__ == '__main__':
     # 设置控制台编码为UTF-8
@@ -320,5 +390,7 @@ if __name__ == '__main__':
 
     t = threading.Thread(target=实时监控持仓, daemon=True)
     t.start()
+    threading.Thread(target=定时归档, daemon=True).start()
+    db.库维护.启动()  # WAL 检查点 / 增量回收 / optimize (参数见 配置.json -> 库维护)
 
     app.run(host='0.0.0.0', port=监听端口, debug=False, threaded=True)
@@ -0,0 +1,28 @@
+# 转换增量回收.py
+# -*- coding: utf-8 -*-
+"""
+把 auto_vacuum=NONE 时建的旧库 VACUUM 一次转成 auto_vacuum=INCREMENTAL，之后统计端的库维护才能增量回收空闲页。
+VACUUM 整库重写，期间所有写入都要等它做完：先停掉 决策端 / 执行端 / 统计端 再跑。
+库目录剩余空间不到 (库 + WAL) 两倍时不做。已经是 INCREMENTAL 的库什么都不改。
+
+用法:
+    python 转换增量回收.py
+"""
+import 数据库工具 as db
+
+if __name__ == "__main__":
+    db.初始化数据库()
+    转换前 = db.库维护.指标()
+    大小MB = lambda 指标: (指标['库字节'] + 指标['WAL字节']) / 1e6
+    try:
+        耗时 = db.库维护.转换增量回收()
+    except RuntimeError as e:
+        db.带时间的日志打印(f"❌ [转换增量回收] {e}")
+        raise SystemExit(1)
+    if 耗时 is None:
+        db.带时间的日志打印(f"✅ [转换增量回收] 已经是 auto_vacuum={转换前['auto_vacuum']}，不用转换")
+    else:
+        db.库维护.检查点("TRUNCATE")
+        转换后 = db.库维护.指标()
+        db.带时间的日志打印(f"✅ [转换增量回收] 完成，耗时 {耗时:.0f} ms | 库+WAL: {大小MB(转换前):.1f}MB -> "
+                          f"{大小MB(转换后):.1f}MB | auto_vacuum: {转换前['auto_vacuum']} -> {转换后['auto_vacuum']}")
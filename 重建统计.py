@@ -0,0 +1,20 @@
+# 重建统计.py
+# -*- coding: utf-8 -*-
+"""
+从 settlements (主库 + archive/ 下全部归档库) 重新生成 kol_stats / kol_symbol_daily 汇总表。
+平时 归档_结算记录 会在同一事务里累加汇总，只有手工改过/删过结算记录时才需要跑。
+
+用法:
+    python 重建统计.py
+"""
+import time
+
+import 数据库工具 as db
+
+if __name__ == "__main__":
+    db.初始化数据库()
+    开始 = time.perf_counter()
+    KOL数 = db.重建_KOL统计()
+    db.带时间的日志打印(f"✅ [重建统计] 完成: {KOL数} 个 KOL，耗时 {(time.perf_counter() - 开始) * 1000:.0f} ms")
+    for 行 in db.查询_KOL战绩():
+        print(f"  {行['kol_name']:<24} 单数: {行['total_trades']:>6} | 胜单: {行['win_count']:>6} | 盈亏: {行['total_profit']:>10.2f}")